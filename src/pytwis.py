@@ -1,35 +1,74 @@
 # -*- coding: utf-8 -*-
 
+from collections import Counter, OrderedDict
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import multiprocessing
+import re
 import redis
-from redis.exceptions import (ResponseError, TimeoutError, WatchError)
+import redis.sentinel
+from redis.exceptions import (ConnectionError, ResponseError, TimeoutError)
 import secrets
+import string
+import threading
 import time
+import zlib
 
 class PytwisConst:
     AUTH = 'auth'
     CHANGE_PASSWORD = 'changepassword'
     CONFIRM_PASSWORD = 'new_confirmed_password'
     CMD = 'cmd'
+    CURSOR = 'cursor'
     ERROR = 'error'
+    ETAG = 'etag'
+    EVENTS = 'events'
     FOLLOW = 'follow'
     FOLLOWEE = 'followee'
     FOLLOWERS = 'followers'
+    FOLLOWERS_OFFSET = 'followers_offset'
+    FOLLOWER_CNT = 'follower_cnt'
     FOLLOWER_LIST = 'follower_list'
     FOLLOWINGS = 'followings'
+    FOLLOWINGS_OFFSET = 'followings_offset'
+    FOLLOWING_CNT = 'following_cnt'
     FOLLOWING_LIST = 'following_list'
+    LAST_EVENT_ID = 'last_event_id'
+    LIMIT = 'limit'
     LOGIN = 'login'
     LOGOUT = 'logout'
+    MAX_ID = 'max_id'
     MAX_TWEET_CNT = 'max_tweet_cnt'
+    MODE = 'mode'
     NEW_PASSWORD = 'new_password'
+    NEXT_FOLLOWERS_OFFSET = 'next_followers_offset'
+    NEXT_FOLLOWINGS_OFFSET = 'next_followings_offset'
+    NEXT_CURSOR = 'next_cursor'
+    NEXT_MAX_ID = 'next_max_id'
+    NEXT_OFFSET = 'next_offset'
+    NEXT_SINCE_ID = 'next_since_id'
+    OFFSET = 'offset'
     OLD_PASSWORD = 'old_password'
+    PAGE_SIZE = 'page_size'
     PASSWORD = 'password'
     POST = 'post'
+    POST_ID = 'post_id'
     REGISTER = 'register'
+    SEARCH = 'search'
+    SINCE_ID = 'since_id'
+    TERMS = 'terms'
     TIMELINE = 'timeline'
+    TIMELINE_JSON = 'timeline_json'
     TWEET = 'tweet'
     TWEETS = 'tweets'
     UNFOLLOW = 'unfollow'
     USER_NAME = 'username'
+    USERNAME = USER_NAME
 
     # Commands
     CMD_REGISTER = REGISTER
@@ -43,7 +82,359 @@ class PytwisConst:
     CMD_FOLLOWINGS = FOLLOWINGS
     CMD_TIMELINE = TIMELINE
 
-class Pytwis:
+class PytwisLocalCache:
+    '''A thread-safe in-process LRU cache whose entries expire after ttl seconds.'''
+    
+    def __init__(self, max_size, ttl):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+class PytwisMetrics:
+    '''Thread-safe call, latency and Redis round-trip metrics of the Pytwis methods, 
+    rendered in the Prometheus text format.'''
+    
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+    PIPELINE_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        # The public method being called by the thread, to which its Redis commands are attributed.
+        self._local = threading.local()
+        self._call_cnts = Counter()
+        self._error_cnts = Counter()
+        self._command_cnts = Counter()
+        self._round_trip_cnts = Counter()
+        self._retry_cnts = Counter()
+        self._abort_cnts = Counter()
+        self._call_durations = {}
+        self._phase_durations = {}
+        self._pipeline_sizes = {}
+    
+    @staticmethod
+    def _observe(histograms, label, buckets, value):
+        # A histogram is [count per bucket..., count above the last bucket, sum].
+        histogram = histograms.setdefault(label, [0] * (len(buckets) + 2))
+        for index, bucket in enumerate(buckets):
+            if value <= bucket:
+                histogram[index] += 1
+                break
+        else:
+            histogram[len(buckets)] += 1
+        histogram[-1] += value
+    
+    def call(self, method_name, method, *args, **kwargs):
+        # Only the outermost public method of a nested call owns the Redis commands.
+        outer_method_name = getattr(self._local, 'method_name', None)
+        if outer_method_name is None:
+            self._local.method_name = method_name
+        
+        start_time = time.perf_counter()
+        succeeded = False
+        try:
+            ret = method(*args, **kwargs)
+            succeeded = not (isinstance(ret, tuple) and ret[0] is False)
+            return ret
+        finally:
+            duration = time.perf_counter() - start_time
+            if outer_method_name is None:
+                self._local.method_name = None
+            with self._lock:
+                self._call_cnts[method_name] += 1
+                if not succeeded:
+                    self._error_cnts[method_name] += 1
+                self._observe(self._call_durations, method_name, self.LATENCY_BUCKETS, duration)
+    
+    def iterate(self, method_name, iterator):
+        # Attribute the Redis commands of a generator returned by a public method to the method, 
+        # since they are issued chunk by chunk after the method has returned.
+        while True:
+            outer_method_name = getattr(self._local, 'method_name', None)
+            if outer_method_name is None:
+                self._local.method_name = method_name
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                if outer_method_name is None:
+                    self._local.method_name = None
+            yield item
+    
+    def time_phase(self, phase, method, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start_time
+            with self._lock:
+                self._observe(self._phase_durations, phase, self.LATENCY_BUCKETS, duration)
+    
+    def _record_round_trip(self, command_cnt, pipeline_size=None):
+        method_name = getattr(self._local, 'method_name', None) or 'other'
+        with self._lock:
+            self._command_cnts[method_name] += command_cnt
+            self._round_trip_cnts[method_name] += 1
+            if pipeline_size is not None:
+                self._observe(self._pipeline_sizes, method_name, self.PIPELINE_SIZE_BUCKETS, pipeline_size)
+    
+    def record_retry(self):
+        # A read which missed on a replica and was retried on the primary.
+        method_name = getattr(self._local, 'method_name', None) or 'other'
+        with self._lock:
+            self._retry_cnts[method_name] += 1
+    
+    def record_abort(self):
+        # A write rejected by an atomic check instead of retried, e.g., registering a username 
+        # claimed by another client.
+        method_name = getattr(self._local, 'method_name', None) or 'other'
+        with self._lock:
+            self._abort_cnts[method_name] += 1
+    
+    def instrument_client(self, rc):
+        # Count every command sent by the client outside of a pipeline, including EVALSHA.
+        execute_command = rc.execute_command
+        def counted_execute_command(*args, **options):
+            self._record_round_trip(1)
+            return execute_command(*args, **options)
+        rc.execute_command = counted_execute_command
+    
+    def instrument_pipeline(self, pipe):
+        execute = pipe.execute
+        def counted_execute(*args, **kwargs):
+            self._record_round_trip(len(pipe.command_stack), len(pipe.command_stack))
+            return execute(*args, **kwargs)
+        pipe.execute = counted_execute
+        return pipe
+    
+    @staticmethod
+    def _render_labels(labels):
+        return '{' + ','.join('{}="{}"'.format(name, value) for name, value in labels) + '}'
+    
+    def _render_counter(self, lines, name, description, counter, label_name):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} counter'.format(name))
+        for label, value in sorted(counter.items()):
+            lines.append('{}{} {}'.format(name, self._render_labels([(label_name, label)]), value))
+    
+    def _render_histogram(self, lines, name, description, histograms, label_name, buckets):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} histogram'.format(name))
+        for label, histogram in sorted(histograms.items()):
+            cumulative_cnt = 0
+            for bucket, cnt in zip(list(buckets) + ['+Inf'], histogram[:-1]):
+                cumulative_cnt += cnt
+                lines.append('{}_bucket{} {}'.format(name, self._render_labels([(label_name, label), 
+                                                                                ('le', bucket)]), 
+                                                     cumulative_cnt))
+            lines.append('{}_sum{} {}'.format(name, self._render_labels([(label_name, label)]), histogram[-1]))
+            lines.append('{}_count{} {}'.format(name, self._render_labels([(label_name, label)]), cumulative_cnt))
+    
+    def render(self, extra_metrics=()):
+        # extra_metrics is a list of (name, type, description, [(labels, value)]) such as 
+        # the gauges read from Redis at scrape time.
+        lines = []
+        with self._lock:
+            self._render_counter(lines, 'pytwis_calls_total', 'The number of calls of each method.', 
+                                 self._call_cnts, 'method')
+            self._render_counter(lines, 'pytwis_errors_total', 'The number of failed calls of each method.', 
+                                 self._error_cnts, 'method')
+            self._render_histogram(lines, 'pytwis_call_duration_seconds', 'The latency of each method.', 
+                                   self._call_durations, 'method', self.LATENCY_BUCKETS)
+            self._render_histogram(lines, 'pytwis_phase_duration_seconds', 
+                                   'The latency of the session checks, the hydration and the backfill.', 
+                                   self._phase_durations, 'phase', self.LATENCY_BUCKETS)
+            self._render_counter(lines, 'pytwis_redis_commands_total', 
+                                 'The number of Redis commands issued by each method.', 
+                                 self._command_cnts, 'method')
+            self._render_counter(lines, 'pytwis_redis_round_trips_total', 
+                                 'The number of Redis round trips (commands or pipelines) of each method.', 
+                                 self._round_trip_cnts, 'method')
+            self._render_counter(lines, 'pytwis_retries_total', 
+                                 'The number of reads of each method retried on the primary.', 
+                                 self._retry_cnts, 'method')
+            self._render_counter(lines, 'pytwis_aborts_total', 
+                                 'The number of writes of each method rejected by an atomic check.', 
+                                 self._abort_cnts, 'method')
+            self._render_histogram(lines, 'pytwis_pipeline_size', 'The number of commands per pipeline.', 
+                                   self._pipeline_sizes, 'method', self.PIPELINE_SIZE_BUCKETS)
+        
+        for name, metric_type, description, samples in extra_metrics:
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, self._render_labels(labels) if labels else '', value))
+        
+        return '\n'.join(lines) + '\n'
+
+# A #hashtag or an @mention which isn't part of a word, e.g., of an email address.
+TERM_REGEX = re.compile(r'(?<!\w)[#@]\w+')
+
+# The ID of a Redis Stream entry, e.g., the LAST_EVENT_ID of a post event.
+STREAM_ENTRY_ID_REGEX = re.compile(r'\d+(-\d+)?')
+
+def extract_terms(tweet):
+    # Get the #hashtags and @mentions of a tweet, lowercased and without duplicates.
+    return sorted({term.lower() for term in TERM_REGEX.findall(tweet)})
+
+def hash_password(password, n, r, p):
+    # Hash a password by scrypt with a random salt into 'scrypt$n$r$p$salt$hash'. This is a 
+    # module-level function so that PytwisPasswordHasher can run it in a worker process.
+    salt = secrets.token_bytes(PytwisPasswordHasher.SALT_SIZE)
+    password_hash = _scrypt(password, salt, n, r, p)
+    return '$'.join([PytwisPasswordHasher.SCHEME, str(n), str(r), str(p), salt.hex(), password_hash.hex()])
+
+def verify_password(password, stored_password):
+    # Check a password against the stored one, which is either hashed by hash_password 
+    # or raw, i.e., stored before the password hashing was enabled.
+    stored_params = parse_password_hash(stored_password)
+    if stored_params is None:
+        return hmac.compare_digest(password.encode('utf-8'), stored_password.encode('utf-8'))
+    
+    n, r, p, salt, password_hash = stored_params
+    return hmac.compare_digest(_scrypt(password, salt, n, r, p), password_hash)
+
+def parse_password_hash(stored_password):
+    # Return (n, r, p, salt, hash) of a password hashed by hash_password, or None if it's raw.
+    fields = stored_password.split('$')
+    if len(fields) != 6 or fields[0] != PytwisPasswordHasher.SCHEME:
+        return None
+    try:
+        return (int(fields[1]), int(fields[2]), int(fields[3]), 
+                bytes.fromhex(fields[4]), bytes.fromhex(fields[5]))
+    except ValueError:
+        return None
+
+def _scrypt(password, salt, n, r, p):
+    # scrypt needs 128 * r * (n + p + 2) bytes, more than OpenSSL allows by default for 
+    # the larger costs.
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, 
+                          maxmem=128 * r * (n + p + 2) + 1024 * 1024, 
+                          dklen=PytwisPasswordHasher.HASH_SIZE)
+
+class PytwisPasswordHasher:
+    '''Hashes and verifies the passwords by scrypt in a pool of worker processes, so that 
+    the CPU-bound hashing doesn't hold the GIL of the threads serving the requests.'''
+    
+    SCHEME = 'scrypt'
+    SALT_SIZE = 16
+    HASH_SIZE = 64
+    
+    def __init__(self, n=None, r=8, p=1, workers=None):
+        # n (a power of 2), r and p are the scrypt CPU/memory cost, block size and 
+        # parallelization. If n is None, the passwords are stored raw. workers is the number 
+        # of worker processes (None for the number of CPUs), or 0 to hash in the calling thread.
+        if n is not None and (n < 2 or n & (n - 1) != 0):
+            raise ValueError('The scrypt cost {} is not a power of 2'.format(n))
+        self._params = None if n is None else (n, r, p)
+        self._workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def _get_executor(self):
+        # Start the worker processes on the first use rather than in the constructor. By then 
+        # the process usually runs other threads (e.g., the request threads and the pub/sub 
+        # thread of the invalidations), which a fork could copy the held locks of, so the 
+        # workers are started by a fork server (or spawned where there is none) instead.
+        with self._lock:
+            if self._executor is None and self._workers != 0:
+                start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._workers, mp_context=multiprocessing.get_context(start_method))
+            return self._executor
+    
+    @staticmethod
+    def _done(value):
+        future = concurrent.futures.Future()
+        future.set_result(value)
+        return future
+    
+    def _submit(self, function, *args):
+        executor = self._get_executor()
+        if executor is None:
+            return self._done(function(*args))
+        return executor.submit(function, *args)
+    
+    def submit_hash(self, password):
+        # Return a future of the password to store.
+        if self._params is None:
+            return self._done(password)
+        return self._submit(hash_password, password, *self._params)
+    
+    def submit_verify(self, password, stored_password):
+        # Return a future of whether the password matches the stored one. The raw passwords 
+        # are compared right away.
+        if stored_password is None:
+            return self._done(False)
+        if parse_password_hash(stored_password) is None:
+            return self._done(verify_password(password, stored_password))
+        return self._submit(verify_password, password, stored_password)
+    
+    def hash(self, password):
+        return self.submit_hash(password).result()
+    
+    def verify(self, password, stored_password):
+        return self.submit_verify(password, stored_password).result()
+    
+    def needs_rehash(self, stored_password):
+        # Whether the stored password is raw or hashed with other costs than the configured ones.
+        if self._params is None:
+            return False
+        stored_params = parse_password_hash(stored_password)
+        return stored_params is None or stored_params[:3] != self._params
+
+def instrumented(method):
+    # Record the calls of a public Pytwis method if the metrics are enabled.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._metrics is None:
+            return method(self, *args, **kwargs)
+        return self._metrics.call(method.__name__, method, self, *args, **kwargs)
+    return wrapper
+
+def instrumented_phase(phase):
+    # Record the latency of a part of the Pytwis methods if the metrics are enabled.
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self._metrics is None:
+                return method(self, *args, **kwargs)
+            return self._metrics.time_phase(phase, method, self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class PytwisKeyLayout:
+    '''The Redis key layout and server-side scripts shared by Pytwis and AsyncPytwis, 
+    so that both can run against the same database.'''
     
     REDIS_SOCKET_CONNECT_TIMEOUT = 60
     
@@ -69,25 +460,533 @@ class Pytwis:
     POST_ID_UNIXTIME_KEY = 'unix_time'
     POST_ID_BODY_KEY = 'body'
     
+    # The storages of the posts (see post_storage). POST_STORAGE_HASH stores each post as 
+    # a Hash at POST_ID_KEY_FORMAT. POST_STORAGE_PACKED stores each post as the String 
+    # 'userid:unix_time:body' at PACKED_POST_ID_KEY_FORMAT, which saves the per-field 
+    # overhead. POST_STORAGE_BUCKETED stores the same Strings as the fields of one Hash per 
+    # POST_BUCKET_SIZE consecutive post IDs, which also saves the per-key overhead as long 
+    # as Redis encodes the Hash as a listpack, i.e., hash-max-listpack-entries is at least 
+    # POST_BUCKET_SIZE and hash-max-listpack-value is at least the longest packed post.
+    POST_STORAGE_HASH = 'hash'
+    POST_STORAGE_PACKED = 'packed'
+    POST_STORAGE_BUCKETED = 'bucketed'
+    POST_STORAGES = (POST_STORAGE_HASH, POST_STORAGE_PACKED, POST_STORAGE_BUCKETED)
+    PACKED_POST_ID_KEY_FORMAT = 'packed_post:{}'
+    POST_BUCKET_KEY_FORMAT = 'post_bucket:{}'
+    POST_BUCKET_SIZE = 100
+    
     GENERAL_TIMELINE_KEY = 'timeline'
     GENERAL_TIMELINE_MAX_POST_CNT = 1000
     
+    # Every post increments the version of the general timeline. The Hash GENERAL_TIMELINE_CACHE_KEY 
+    # maps GENERAL_TIMELINE_MAX_POST_CNT to the whole general timeline, serialized as JSON and 
+    # prefixed with the version it was read at (see get_general_timeline_json).
+    GENERAL_TIMELINE_VERSION_KEY = 'timeline_version'
+    GENERAL_TIMELINE_CACHE_KEY = 'timeline_cache'
+    
     POST_ID_USER_KEY_FORMAT = 'posts:{}'
+    AUTHORED_POST_ID_USER_KEY_FORMAT = 'authored_posts:{}'
+    
+    # Set once the lists of the authored posts include all the posts, i.e., when the first post 
+    # is written or when pytwis_loader.py --build-authored-posts has built the lists of the posts 
+    # written before the lists were introduced. The user timelines can't be trimmed without it 
+    # (see user_timeline_max_post_cnt), since the trimmed posts are rebuilt from the lists.
+    AUTHORED_POSTS_COMPLETE_KEY = 'authored_posts_complete'
+    AUTHORED_POSTS_INCOMPLETE_ERROR = "The user timelines can't be trimmed before the lists of the authored " \
+                                      "posts are built by pytwis_loader.py --build-authored-posts"
+    
+    # Set when posts have been trimmed from a user timeline which is no longer full, i.e., by 
+    # the LREMs of an unfollow or the LTRIM after a follow backfill. A full user timeline (see 
+    # user_timeline_max_post_cnt) is taken as trimmed anyway since every push trims it.
+    TRIMMED_USER_KEY_FORMAT = 'trimmed:{}'
     
-    def __init__(self, hostname='127.0.0.1', port=6379, db=0, password = ''):
-        # TODO: Set unix_socket_path='/tmp/redis.sock' to use Unix domain socket 
-        # if the host name is 'localhost'. Note that need to uncomment the following 
-        # line in /etc/redis/redis.conf:
-        #
-        # unixsocket /tmp/redis.sock
-        # 
-        self._rc = redis.StrictRedis(
-            host=hostname,
-            port=port,
-            db=db,
-            password=password,
-            decode_responses=True, # Decode the response bytes into strings.
-            socket_connect_timeout=self.REDIS_SOCKET_CONNECT_TIMEOUT)
+    # The sorted set of the IDs of the posts with a #hashtag or an @mention, scored by the 
+    # post IDs so that the latest posts come first. search intersects them into a temporary 
+    # SEARCH_RESULT_KEY_FORMAT sorted set.
+    TERM_ZSET_KEY_FORMAT = 'term:{}'
+    SEARCH_RESULT_KEY_FORMAT = 'search:{}'
+    SEARCH_MODE_AND = 'and'
+    SEARCH_MODE_OR = 'or'
+    SEARCH_MODES = (SEARCH_MODE_AND, SEARCH_MODE_OR)
+    SEARCH_MAX_LIMIT = 100
+    
+    # The number of post IDs read per LRANGE when paging through a timeline.
+    TIMELINE_SCAN_WINDOW = 100
+    
+    # When a user follows another, the latest posts of the followee (see follow_backfill_post_cnt) 
+    # are merged into the first FOLLOW_BACKFILL_MERGE_WINDOW posts of the user timeline, or 
+    # into the whole user timeline if it's trimmed to user_timeline_max_post_cnt posts.
+    FOLLOW_BACKFILL_MERGE_WINDOW = 1000
+    
+    # When a user unfollows another, the posts of the followee are removed from the latest 
+    # UNFOLLOW_PURGE_WINDOW posts of the user timeline by UNFOLLOW_PURGE_CHUNK_SIZE LREMs per 
+    # pipeline.
+    UNFOLLOW_PURGE_CHUNK_SIZE = 100
+    UNFOLLOW_PURGE_WINDOW = 1000
+    
+    # Users whose posts are not write-fanned out but merged into their followers' 
+    # timelines at read time (see celebrity_follower_threshold).
+    CELEBRITIES_SET_KEY = 'celebrities'
+    
+    # Redis Stream of the fanout jobs consumed by pytwis_fanout_worker.py.
+    FANOUT_STREAM_KEY = 'fanout'
+    FANOUT_STREAM_POST_ID_KEY = 'post_id'
+    FANOUT_STREAM_USERID_KEY = 'userid'
+    
+    # Redis Streams of the new posts read by read_post_events (see post_events): one per user 
+    # of the posts pushed into its timeline, and one per celebrity of its own posts, which 
+    # aren't pushed. An entry only has the post ID. Each stream is trimmed to about 
+    # POST_EVENT_STREAM_MAX_LEN entries, which bounds how far back a reader can resume.
+    POST_EVENT_USER_KEY_FORMAT = 'post_events:{}'
+    CELEBRITY_POST_EVENT_KEY_FORMAT = 'celebrity_post_events:{}'
+    POST_EVENT_STREAM_MAX_LEN = 100
+    POST_EVENT_POST_ID_KEY = 'post_id'
+    
+    # The key formats which replace the ones above in the cluster mode. All the keys of a user 
+    # share the hash tag {user_id} and hence the same slot. The global hashes USERS_HASH_KEY 
+    # and AUTHS_HASH_KEY are sharded into CLUSTER_HASH_SHARD_CNT hashes each.
+    CLUSTER_KEY_FORMATS = {
+        'USER_ID_PROFILE_KEY_FORMAT': 'user:{{{}}}',
+        'FOLLOWER_ZSET_KEY_FORMAT': 'follower:{{{}}}',
+        'FOLLOWING_ZSET_KEY_FORMAT': 'following:{{{}}}',
+        'POST_ID_USER_KEY_FORMAT': 'posts:{{{}}}',
+        'AUTHORED_POST_ID_USER_KEY_FORMAT': 'authored_posts:{{{}}}',
+        'TRIMMED_USER_KEY_FORMAT': 'trimmed:{{{}}}'}
+    CLUSTER_HASH_SHARD_CNT = 64
+    USERS_HASH_SHARD_KEY_FORMAT = 'users:{{{}}}'
+    AUTHS_HASH_SHARD_KEY_FORMAT = 'auths:{{{}}}'
+    
+    # Pub/sub channel of the user_ids whose usernames need to be evicted from the 
+    # username caches of all the Pytwis instances.
+    USERNAME_INVALIDATION_CHANNEL = 'username_invalidation'
+    
+    # Pub/sub channel of the authentication secrets which have been revoked by logout or 
+    # change_password and need to be evicted from the session caches of all the Pytwis instances.
+    SESSION_INVALIDATION_CHANNEL = 'session_invalidation'
+    
+    # Server-side version of _is_loggedin which looks up the user_id of the authentication 
+    # secret and cross-checks it against the user profile in one round trip.
+    #
+    # KEYS: AUTHS_HASH_KEY
+    # ARGV: auth_secret
+    # Returns the user_id, or nil if the user isn't logged in.
+    IS_LOGGEDIN_LUA_SCRIPT = '''
+        local user_id = redis.call('HGET', KEYS[1], ARGV[1])
+        if not user_id then
+            return nil
+        end
+        local user_id_profile_key = (string.gsub('$USER_ID_PROFILE_KEY_FORMAT', '{}', user_id, 1))
+        if redis.call('HGET', user_id_profile_key, '$USER_ID_PROFILE_AUTH_KEY') ~= ARGV[1] then
+            return nil
+        end
+        return user_id
+    '''
+    
+    # Replace the stored password by its rehash unless it has been changed in the meantime, 
+    # e.g., by change_password.
+    #
+    # KEYS: the user profile key
+    # ARGV: the stored password, the rehashed password
+    # Returns 1 if the password is replaced, otherwise 0.
+    REHASH_PASSWORD_LUA_SCRIPT = '''
+        if redis.call('HGET', KEYS[1], '$USER_ID_PROFILE_PASSWORD_KEY') ~= ARGV[1] then
+            return 0
+        end
+        redis.call('HSET', KEYS[1], '$USER_ID_PROFILE_PASSWORD_KEY', ARGV[2])
+        return 1
+    '''
+    
+    # Server-side version of post_tweet which checks the authentication secret, stores 
+    # the tweet and pushes it into all the timelines in one atomic round trip. The 
+    # $-placeholders are substituted by the constants above when the script is registered.
+    #
+    # KEYS: AUTHS_HASH_KEY, NEXT_POST_ID_KEY, CELEBRITIES_SET_KEY, FANOUT_STREAM_KEY, GENERAL_TIMELINE_KEY, 
+    #       GENERAL_TIMELINE_VERSION_KEY
+    # ARGV: auth_secret, tweet, unix_time, celebrity_follower_threshold (-1 if disabled), 
+    #       async_fanout (1 or 0), user_timeline_max_post_cnt (-1 if disabled), post_storage, 
+    #       post_events (1 or 0), followed by the terms of the tweet (see extract_terms)
+    # Returns the post ID, or 0 if the user isn't logged in.
+    POST_TWEET_LUA_SCRIPT = '''
+        -- Replicate the effects since XADD generates a random stream ID.
+        redis.replicate_commands()
+        
+        local function format_key(key_format, id)
+            return (string.gsub(key_format, '{}', id, 1))
+        end
+        
+        local user_timeline_max_post_cnt = tonumber(ARGV[6])
+        local function push_user_timeline(user_id, post_id)
+            local post_id_user_key = format_key('$POST_ID_USER_KEY_FORMAT', user_id)
+            redis.call('LPUSH', post_id_user_key, post_id)
+            if user_timeline_max_post_cnt >= 0 then
+                redis.call('LTRIM', post_id_user_key, 0, user_timeline_max_post_cnt - 1)
+            end
+            if ARGV[8] == '1' then
+                redis.call('XADD', format_key('$POST_EVENT_USER_KEY_FORMAT', user_id),
+                           'MAXLEN', '~', $POST_EVENT_STREAM_MAX_LEN, '*', '$POST_EVENT_POST_ID_KEY', post_id)
+            end
+        end
+        
+        local user_id = redis.call('HGET', KEYS[1], ARGV[1])
+        if not user_id then
+            return 0
+        end
+        local user_id_profile_key = format_key('$USER_ID_PROFILE_KEY_FORMAT', user_id)
+        if redis.call('HGET', user_id_profile_key, '$USER_ID_PROFILE_AUTH_KEY') ~= ARGV[1] then
+            return 0
+        end
+        
+        local post_id = redis.call('INCR', KEYS[2])
+        if post_id == 1 then
+            redis.call('SET', '$AUTHORED_POSTS_COMPLETE_KEY', 1)
+        end
+        local packed_post = user_id .. ':' .. ARGV[3] .. ':' .. ARGV[2]
+        if ARGV[7] == '$POST_STORAGE_PACKED' then
+            redis.call('SET', format_key('$PACKED_POST_ID_KEY_FORMAT', post_id), packed_post)
+        elseif ARGV[7] == '$POST_STORAGE_BUCKETED' then
+            redis.call('HSET', format_key('$POST_BUCKET_KEY_FORMAT', math.floor(post_id / $POST_BUCKET_SIZE)),
+                       post_id, packed_post)
+        else
+            redis.call('HMSET', format_key('$POST_ID_KEY_FORMAT', post_id),
+                       '$POST_ID_USERID_KEY', user_id,
+                       '$POST_ID_UNIXTIME_KEY', ARGV[3],
+                       '$POST_ID_BODY_KEY', ARGV[2])
+        end
+        push_user_timeline(user_id, post_id)
+        redis.call('LPUSH', format_key('$AUTHORED_POST_ID_USER_KEY_FORMAT', user_id), post_id)
+        for term_index = 9, #ARGV do
+            redis.call('ZADD', format_key('$TERM_ZSET_KEY_FORMAT', ARGV[term_index]), post_id, post_id)
+        end
+        
+        local follower_zset_key = format_key('$FOLLOWER_ZSET_KEY_FORMAT', user_id)
+        local threshold = tonumber(ARGV[4])
+        local is_celebrity = threshold >= 0 and redis.call('ZCARD', follower_zset_key) >= threshold
+        if is_celebrity then
+            redis.call('SADD', KEYS[3], user_id)
+            if ARGV[8] == '1' then
+                redis.call('XADD', format_key('$CELEBRITY_POST_EVENT_KEY_FORMAT', user_id),
+                           'MAXLEN', '~', $POST_EVENT_STREAM_MAX_LEN, '*', '$POST_EVENT_POST_ID_KEY', post_id)
+            end
+        elseif ARGV[5] == '1' then
+            redis.call('XADD', KEYS[4], '*',
+                       '$FANOUT_STREAM_POST_ID_KEY', post_id,
+                       '$FANOUT_STREAM_USERID_KEY', user_id)
+        else
+            for _, follower_user_id in ipairs(redis.call('ZRANGE', follower_zset_key, 0, -1)) do
+                push_user_timeline(follower_user_id, post_id)
+            end
+        end
+        
+        redis.call('LPUSH', KEYS[5], post_id)
+        redis.call('LTRIM', KEYS[5], 0, $GENERAL_TIMELINE_MAX_POST_CNT - 1)
+        redis.call('INCR', KEYS[6])
+        
+        return post_id
+    '''
+    
+    def _queue_post_write(self, pipe, post_id, user_id, unix_time, tweet, post_storage):
+        if post_storage == self.POST_STORAGE_HASH:
+            pipe.hmset(self.POST_ID_KEY_FORMAT.format(post_id),
+                       {self.POST_ID_USERID_KEY: user_id,
+                        self.POST_ID_UNIXTIME_KEY: unix_time,
+                        self.POST_ID_BODY_KEY: tweet})
+            return
+        
+        # Neither the user ID nor the UNIX timestamp contains ':', so the body can.
+        packed_post = '{}:{}:{}'.format(user_id, unix_time, tweet)
+        if post_storage == self.POST_STORAGE_PACKED:
+            pipe.set(self.PACKED_POST_ID_KEY_FORMAT.format(post_id), packed_post)
+        else:
+            pipe.hset(self.POST_BUCKET_KEY_FORMAT.format(int(post_id) // self.POST_BUCKET_SIZE), 
+                      post_id, packed_post)
+    
+    def _queue_post_read(self, pipe, post_id, post_storage):
+        if post_storage == self.POST_STORAGE_HASH:
+            pipe.hgetall(self.POST_ID_KEY_FORMAT.format(post_id))
+        elif post_storage == self.POST_STORAGE_PACKED:
+            pipe.get(self.PACKED_POST_ID_KEY_FORMAT.format(post_id))
+        else:
+            pipe.hget(self.POST_BUCKET_KEY_FORMAT.format(int(post_id) // self.POST_BUCKET_SIZE), post_id)
+    
+    def _queue_post_delete(self, pipe, post_id, post_storage):
+        if post_storage == self.POST_STORAGE_HASH:
+            pipe.delete(self.POST_ID_KEY_FORMAT.format(post_id))
+        elif post_storage == self.POST_STORAGE_PACKED:
+            pipe.delete(self.PACKED_POST_ID_KEY_FORMAT.format(post_id))
+        else:
+            pipe.hdel(self.POST_BUCKET_KEY_FORMAT.format(int(post_id) // self.POST_BUCKET_SIZE), post_id)
+    
+    def _decode_post(self, raw_post):
+        # Decode the reply of _queue_post_read into a tweet, or None if the post isn't there.
+        if not raw_post:
+            return None
+        if isinstance(raw_post, dict):
+            return raw_post
+        
+        user_id, unix_time, body = raw_post.split(':', 2)
+        return {self.POST_ID_USERID_KEY: user_id,
+                self.POST_ID_UNIXTIME_KEY: unix_time,
+                self.POST_ID_BODY_KEY: body}
+    
+    def _get_missing_post_storages(self, post_storage):
+        # The other storages to look a post up in, e.g., if it hasn't been migrated yet.
+        return [other_post_storage for other_post_storage in self.POST_STORAGES 
+                if other_post_storage != post_storage]
+    
+    def _get_follow_backfill_merge_window(self):
+        if self._user_timeline_max_post_cnt is not None:
+            return self._user_timeline_max_post_cnt
+        return self.FOLLOW_BACKFILL_MERGE_WINDOW
+    
+    def _plan_follow_backfill(self, home_post_ids, backfill_post_ids):
+        # Plan the merge of backfill_post_ids into home_post_ids, the first posts of a user 
+        # timeline, both from the latest to the oldest. Return a list of (post_id, pivot_post_id) 
+        # to LINSERT post_id BEFORE pivot_post_id, or to RPUSH post_id if pivot_post_id is None. 
+        # Unlike rewriting the timeline, the LINSERTs keep it sorted even if new posts are 
+        # pushed into it in the meantime.
+        home_post_id_set = set(home_post_ids)
+        is_whole_timeline = len(home_post_ids) < self._get_follow_backfill_merge_window()
+        inserts = []
+        pivot_index = 0
+        for post_id in backfill_post_ids:
+            if post_id in home_post_id_set:
+                continue
+            while pivot_index < len(home_post_ids) and int(home_post_ids[pivot_index]) > int(post_id):
+                pivot_index += 1
+            if pivot_index < len(home_post_ids):
+                inserts.append((post_id, home_post_ids[pivot_index]))
+            elif is_whole_timeline:
+                inserts.append((post_id, None))
+            else:
+                # The rest are older than the merge window.
+                break
+        
+        return inserts
+    
+    def _filter_scan_window(self, window, window_start_index, post_ids, scan_end_index, max_id, since_id):
+        # Append the post IDs of a window of the timeline which are no larger than max_id and 
+        # larger than since_id to post_ids. A timeline isn't strictly sorted, since a post is 
+        # pushed after its ID is allocated (by a fanout worker even later), so the scan goes 
+        # on for TIMELINE_SCAN_WINDOW post IDs past the first one no larger than since_id 
+        # instead of stopping there. Return the index where the scan ends, or None.
+        for index, post_id in enumerate(window, window_start_index):
+            if scan_end_index is not None and index >= scan_end_index:
+                break
+            if since_id is not None and int(post_id) <= since_id:
+                if scan_end_index is None:
+                    scan_end_index = index + self.TIMELINE_SCAN_WINDOW
+                continue
+            if max_id is not None and int(post_id) > max_id:
+                continue
+            post_ids.append(post_id)
+        
+        return scan_end_index
+    
+    def _is_scan_done(self, window, next_window_start_index, post_ids, scan_end_index, max_cnt_post_ids):
+        return len(window) < self.TIMELINE_SCAN_WINDOW or \
+               (scan_end_index is not None and next_window_start_index >= scan_end_index) or \
+               (max_cnt_post_ids != -1 and len(post_ids) >= max_cnt_post_ids)
+    
+    def _sort_scanned_post_ids(self, post_ids, max_cnt_post_ids):
+        # Sort the post IDs out of order, e.g., within the last window, before they are cut.
+        post_ids.sort(key=int, reverse=True)
+        return post_ids if max_cnt_post_ids == -1 else post_ids[:max_cnt_post_ids]
+    
+    def _is_user_timeline_trimmed(self, post_id_cnt, is_trimmed):
+        return self._user_timeline_max_post_cnt is not None and \
+               (is_trimmed or post_id_cnt >= self._user_timeline_max_post_cnt)
+    
+    def _plan_backfill_reads(self, authored_post_id_user_keys, max_cnt_post_ids, max_id, since_id):
+        # A generator which yields the batches of read commands, each run in one pipeline and sent 
+        # back its replies, and returns a list of at most max_cnt_post_ids (all if -1) post IDs no 
+        # larger than max_id and larger than since_id per list of authored posts. The first window 
+        # of every list is read in one batch. A list whose first window is all newer than max_id 
+        # is then searched for max_id by LINDEX probes, galloping and then bisecting, one batch 
+        # per step for all such lists, instead of being scanned from its head. The rest of the 
+        # lists are read in a final batch.
+        window_size = self.TIMELINE_SCAN_WINDOW
+        is_in_range = lambda post_id: (max_id is None or int(post_id) <= max_id) and \
+                                      (since_id is None or int(post_id) > since_id)
+        windows = yield [('lrange', key, 0, window_size - 1) for key in authored_post_id_user_keys]
+        post_id_lists = [[post_id for post_id in window if is_in_range(post_id)] for window in windows]
+        
+        # The post ID at index low of each list to be read on is newer than max_id, and the one 
+        # at index high isn't (or is past the end). high is None until it's found.
+        bounds = {}
+        for list_index, window in enumerate(windows):
+            if len(window) < window_size or (since_id is not None and int(window[-1]) <= since_id) or \
+               (max_cnt_post_ids != -1 and len(post_id_lists[list_index]) >= max_cnt_post_ids):
+                continue
+            if max_id is None or int(window[-1]) <= max_id:
+                bounds[list_index] = (window_size - 1, window_size)
+            else:
+                bounds[list_index] = (window_size - 1, None)
+        
+        def probe(probe_indexes):
+            post_ids = yield [('lindex', authored_post_id_user_keys[list_index], index) 
+                              for list_index, index in probe_indexes.items()]
+            for (list_index, index), post_id in zip(probe_indexes.items(), post_ids):
+                low, high = bounds[list_index]
+                if post_id is None or int(post_id) <= max_id:
+                    bounds[list_index] = (low, index)
+                else:
+                    bounds[list_index] = (index, high)
+        
+        step = window_size
+        while any(high is None for _, high in bounds.values()):
+            yield from probe({list_index: low + step for list_index, (low, high) in bounds.items() if high is None})
+            step *= 2
+        while any(high - low > window_size for low, high in bounds.values()):
+            yield from probe({list_index: (low + high) // 2 for list_index, (low, high) in bounds.items() 
+                              if high - low > window_size})
+        
+        if len(bounds) > 0:
+            list_indexes = list(bounds.keys())
+            windows = yield [('lrange', authored_post_id_user_keys[list_index], bounds[list_index][0] + 1, 
+                              -1 if max_cnt_post_ids == -1 else 
+                              bounds[list_index][1] + max_cnt_post_ids - len(post_id_lists[list_index]) - 1) 
+                             for list_index in list_indexes]
+            for list_index, window in zip(list_indexes, windows):
+                post_id_lists[list_index] += [post_id for post_id in window if is_in_range(post_id)]
+        
+        if max_cnt_post_ids == -1:
+            return post_id_lists
+        return [post_ids[:max_cnt_post_ids] for post_ids in post_id_lists]
+    
+    def _render_lua_script(self, script_template):
+        # Substitute the $-placeholders of the script by the constants.
+        lua_constants = {name: getattr(self, name) for name in dir(self) if name.isupper()}
+        return string.Template(script_template).substitute(lua_constants)
+
+class Pytwis(PytwisKeyLayout):
+    
+    # The replica latencies used by the least_latency replica selection are refreshed 
+    # at most once per REPLICA_LATENCY_PROBE_INTERVAL seconds.
+    REPLICA_LATENCY_PROBE_INTERVAL = 10
+    
+    # The batch methods (register_many, follow_many and post_tweets) handle their items 
+    # in chunks of BATCH_CHUNK_SIZE, each in a few round trips.
+    BATCH_CHUNK_SIZE = 1000
+    
+    def __init__(self, hostname='127.0.0.1', port=6379, db=0, password = '',
+                 celebrity_follower_threshold=None, async_fanout=False, lua_scripts=False,
+                 user_timeline_max_post_cnt=None, username_cache_size=0, username_cache_ttl=3600,
+                 session_cache_size=0, session_cache_ttl=5,
+                 unix_socket_path=None, max_connections=None, pool_timeout=20, socket_keepalive=False,
+                 health_check_interval=0, prewarm_connections=0, cluster=False,
+                 replicas=None, sentinels=None, sentinel_service_name='mymaster',
+                 replica_selection='round_robin', metrics=False, post_storage='hash',
+                 follow_backfill_post_cnt=100, password_scrypt_n=None, password_scrypt_r=8, 
+                 password_scrypt_p=1, password_hash_workers=None, post_events=False):
+        # If metrics is True, record the calls, the latencies and the Redis round trips of 
+        # the methods, which get_metrics renders in the Prometheus text format.
+        self._metrics = PytwisMetrics() if metrics else None
+        
+        # If celebrity_follower_threshold is set, the posts of a user with at least that 
+        # many followers are not pushed into every follower's timeline. Instead they are 
+        # merged into the follower's timeline by get_timeline at read time.
+        self._celebrity_follower_threshold = celebrity_follower_threshold
+        
+        # If async_fanout is True, post_tweet only appends a fanout job to FANOUT_STREAM_KEY 
+        # and the fanout workers push the tweet into the followers' timelines.
+        self._async_fanout = async_fanout
+        
+        # If post_events is True, every push of a tweet into a user timeline is also appended to 
+        # the post event stream of the user, which read_post_events reads. It costs an XADD per 
+        # push, so it's off by default. Note that the tweets posted by the clients (and pushed 
+        # by the fanout workers) without post_events aren't read.
+        self._post_events = post_events
+        
+        # post_storage is one of POST_STORAGES. The posts stored in the other storages, e.g., 
+        # before pytwis_loader.py --migrate-posts, are still readable.
+        if post_storage not in self.POST_STORAGES:
+            raise ValueError('Unknown post storage {}'.format(post_storage))
+        self._post_storage = post_storage
+        
+        # If password_scrypt_n is set, the passwords are hashed by scrypt with the costs 
+        # password_scrypt_n (e.g., 2 ** 14), password_scrypt_r and password_scrypt_p in 
+        # password_hash_workers worker processes (see PytwisPasswordHasher). The raw passwords 
+        # and the ones hashed with other costs are rehashed when their users log in.
+        self._password_hasher = PytwisPasswordHasher(password_scrypt_n, password_scrypt_r, 
+                                                     password_scrypt_p, password_hash_workers)
+        
+        # If user_timeline_max_post_cnt is set, every user timeline is left trimmed to only retain 
+        # the latest user_timeline_max_post_cnt tweets. The older tweets are rebuilt from the 
+        # tweets authored by the followings when a reader pages past them. It's refused on a 
+        # database whose posts aren't all in the lists of the authored posts yet (see 
+        # AUTHORED_POSTS_COMPLETE_KEY).
+        self._user_timeline_max_post_cnt = user_timeline_max_post_cnt
+        
+        # When a user follows another, the latest follow_backfill_post_cnt posts of the followee 
+        # are merged into the user timeline (0 to disable). Either way the posts of the followee 
+        # are removed from the user timeline when the user unfollows the followee.
+        self._follow_backfill_post_cnt = follow_backfill_post_cnt
+        
+        # If cluster is True, connect to a Redis Cluster via the node hostname:port and use 
+        # CLUSTER_KEY_FORMATS. Note that the Lua scripts aren't supported in the cluster mode 
+        # since they access the keys of multiple users.
+        self._cluster = cluster
+        if cluster:
+            if lua_scripts:
+                raise ValueError('The Lua scripts are not supported in the cluster mode')
+            for key_format_name, key_format in self.CLUSTER_KEY_FORMATS.items():
+                setattr(self, key_format_name, key_format)
+            if replicas is not None or sentinels is not None:
+                raise ValueError('The replicas are not supported in the cluster mode')
+            if post_events:
+                raise ValueError('The post events are not supported in the cluster mode')
+        
+        if replica_selection not in ('round_robin', 'least_latency'):
+            raise ValueError('Unknown replica selection {}'.format(replica_selection))
+        
+        connection_kwargs = {
+            'db': db,
+            'password': password,
+            'decode_responses': True, # Decode the response bytes into strings.
+            'health_check_interval': health_check_interval}
+        if unix_socket_path is not None:
+            # Connect via the Unix domain socket if Redis is on the same host. Note that need to 
+            # uncomment the following line in /etc/redis/redis.conf:
+            #
+            # unixsocket /tmp/redis.sock
+            #
+            connection_kwargs['connection_class'] = redis.UnixDomainSocketConnection
+            connection_kwargs['path'] = unix_socket_path
+            hostname = unix_socket_path
+        else:
+            connection_kwargs['host'] = hostname
+            connection_kwargs['port'] = port
+            connection_kwargs['socket_connect_timeout'] = self.REDIS_SOCKET_CONNECT_TIMEOUT
+            connection_kwargs['socket_keepalive'] = socket_keepalive
+        
+        # If max_connections is set, a thread which needs a connection when all the max_connections 
+        # connections are in use waits up to pool_timeout seconds for one to be released, 
+        # instead of opening yet another connection.
+        if cluster:
+            del connection_kwargs['db']
+            if max_connections is not None:
+                connection_kwargs['max_connections'] = max_connections
+            self._rc = redis.RedisCluster(**connection_kwargs)
+            connection_pool = None
+        elif sentinels is not None:
+            # Discover the primary via the Sentinels, which also fail it over.
+            connection_kwargs.pop('host', None)
+            connection_kwargs.pop('port', None)
+            self._sentinel = redis.sentinel.Sentinel(sentinels, 
+                                                     socket_timeout=self.REDIS_SOCKET_CONNECT_TIMEOUT)
+            self._rc = self._sentinel.master_for(sentinel_service_name, **connection_kwargs)
+            connection_pool = None
+        elif max_connections is not None:
+            connection_pool = redis.BlockingConnectionPool(max_connections=max_connections,
+                                                           timeout=pool_timeout,
+                                                           **connection_kwargs)
+        else:
+            connection_pool = redis.ConnectionPool(**connection_kwargs)
+        if connection_pool is not None:
+            self._rc = redis.StrictRedis(connection_pool=connection_pool)
+        
+        if self._metrics is not None:
+            self._metrics.instrument_client(self._rc)
         
         # Test the connection by ping.
         try:
@@ -96,21 +995,288 @@ class Pytwis:
         except (ResponseError, TimeoutError) as e:
             raise ValueError(str(e)) from e
         
-    def _is_loggedin(self, auth_secret):
+        if user_timeline_max_post_cnt is not None and self._rc.exists(self.NEXT_POST_ID_KEY) and \
+           not self._rc.exists(self.AUTHORED_POSTS_COMPLETE_KEY):
+            raise ValueError(self.AUTHORED_POSTS_INCOMPLETE_ERROR)
+        
+        # Open prewarm_connections connections in advance so that the first requests don't 
+        # pay for the connection setup.
+        if connection_pool is not None:
+            prewarmed_connections = [connection_pool.get_connection('PING') 
+                                     for _ in range(prewarm_connections)]
+            for connection in prewarmed_connections:
+                connection_pool.release(connection)
+        
+        # If replicas (a list of (hostname, port)) or sentinels is set, the read-only methods 
+        # (get_timeline, get_timeline_page, get_followers, get_following and login) are routed 
+        # to the replicas, picked by replica_selection: 'round_robin' or 'least_latency'. 
+        # The writes and their session checks stay on the primary. Since a replica lags behind 
+        # the primary, a session or a username which isn't found on a replica is looked up 
+        # again on the primary.
+        self._replica_rcs = []
+        if sentinels is not None:
+            # A Sentinel replica client balances its connections across the replicas of the service.
+            self._replica_rcs.append(self._sentinel.slave_for(sentinel_service_name, **connection_kwargs))
+        for replica_hostname, replica_port in replicas or []:
+            replica_connection_kwargs = dict(connection_kwargs, host=replica_hostname, port=replica_port)
+            if max_connections is not None:
+                replica_connection_pool = redis.BlockingConnectionPool(max_connections=max_connections,
+                                                                       timeout=pool_timeout,
+                                                                       **replica_connection_kwargs)
+            else:
+                replica_connection_pool = redis.ConnectionPool(**replica_connection_kwargs)
+            self._replica_rcs.append(redis.StrictRedis(connection_pool=replica_connection_pool))
+        
+        if self._metrics is not None:
+            for replica_rc in self._replica_rcs:
+                self._metrics.instrument_client(replica_rc)
+        
+        self._replica_selection = replica_selection
+        self._replica_lock = threading.Lock()
+        self._next_replica_index = 0
+        self._replica_latencies = [0.0] * len(self._replica_rcs)
+        self._replica_latencies_probed_at = 0.0
+        
+        # If lua_scripts is True, run the commands which support it as server-side Lua scripts. 
+        # A registered script is called via EVALSHA and only loaded into the Redis server 
+        # when it is called for the first time.
+        self._post_tweet_script = None
+        self._is_loggedin_script = None
+        if lua_scripts:
+            self._post_tweet_script = self._register_lua_script(self.POST_TWEET_LUA_SCRIPT)
+            self._is_loggedin_script = self._register_lua_script(self.IS_LOGGEDIN_LUA_SCRIPT)
+        
+        # This script only accesses the profile of one user, so it's also run in the cluster mode.
+        self._rehash_password_script = self._register_lua_script(self.REHASH_PASSWORD_LUA_SCRIPT)
+        
+        invalidation_handlers = {}
+        
+        # If username_cache_size is positive, cache the user_id-to-username mappings used 
+        # to hydrate timelines and follower lists. The entries are evicted via 
+        # USERNAME_INVALIDATION_CHANNEL so that all the instances stay consistent.
+        self._username_cache = None
+        if username_cache_size > 0:
+            self._username_cache = PytwisLocalCache(username_cache_size, username_cache_ttl)
+            invalidation_handlers[self.USERNAME_INVALIDATION_CHANNEL] = \
+                lambda message: self._username_cache.delete(message['data'])
+        
+        # If session_cache_size is positive, cache the authentication_secret-to-user_id 
+        # mappings checked by _is_loggedin for session_cache_ttl seconds. The revoked 
+        # authentication secrets are evicted via SESSION_INVALIDATION_CHANNEL.
+        self._session_cache = None
+        if session_cache_size > 0:
+            self._session_cache = PytwisLocalCache(session_cache_size, session_cache_ttl)
+            invalidation_handlers[self.SESSION_INVALIDATION_CHANNEL] = \
+                lambda message: self._session_cache.delete(message['data'])
+        
+        if len(invalidation_handlers) > 0:
+            self._invalidation_pubsub = self._rc.pubsub(ignore_subscribe_messages=True)
+            self._invalidation_pubsub.subscribe(**invalidation_handlers)
+            self._invalidation_pubsub.run_in_thread(sleep_time=1, daemon=True)
+    
+    def _pipeline(self, rc=None, transaction=True):
+        # The commands of a pipeline are executed in a MULTI transaction, except in the cluster 
+        # mode where a pipeline is split into one batch per node and can't be a transaction.
+        if rc is None:
+            rc = self._rc
+        pipe = rc.pipeline(transaction=transaction and not self._cluster)
+        if self._metrics is not None:
+            self._metrics.instrument_pipeline(pipe)
+        return pipe
+    
+    def _read_rc(self):
+        # Get the client for a read-only method: a replica if any, otherwise the primary.
+        if len(self._replica_rcs) == 0:
+            return self._rc
+        
+        with self._replica_lock:
+            if self._replica_selection == 'least_latency':
+                if time.time() - self._replica_latencies_probed_at >= self.REPLICA_LATENCY_PROBE_INTERVAL:
+                    self._replica_latencies_probed_at = time.time()
+                    self._probe_replica_latencies()
+                return self._replica_rcs[min(range(len(self._replica_rcs)), 
+                                             key=self._replica_latencies.__getitem__)]
+            
+            replica_rc = self._replica_rcs[self._next_replica_index]
+            self._next_replica_index = (self._next_replica_index + 1) % len(self._replica_rcs)
+            return replica_rc
+    
+    def _probe_replica_latencies(self):
+        # Measure the round-trip time of a PING to each replica. An unreachable replica is 
+        # never picked until it answers a later probe.
+        for index, replica_rc in enumerate(self._replica_rcs):
+            start_time = time.perf_counter()
+            try:
+                replica_rc.ping()
+                self._replica_latencies[index] = time.perf_counter() - start_time
+            except (ConnectionError, ResponseError, TimeoutError):
+                self._replica_latencies[index] = float('inf')
+    
+    def _users_hash_key(self, username):
+        if not self._cluster:
+            return self.USERS_HASH_KEY
+        shard = zlib.crc32(username.encode('utf-8')) % self.CLUSTER_HASH_SHARD_CNT
+        return self.USERS_HASH_SHARD_KEY_FORMAT.format(shard)
+    
+    def _auths_hash_key(self, auth_secret):
+        if not self._cluster:
+            return self.AUTHS_HASH_KEY
+        shard = zlib.crc32(auth_secret.encode('utf-8')) % self.CLUSTER_HASH_SHARD_CNT
+        return self.AUTHS_HASH_SHARD_KEY_FORMAT.format(shard)
+    
+    def _register_lua_script(self, script_template):
+        return self._rc.register_script(self._render_lua_script(script_template))
+        
+    def invalidate_username(self, user_id):
+        # Evict the username of user_id from the username caches of all the instances.
+        self._rc.publish(self.USERNAME_INVALIDATION_CHANNEL, user_id)
+    
+    def get_username_cache_stats(self):
+        if self._username_cache is None:
+            return None
+        return self._username_cache.stats()
+    
+    @instrumented_phase('username_hydration')
+    def _get_usernames(self, user_ids, rc=None):
+        # Get the usernames of the user_ids, from the username cache if possible.
+        usernames = [None] * len(user_ids)
+        missed_indexes = []
+        for index, user_id in enumerate(user_ids):
+            if self._username_cache is not None:
+                usernames[index] = self._username_cache.get(user_id)
+            if usernames[index] is None:
+                missed_indexes.append(index)
+        
+        if len(missed_indexes) == 0:
+            return usernames
+        
+        with self._pipeline(rc) as pipe:
+            for index in missed_indexes:
+                user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_ids[index])
+                pipe.hget(user_id_profile_key, self.USER_ID_PROFILE_USERNAME_KEY)
+            missed_usernames = pipe.execute()
+        
+        for index, username in zip(missed_indexes, missed_usernames):
+            usernames[index] = username
+            if self._username_cache is not None and username is not None:
+                self._username_cache.set(user_ids[index], username)
+        
+        return usernames
+    
+    def get_metrics(self):
+        if self._metrics is None:
+            return None
+        
+        extra_metrics = []
+        for cache_name, cache in (('username', self._username_cache), ('session', self._session_cache)):
+            if cache is not None:
+                stats = cache.stats()
+                extra_metrics.append(('pytwis_{}_cache_hits_total'.format(cache_name), 'counter', 
+                                      'The number of {} cache hits.'.format(cache_name), [([], stats['hits'])]))
+                extra_metrics.append(('pytwis_{}_cache_misses_total'.format(cache_name), 'counter', 
+                                      'The number of {} cache misses.'.format(cache_name), [([], stats['misses'])]))
+        if self._async_fanout:
+            extra_metrics.append(('pytwis_fanout_backlog', 'gauge', 
+                                  'The number of the fanout jobs which are not finished yet.', 
+                                  [([], self._rc.xlen(self.FANOUT_STREAM_KEY))]))
+        
+        return self._metrics.render(extra_metrics)
+    
+    def get_session_cache_stats(self):
+        if self._session_cache is None:
+            return None
+        return self._session_cache.stats()
+    
+    def _revoke_auth_secret(self, pipe, auth_secret):
+        # Evict the revoked authentication secret from the session caches of all the instances.
+        if self._session_cache is not None:
+            self._session_cache.delete(auth_secret)
+        pipe.publish(self.SESSION_INVALIDATION_CHANNEL, auth_secret)
+    
+    def _get_loggedin_user_id(self, auth_secret, rc):
+        if self._is_loggedin_script is not None:
+            # Check the authentication secret in one round trip.
+            return self._is_loggedin_script(keys=[self.AUTHS_HASH_KEY], args=[auth_secret], client=rc)
+        
         # Get the user_id from the authentication secret.
-        user_id = self._rc.hget(self.AUTHS_HASH_KEY, auth_secret)
+        user_id = rc.hget(self._auths_hash_key(auth_secret), auth_secret)
         if user_id is None:
-            return (False, None)
+            return None
         
         # Compare the input authentication secret with the stored one.
         user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
-        stored_auth_secret = self._rc.hget(user_id_profile_key, self.USER_ID_PROFILE_AUTH_KEY)
-        if auth_secret == stored_auth_secret:
-            return (True, user_id)
-        else:
+        stored_auth_secret = rc.hget(user_id_profile_key, self.USER_ID_PROFILE_AUTH_KEY)
+        if auth_secret != stored_auth_secret:
             # TODO: Resolve the inconsistency of the two authentication secrets. 
+            return None
+        
+        return user_id
+    
+    @instrumented_phase('auth')
+    def _is_loggedin(self, auth_secret, rc=None):
+        if self._session_cache is not None:
+            user_id = self._session_cache.get(auth_secret)
+            if user_id is not None:
+                return (True, user_id)
+        
+        if rc is None:
+            rc = self._rc
+        user_id = self._get_loggedin_user_id(auth_secret, rc)
+        if user_id is None and rc is not self._rc:
+            # The session may not have been replicated yet.
+            if self._metrics is not None:
+                self._metrics.record_retry()
+            user_id = self._get_loggedin_user_id(auth_secret, self._rc)
+        if user_id is None:
             return (False, None)
+        
+        if self._session_cache is not None:
+            self._session_cache.set(auth_secret, user_id)
+        return (True, user_id)
+    
+    @instrumented_phase('auth')
+    def _get_loggedin_user_ids(self, auth_secrets):
+        # Check a batch of authentication secrets in two round trips. Return the user_id of 
+        # each authentication secret, or None if it isn't logged in.
+        loggedin_user_ids = {}
+        unchecked_auth_secrets = []
+        for auth_secret in set(auth_secrets):
+            user_id = None
+            if self._session_cache is not None:
+                user_id = self._session_cache.get(auth_secret)
+            if user_id is None:
+                unchecked_auth_secrets.append(auth_secret)
+            else:
+                loggedin_user_ids[auth_secret] = user_id
+        
+        if len(unchecked_auth_secrets) > 0:
+            # Get the user_ids from the authentication secrets.
+            with self._pipeline() as pipe:
+                for auth_secret in unchecked_auth_secrets:
+                    pipe.hget(self._auths_hash_key(auth_secret), auth_secret)
+                user_ids = pipe.execute()
+            
+            # Compare the input authentication secrets with the stored ones.
+            with self._pipeline() as pipe:
+                for user_id in user_ids:
+                    if user_id is not None:
+                        pipe.hget(self.USER_ID_PROFILE_KEY_FORMAT.format(user_id), 
+                                  self.USER_ID_PROFILE_AUTH_KEY)
+                stored_auth_secrets = iter(pipe.execute())
+            
+            for auth_secret, user_id in zip(unchecked_auth_secrets, user_ids):
+                if user_id is not None and next(stored_auth_secrets) == auth_secret:
+                    loggedin_user_ids[auth_secret] = user_id
+                    if self._session_cache is not None:
+                        self._session_cache.set(auth_secret, user_id)
+        
+        return [loggedin_user_ids.get(auth_secret) for auth_secret in auth_secrets]
+    
+    def _chunks(self, items):
+        for chunk_start in range(0, len(items), self.BATCH_CHUNK_SIZE):
+            yield items[chunk_start:chunk_start + self.BATCH_CHUNK_SIZE]
 
+    @instrumented
     def register(self, username, password):
         result = {'error': None}
         
@@ -118,43 +1284,35 @@ class Pytwis:
         # TODO: add the password check.
         # https://stackoverflow.com/questions/16709638/checking-the-strength-of-a-password-how-to-check-conditions
         
-        # Update the username-to-user_id mapping.
-        with self._rc.pipeline() as pipe:
-            while True:
-                try:
-                    # Put a watch on the Hash 'users': username -> user-id, in case that 
-                    # multiple clients are registering with the same username.
-                    pipe.watch(self.USERS_HASH_KEY)
-                    username_exists = pipe.hexists(self.USERS_HASH_KEY, username)
-                    if username_exists:
-                        result[PytwisConst.ERROR] = 'username {} already exists'.format(username)
-                        return (False, result);
-                    
-                    # Get the next user-id. If the key "next_user_id" doesn't exist,
-                    # it will be created and initialized as 0, and then incremented by 1.
-                    user_id = pipe.incr(self.NEXT_USER_ID_KEY)
-                    
-                    # Set the username-to-user_id pair in USERS_HASH_KEY.
-                    pipe.multi()
-                    pipe.hset(self.USERS_HASH_KEY, username, user_id)
-                    pipe.execute()
-                    
-                    break
-                except WatchError:
-                    continue
-                
+        # Hash the password in a worker process while the username is claimed.
+        password_future = self._password_hasher.submit_hash(password)
+        
+        # Get the next user-id. If the key "next_user_id" doesn't exist,
+        # it will be created and initialized as 0, and then incremented by 1.
+        user_id = self._rc.incr(self.NEXT_USER_ID_KEY)
+        
+        # Claim the username by HSETNX, which only succeeds for one of the clients registering 
+        # with the same username. Unlike a WATCH on the Hash 'users', it never makes the 
+        # concurrent registrations of other usernames retry. The user-id of a failed 
+        # registration is left unused.
+        if not self._rc.hsetnx(self._users_hash_key(username), username, user_id):
+            result[PytwisConst.ERROR] = 'username {} already exists'.format(username)
+            password_future.cancel()
+            if self._metrics is not None:
+                self._metrics.record_abort()
+            return (False, result)
+        
+        with self._pipeline() as pipe:
             # Generate the authentication secret.
             auth_secret = secrets.token_hex()
             user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
             
-            pipe.multi()
             # Update the authentication_secret-to-user_id mapping.
-            pipe.hset(self.AUTHS_HASH_KEY, auth_secret, user_id)
+            pipe.hset(self._auths_hash_key(auth_secret), auth_secret, user_id)
             # Create the user profile.
-            # TODO: Store the hashed password instead of the raw password.
             pipe.hmset(user_id_profile_key, 
                        {self.USER_ID_PROFILE_USERNAME_KEY: username,
-                        self.USER_ID_PROFILE_PASSWORD_KEY: password,
+                        self.USER_ID_PROFILE_PASSWORD_KEY: password_future.result(),
                         self.USER_ID_PROFILE_AUTH_KEY: auth_secret})
             pipe.execute()
 
@@ -162,7 +1320,55 @@ class Pytwis:
         result[PytwisConst.AUTH] = auth_secret
         
         return (True, result)
+    
+    @instrumented
+    def register_many(self, credentials):
+        # Register a batch of users given as (username, password) pairs. Return a list of 
+        # (succeeded, result) in the same order, as returned by register.
+        results = []
+        for chunk in self._chunks(credentials):
+            # Hash the passwords of the chunk in parallel by the worker processes.
+            password_futures = [self._password_hasher.submit_hash(password) for _, password in chunk]
+            
+            # Allocate the user-ids of the whole chunk at once. The user-ids of the 
+            # usernames which already exist are left unused.
+            last_user_id = self._rc.incrby(self.NEXT_USER_ID_KEY, len(chunk))
+            user_ids = range(last_user_id - len(chunk) + 1, last_user_id + 1)
             
+            # Claim the usernames by HSETNX, which fails for the existing usernames 
+            # including the duplicates within the batch.
+            with self._pipeline() as pipe:
+                for (username, _), user_id in zip(chunk, user_ids):
+                    pipe.hsetnx(self._users_hash_key(username), username, user_id)
+                claimed = pipe.execute()
+            
+            with self._pipeline() as pipe:
+                for (username, _), password_future, user_id, username_claimed in zip(chunk, password_futures, 
+                                                                                     user_ids, claimed):
+                    result = {'error': None}
+                    if not username_claimed:
+                        result[PytwisConst.ERROR] = 'username {} already exists'.format(username)
+                        results.append((False, result))
+                        if self._metrics is not None:
+                            self._metrics.record_abort()
+                        continue
+                    
+                    # Update the authentication_secret-to-user_id mapping and create the user profile.
+                    auth_secret = secrets.token_hex()
+                    pipe.hset(self._auths_hash_key(auth_secret), auth_secret, user_id)
+                    pipe.hmset(self.USER_ID_PROFILE_KEY_FORMAT.format(user_id), 
+                               {self.USER_ID_PROFILE_USERNAME_KEY: username,
+                                self.USER_ID_PROFILE_PASSWORD_KEY: password_future.result(),
+                                self.USER_ID_PROFILE_AUTH_KEY: auth_secret})
+                    
+                    result[PytwisConst.USER_NAME] = user_id
+                    result[PytwisConst.AUTH] = auth_secret
+                    results.append((True, result))
+                pipe.execute()
+        
+        return results
+            
+    @instrumented
     def change_password(self, auth_secret, old_password, new_password):
         result = {'error': None}
         
@@ -175,7 +1381,7 @@ class Pytwis:
         # Check if the old password matches.
         user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
         stored_password = self._rc.hget(user_id_profile_key, self.USER_ID_PROFILE_PASSWORD_KEY)
-        if stored_password != old_password:
+        if not self._password_hasher.verify(old_password, stored_password):
             result[PytwisConst.ERROR] = 'Incorrect old password'
             return (False, result)
         
@@ -185,22 +1391,31 @@ class Pytwis:
         new_auth_secret = secrets.token_hex()
         
         # Replace the old password by the new one and the old authentication secret by the new one.
-        with self._rc.pipeline() as pipe:
-            pipe.multi()
+        new_password = self._password_hasher.hash(new_password)
+        with self._pipeline() as pipe:
             pipe.hset(user_id_profile_key, self.USER_ID_PROFILE_PASSWORD_KEY, new_password)
             pipe.hset(user_id_profile_key, self.USER_ID_PROFILE_AUTH_KEY, new_auth_secret)
-            pipe.hset(self.AUTHS_HASH_KEY, new_auth_secret, user_id)
-            pipe.hdel(self.AUTHS_HASH_KEY, auth_secret)
+            pipe.hset(self._auths_hash_key(new_auth_secret), new_auth_secret, user_id)
+            pipe.hdel(self._auths_hash_key(auth_secret), auth_secret)
+            self._revoke_auth_secret(pipe, auth_secret)
             pipe.execute()
         
         result[PytwisConst.AUTH] = new_auth_secret
         return (True, result)
     
+    @instrumented
     def login(self, username, password):
         result = {'error': None}
         
-        # Get the user-id based on the username.
-        user_id = self._rc.hget(self.USERS_HASH_KEY, username)
+        # Get the user-id based on the username, from the primary if the user has 
+        # just registered and hasn't been replicated yet.
+        rc = self._read_rc()
+        user_id = rc.hget(self._users_hash_key(username), username)
+        if user_id is None and rc is not self._rc:
+            if self._metrics is not None:
+                self._metrics.record_retry()
+            rc = self._rc
+            user_id = rc.hget(self._users_hash_key(username), username)
         if user_id is None:
             result[PytwisConst.ERROR] = "username {} doesn't exist".format(username)
             return (False, result)
@@ -208,15 +1423,26 @@ class Pytwis:
         # Compare the input password with the stored one. If it matches, 
         # return the authentication secret.
         user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
-        stored_password = self._rc.hget(user_id_profile_key, self.USER_ID_PROFILE_PASSWORD_KEY)
-        if password == stored_password:
+        stored_password, auth_secret = rc.hmget(user_id_profile_key, 
+                                                self.USER_ID_PROFILE_PASSWORD_KEY, 
+                                                self.USER_ID_PROFILE_AUTH_KEY)
+        if self._password_hasher.verify(password, stored_password):
+            # Rehash the password on the primary if it's raw or hashed with the old costs.
+            if self._password_hasher.needs_rehash(stored_password):
+                rehashed = self._rehash_password_script(keys=[user_id_profile_key], 
+                                                        args=[stored_password, 
+                                                              self._password_hasher.hash(password)])
+                if not rehashed and self._metrics is not None:
+                    self._metrics.record_abort()
+            
             result[PytwisConst.USER_NAME] = username
-            result[PytwisConst.AUTH] = self._rc.hget(user_id_profile_key, self.USER_ID_PROFILE_AUTH_KEY)
+            result[PytwisConst.AUTH] = auth_secret
             return (True, result)
         else:
             result[PytwisConst.ERROR] = 'Incorrect password'
             return (False, result)
     
+    @instrumented
     def logout(self, auth_secret):
         result = {'error': None}
         
@@ -231,20 +1457,75 @@ class Pytwis:
         
         # Replace the old authentication secret by the new one.
         user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
-        with self._rc.pipeline() as pipe:
-            pipe.multi()
+        with self._pipeline() as pipe:
             pipe.hset(user_id_profile_key, self.USER_ID_PROFILE_AUTH_KEY, new_auth_secret)
-            pipe.hset(self.AUTHS_HASH_KEY, new_auth_secret, user_id)
-            pipe.hdel(self.AUTHS_HASH_KEY, auth_secret)
+            pipe.hset(self._auths_hash_key(new_auth_secret), new_auth_secret, user_id)
+            pipe.hdel(self._auths_hash_key(auth_secret), auth_secret)
+            self._revoke_auth_secret(pipe, auth_secret)
             pipe.execute()
 
         result[PytwisConst.AUTH] = ''
         result[PytwisConst.USER_NAME] = ''
         return (True, result)
     
+    def _push_user_timeline(self, pipe, user_id, post_id):
+        post_id_user_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
+        pipe.lpush(post_id_user_key, post_id)
+        if self._user_timeline_max_post_cnt is not None:
+            pipe.ltrim(post_id_user_key, 0, self._user_timeline_max_post_cnt - 1)
+        self._publish_post_event(pipe, self.POST_EVENT_USER_KEY_FORMAT.format(user_id), post_id)
+    
+    def _index_terms(self, pipe, post_id, tweet):
+        for term in extract_terms(tweet):
+            pipe.zadd(self.TERM_ZSET_KEY_FORMAT.format(term), {post_id: post_id})
+    
+    def _fanout_post(self, pipe, post_id, follower_user_ids):
+        # Push the tweet into the timelines of the followers.
+        for follower_user_id in follower_user_ids:
+            self._push_user_timeline(pipe, follower_user_id, post_id)
+    
+    def _get_user_ids_without_post(self, user_ids, post_id):
+        # Get the users whose timelines don't have the post, so that a fanout job can be 
+        # retried, or follow a follow which has already backfilled the post, without pushing 
+        # the post twice. The backfill inserts the post within its merge window, so only the 
+        # head of each timeline is looked up by LPOS.
+        if len(user_ids) == 0:
+            return []
+        with self._pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.lpos(self.POST_ID_USER_KEY_FORMAT.format(user_id), post_id, 
+                          maxlen=self._get_follow_backfill_merge_window() + self._follow_backfill_post_cnt)
+            positions = pipe.execute()
+        return [user_id for user_id, position in zip(user_ids, positions) if position is None]
+    
+    def _publish_post_event(self, pipe, post_event_key, post_id):
+        # Append the tweet to a post event stream if post_events is set.
+        if self._post_events:
+            pipe.xadd(post_event_key, {self.POST_EVENT_POST_ID_KEY: post_id}, 
+                      maxlen=self.POST_EVENT_STREAM_MAX_LEN, approximate=True)
+    
+    @instrumented
     def post_tweet(self, auth_secret, tweet):
         result = {'error': None}
         
+        if self._post_tweet_script is not None:
+            threshold = self._celebrity_follower_threshold
+            max_post_cnt = self._user_timeline_max_post_cnt
+            post_id = self._post_tweet_script(
+                keys=[self.AUTHS_HASH_KEY, self.NEXT_POST_ID_KEY, self.CELEBRITIES_SET_KEY,
+                      self.FANOUT_STREAM_KEY, self.GENERAL_TIMELINE_KEY, self.GENERAL_TIMELINE_VERSION_KEY],
+                args=[auth_secret, tweet, int(time.time()), 
+                      -1 if threshold is None else threshold, 
+                      1 if self._async_fanout else 0,
+                      -1 if max_post_cnt is None else max_post_cnt,
+                      self._post_storage,
+                      1 if self._post_events else 0] + extract_terms(tweet))
+            if post_id == 0:
+                result[PytwisConst.ERROR] = 'Not logged in'
+                return (False, result)
+            
+            return (True, result)
+        
         # Check if the user is logged in.
         loggedin, user_id = self._is_loggedin(auth_secret)
         if not loggedin:
@@ -254,39 +1535,113 @@ class Pytwis:
         # Get the next user-id. If the key "next_user_id" doesn't exist,
         # it will be created and initialized as 0, and then incremented by 1.
         post_id = self._rc.incr(self.NEXT_POST_ID_KEY)
-        post_id_key = self.POST_ID_KEY_FORMAT.format(post_id)
-        
-        post_id_user_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
         
+        # Get the followers unless the user has too many followers to write fanout the tweet.
         follower_zset_key = self.FOLLOWER_ZSET_KEY_FORMAT.format(user_id)
-        followers = self._rc.zrange(follower_zset_key, 0, -1)
+        is_celebrity = False
+        if self._celebrity_follower_threshold is not None:
+            is_celebrity = self._rc.zcard(follower_zset_key) >= self._celebrity_follower_threshold
+        if is_celebrity or self._async_fanout:
+            followers = []
+        else:
+            followers = self._rc.zrange(follower_zset_key, 0, -1)
         
-        unix_time = int(time.time())
-        with self._rc.pipeline() as pipe:
-            pipe.multi()
-            # Store the tweet with its user ID and UNIX timestamp.
-            pipe.hmset(post_id_key,
-                       {self.POST_ID_USERID_KEY: user_id,
-                        self.POST_ID_UNIXTIME_KEY: unix_time,
-                        self.POST_ID_BODY_KEY: tweet})
+        with self._pipeline() as pipe:
+            self._write_post(pipe, user_id, post_id, tweet, int(time.time()), is_celebrity, followers)
+            pipe.execute()
+        
+        return (True, result)
+    
+    def _write_post(self, pipe, user_id, post_id, tweet, unix_time, is_celebrity, followers):
+        authored_post_id_user_key = self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(user_id)
+        
+        # All the posts are authored since the first one.
+        if int(post_id) == 1:
+            pipe.set(self.AUTHORED_POSTS_COMPLETE_KEY, 1)
+        
+        # Store the tweet with its user ID and UNIX timestamp.
+        self._queue_post_write(pipe, post_id, user_id, unix_time, tweet, self._post_storage)
+        
+        # Add the tweet to the user timeline and the list of the tweets authored by the user.
+        self._push_user_timeline(pipe, user_id, post_id)
+        pipe.lpush(authored_post_id_user_key, post_id)
+        
+        # Index the tweet by its #hashtags and @mentions.
+        self._index_terms(pipe, post_id, tweet)
+        
+        if is_celebrity:
+            # The followers will pull the tweet from the authored list at read time. 
+            # Note that a user stays in the celebrity set even if the follower count 
+            # drops below the threshold later, since the tweets posted in the meantime 
+            # are only reachable via the authored list.
+            pipe.sadd(self.CELEBRITIES_SET_KEY, user_id)
+            self._publish_post_event(pipe, self.CELEBRITY_POST_EVENT_KEY_FORMAT.format(user_id), post_id)
+        elif self._async_fanout:
+            # Leave the write fanout to the fanout workers.
+            pipe.xadd(self.FANOUT_STREAM_KEY,
+                      {self.FANOUT_STREAM_POST_ID_KEY: post_id,
+                       self.FANOUT_STREAM_USERID_KEY: user_id})
+        
+        # Write fanout the tweet to all the followers' timelines.
+        self._fanout_post(pipe, post_id, followers)
+        
+        # Add the tweet to the general timeline and left trim the general timeline to only retain 
+        # the latest GENERAL_TIMELINE_MAX_POST_CNT tweets.
+        pipe.lpush(self.GENERAL_TIMELINE_KEY, post_id)
+        pipe.ltrim(self.GENERAL_TIMELINE_KEY, 0, self.GENERAL_TIMELINE_MAX_POST_CNT - 1)
+        # Outdate the cached general timelines.
+        pipe.incr(self.GENERAL_TIMELINE_VERSION_KEY)
+    
+    @instrumented
+    def post_tweets(self, tweets):
+        # Post a batch of tweets given as (auth_secret, tweet) pairs. Return a list of 
+        # (succeeded, result) in the same order, as returned by post_tweet.
+        results = []
+        for chunk in self._chunks(tweets):
+            user_ids = self._get_loggedin_user_ids([auth_secret for auth_secret, _ in chunk])
+            author_user_ids = list({user_id for user_id in user_ids if user_id is not None})
             
-            # Add the tweet to the user timeline.
-            pipe.lpush(post_id_user_key, post_id)
+            # Find the celebrities among the authors.
+            celebrity_user_ids = set()
+            if self._celebrity_follower_threshold is not None:
+                with self._pipeline() as pipe:
+                    for user_id in author_user_ids:
+                        pipe.zcard(self.FOLLOWER_ZSET_KEY_FORMAT.format(user_id))
+                    follower_cnts = pipe.execute()
+                celebrity_user_ids = {user_id for user_id, follower_cnt in zip(author_user_ids, follower_cnts)
+                                      if follower_cnt >= self._celebrity_follower_threshold}
             
-            # Write fanout the tweet to all the followers' timelines.
-            for follower in followers:
-                post_id_follower_key = self.POST_ID_USER_KEY_FORMAT.format(follower)
-                pipe.lpush(post_id_follower_key, post_id)
+            # Get the followers of the other authors unless the fanout is asynchronous.
+            author_followers = {}
+            if not self._async_fanout:
+                fanout_user_ids = [user_id for user_id in author_user_ids if user_id not in celebrity_user_ids]
+                with self._pipeline() as pipe:
+                    for user_id in fanout_user_ids:
+                        pipe.zrange(self.FOLLOWER_ZSET_KEY_FORMAT.format(user_id), 0, -1)
+                    author_followers = dict(zip(fanout_user_ids, pipe.execute()))
             
-            # Add the tweet to the general timeline and left trim the general timeline to only retain 
-            # the latest GENERAL_TIMELINE_MAX_POST_CNT tweets.
-            pipe.lpush(self.GENERAL_TIMELINE_KEY, post_id)
-            pipe.ltrim(self.GENERAL_TIMELINE_KEY, 0, self.GENERAL_TIMELINE_MAX_POST_CNT - 1)
+            # Allocate the post IDs of the chunk at once, in the order of the tweets.
+            loggedin_cnt = len(user_ids) - user_ids.count(None)
+            last_post_id = self._rc.incrby(self.NEXT_POST_ID_KEY, loggedin_cnt)
+            post_ids = iter(range(last_post_id - loggedin_cnt + 1, last_post_id + 1))
             
-            pipe.execute()
+            unix_time = int(time.time())
+            with self._pipeline() as pipe:
+                for (_, tweet), user_id in zip(chunk, user_ids):
+                    result = {'error': None}
+                    if user_id is None:
+                        result[PytwisConst.ERROR] = 'Not logged in'
+                        results.append((False, result))
+                        continue
+                    
+                    self._write_post(pipe, user_id, next(post_ids), tweet, unix_time, 
+                                     user_id in celebrity_user_ids, author_followers.get(user_id, []))
+                    results.append((True, result))
+                pipe.execute()
         
-        return (True, result)
+        return results
     
+    @instrumented
     def follow(self, auth_secret, followee_username):
         result = {'error': None}
         
@@ -296,33 +1651,148 @@ class Pytwis:
             result[PytwisConst.ERROR] = 'Not logged in'
             return (False, result)
         
-        with self._rc.pipeline() as pipe:
-            # Check if the followee exists.
-            while True:
-                try:
-                    # Put a watch on the Hash 'users': username -> user-id, in case that 
-                    # other clients are modifying the Hash 'users'.
-                    pipe.watch(self.USERS_HASH_KEY)
-                    followee_user_id = pipe.hget(self.USERS_HASH_KEY, followee_username)
-                    if followee_user_id is None:
-                        result[PytwisConst.ERROR] = "Followee {} doesn't exist".format(followee_username)
-                        return (False, result);
-                    
-                    break
-                except WatchError:
-                    continue
-            
+        # Check if the followee exists. Note that there is no need to WATCH the Hash 'users' 
+        # since a username is never removed from it.
+        followee_user_id = self._rc.hget(self._users_hash_key(followee_username), followee_username)
+        if followee_user_id is None:
+            result[PytwisConst.ERROR] = "Followee {} doesn't exist".format(followee_username)
+            return (False, result);
+        
+        with self._pipeline() as pipe:
             # Update the two zset 'followers:[followee_username]' and 'following:[username]'.
             follower_zset_key = self.FOLLOWER_ZSET_KEY_FORMAT.format(followee_user_id)
             following_zset_key = self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id)
             unix_time = int(time.time())
-            pipe.multi()
-            pipe.zadd(follower_zset_key, unix_time, user_id)
-            pipe.zadd(following_zset_key, unix_time, followee_user_id)
+            pipe.zadd(follower_zset_key, {user_id: unix_time})
+            pipe.zadd(following_zset_key, {followee_user_id: unix_time})
             pipe.execute()
+        
+        if followee_user_id != user_id:
+            self._backfill_home_timelines({user_id: [followee_user_id]})
             
         return (True, result)
     
+    def _backfill_home_timelines(self, followee_user_ids_by_user_id):
+        # Merge the latest posts of the new followees into the timelines of their followers.
+        if self._follow_backfill_post_cnt == 0 or len(followee_user_ids_by_user_id) == 0:
+            return
+        
+        user_ids = list(followee_user_ids_by_user_id.keys())
+        followee_user_ids = list({followee_user_id 
+                                  for user_followee_user_ids in followee_user_ids_by_user_id.values() 
+                                  for followee_user_id in user_followee_user_ids})
+        with self._pipeline() as pipe:
+            for followee_user_id in followee_user_ids:
+                pipe.sismember(self.CELEBRITIES_SET_KEY, followee_user_id)
+                pipe.lrange(self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(followee_user_id), 
+                            0, self._follow_backfill_post_cnt - 1)
+            for user_id in user_ids:
+                pipe.lrange(self.POST_ID_USER_KEY_FORMAT.format(user_id), 
+                            0, self._get_follow_backfill_merge_window() - 1)
+            replies = pipe.execute()
+        
+        # The posts of a celebrity are merged into the user timeline at read time instead.
+        authored_post_ids = {followee_user_id: post_ids 
+                             for followee_user_id, is_celebrity, post_ids 
+                             in zip(followee_user_ids, replies[0:2 * len(followee_user_ids):2], 
+                                     replies[1:2 * len(followee_user_ids):2]) 
+                             if not is_celebrity}
+        
+        with self._pipeline(transaction=False) as pipe:
+            for user_id, home_post_ids in zip(user_ids, replies[2 * len(followee_user_ids):]):
+                backfill_post_ids = merge_post_ids([authored_post_ids.get(followee_user_id, []) 
+                                                    for followee_user_id in followee_user_ids_by_user_id[user_id]])
+                post_id_user_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
+                inserts = self._plan_follow_backfill(home_post_ids, backfill_post_ids)
+                for post_id, pivot_post_id in inserts:
+                    if pivot_post_id is None:
+                        pipe.rpush(post_id_user_key, post_id)
+                    else:
+                        pipe.linsert(post_id_user_key, 'BEFORE', pivot_post_id, post_id)
+                if self._user_timeline_max_post_cnt is not None:
+                    pipe.ltrim(post_id_user_key, 0, self._user_timeline_max_post_cnt - 1)
+                    if len(home_post_ids) + len(inserts) > self._user_timeline_max_post_cnt:
+                        pipe.set(self.TRIMMED_USER_KEY_FORMAT.format(user_id), 1)
+            pipe.execute()
+    
+    def _purge_home_timeline(self, user_id, followee_user_id):
+        # Remove the posts of the followee from the latest UNFOLLOW_PURGE_WINDOW posts of the user 
+        # timeline. Each LREM stops at its last match in the window, so an unfollow costs at most 
+        # about the window squared however long the timeline is, and the older posts of the 
+        # followee are left in place. Each chunk of LREMs is sent in a pipeline without MULTI, 
+        # so that Redis serves the other clients between the LREMs.
+        post_id_user_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
+        with self._pipeline() as pipe:
+            pipe.llen(post_id_user_key)
+            pipe.lrange(post_id_user_key, 0, self.UNFOLLOW_PURGE_WINDOW - 1)
+            post_id_cnt, window_post_ids = pipe.execute()
+        if len(window_post_ids) == 0:
+            return
+        
+        # A full user timeline may have been trimmed, which has to be remembered once it isn't full.
+        if self._is_user_timeline_trimmed(post_id_cnt, False):
+            self._rc.set(self.TRIMMED_USER_KEY_FORMAT.format(user_id), 1)
+        
+        # Only the posts no older than the oldest post of the window can be in the window.
+        oldest_post_id = min(int(post_id) for post_id in window_post_ids)
+        window_post_id_cnts = Counter(window_post_ids)
+        authored_post_id_user_key = self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(followee_user_id)
+        chunk_start_index = 0
+        while True:
+            post_ids = self._rc.lrange(authored_post_id_user_key, chunk_start_index, 
+                                       chunk_start_index + self.UNFOLLOW_PURGE_CHUNK_SIZE - 1)
+            purged_post_ids = [post_id for post_id in post_ids if int(post_id) >= oldest_post_id]
+            if any(post_id in window_post_id_cnts for post_id in purged_post_ids):
+                with self._pipeline(transaction=False) as pipe:
+                    for post_id in purged_post_ids:
+                        if post_id in window_post_id_cnts:
+                            pipe.lrem(post_id_user_key, window_post_id_cnts[post_id], post_id)
+                    pipe.execute()
+            
+            if len(purged_post_ids) < self.UNFOLLOW_PURGE_CHUNK_SIZE:
+                break
+            chunk_start_index += self.UNFOLLOW_PURGE_CHUNK_SIZE
+    
+    @instrumented
+    def follow_many(self, follows):
+        # Create a batch of follow edges given as (auth_secret, followee_username) pairs. 
+        # Return a list of (succeeded, result) in the same order, as returned by follow.
+        results = []
+        for chunk in self._chunks(follows):
+            user_ids = self._get_loggedin_user_ids([auth_secret for auth_secret, _ in chunk])
+            
+            # Get the user-ids of the followees.
+            followee_usernames = list({followee_username for _, followee_username in chunk})
+            with self._pipeline() as pipe:
+                for followee_username in followee_usernames:
+                    pipe.hget(self._users_hash_key(followee_username), followee_username)
+                followee_user_ids = dict(zip(followee_usernames, pipe.execute()))
+            
+            unix_time = int(time.time())
+            followee_user_ids_by_user_id = {}
+            with self._pipeline() as pipe:
+                for (_, followee_username), user_id in zip(chunk, user_ids):
+                    result = {'error': None}
+                    followee_user_id = followee_user_ids[followee_username]
+                    if user_id is None:
+                        result[PytwisConst.ERROR] = 'Not logged in'
+                        results.append((False, result))
+                    elif followee_user_id is None:
+                        result[PytwisConst.ERROR] = "Followee {} doesn't exist".format(followee_username)
+                        results.append((False, result))
+                    else:
+                        pipe.zadd(self.FOLLOWER_ZSET_KEY_FORMAT.format(followee_user_id), {user_id: unix_time})
+                        pipe.zadd(self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id), {followee_user_id: unix_time})
+                        if followee_user_id != user_id:
+                            followee_user_ids_by_user_id.setdefault(user_id, []).append(followee_user_id)
+                        results.append((True, result))
+                pipe.execute()
+            
+            self._backfill_home_timelines(followee_user_ids_by_user_id)
+        
+        return results
+    
+    @instrumented
     def unfollow(self, auth_secret, followee_username):
         result = {'error': None}
         
@@ -332,106 +1802,313 @@ class Pytwis:
             result[PytwisConst.ERROR] = 'Not logged in'
             return (False, result)
         
-        with self._rc.pipeline() as pipe:
-            # Check if the followee exists.
-            while True:
-                try:
-                    # Put a watch on the Hash 'users': username -> user-id, in case that 
-                    # other clients are modifying the Hash 'users'.
-                    pipe.watch(self.USERS_HASH_KEY)
-                    followee_user_id = pipe.hget(self.USERS_HASH_KEY, followee_username)
-                    if followee_user_id is None:
-                        result[PytwisConst.ERROR] = "Followee {} doesn't exist".format(followee_username)
-                        return (False, result);
-                    
-                    break
-                except WatchError:
-                    continue
-            
+        # Check if the followee exists. Note that there is no need to WATCH the Hash 'users' 
+        # since a username is never removed from it.
+        followee_user_id = self._rc.hget(self._users_hash_key(followee_username), followee_username)
+        if followee_user_id is None:
+            result[PytwisConst.ERROR] = "Followee {} doesn't exist".format(followee_username)
+            return (False, result);
+        
+        with self._pipeline() as pipe:
             # Remove followee_user_id from the zset 'following:[username]' and remove user_id 
             # from the zset 'followers:[followee_username]'.
             follower_zset_key = self.FOLLOWER_ZSET_KEY_FORMAT.format(followee_user_id)
             following_zset_key = self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id)
-            pipe.multi()
             pipe.zrem(follower_zset_key, user_id)
             pipe.zrem(following_zset_key, followee_user_id)
             pipe.execute()
+        
+        # The user timeline always has the posts of the user, even after unfollowing oneself.
+        if followee_user_id != user_id:
+            self._purge_home_timeline(user_id, followee_user_id)
             
         return (True, result)
     
+    @instrumented
     def get_followers(self, auth_secret):
         result = {'error': None}
         
         # Check if the user is logged in.
-        loggedin, user_id = self._is_loggedin(auth_secret)
+        rc = self._read_rc()
+        loggedin, user_id = self._is_loggedin(auth_secret, rc)
         if not loggedin:
             result[PytwisConst.ERROR] = 'Not logged in'
             return (False, result)
         
         # Get the list of followers' user_ids.
         follower_zset_key = self.FOLLOWER_ZSET_KEY_FORMAT.format(user_id)
-        follower_user_ids = self._rc.zrange(follower_zset_key, 0, -1)
+        follower_user_ids = rc.zrange(follower_zset_key, 0, -1)
         
         if follower_user_ids is None or len(follower_user_ids) == 0:
             result[PytwisConst.FOLLOWER_LIST] = []
             return (True, result)
         
         # Get the list of followers' usernames from their user_ids.
-        with self._rc.pipeline() as pipe:
-            pipe.multi()
-            
-            for follower_user_id in follower_user_ids:
-                follower_user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(follower_user_id)
-                pipe.hget(follower_user_id_profile_key, self.USER_ID_PROFILE_USERNAME_KEY)
-            
-            result[PytwisConst.FOLLOWER_LIST] = pipe.execute()
+        result[PytwisConst.FOLLOWER_LIST] = self._get_usernames(follower_user_ids, rc)
             
         return (True, result)
         
+    @instrumented
     def get_following(self, auth_secret):
         result = {'error': None}
         
         # Check if the user is logged in.
-        loggedin, user_id = self._is_loggedin(auth_secret)
+        rc = self._read_rc()
+        loggedin, user_id = self._is_loggedin(auth_secret, rc)
         if not loggedin:
             result[PytwisConst.ERROR] = 'Not logged in'
             return (False, result)
         
         # Get the list of followers' user_ids.
         following_zset_key = self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id)
-        following_user_ids = self._rc.zrange(following_zset_key, 0, -1)
+        following_user_ids = rc.zrange(following_zset_key, 0, -1)
         
         if following_user_ids is None or len(following_user_ids) == 0:
             result[PytwisConst.FOLLOWING_LIST] = []
             return (True, result)
         
         # Get the list of followings' usernames from their user_ids.
-        with self._rc.pipeline() as pipe:
-            pipe.multi()
-            
-            for following_user_id in following_user_ids:
-                following_user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(following_user_id)
-                pipe.hget(following_user_id_profile_key, self.USER_ID_PROFILE_USERNAME_KEY)
-            
-            result[PytwisConst.FOLLOWING_LIST] = pipe.execute()
+        result[PytwisConst.FOLLOWING_LIST] = self._get_usernames(following_user_ids, rc)
             
         return (True, result)
     
-    def get_timeline(self, auth_secret, max_cnt_tweets):
+    def _get_follow_list_page(self, auth_secret, zset_key_format, list_name, page_size, offset):
+        result = {'error': None}
+        
+        # A negative offset would count from the end of the list.
+        if page_size < 1 or offset < 0:
+            result[PytwisConst.ERROR] = 'Invalid page size {} or offset {}'.format(page_size, offset)
+            return (False, result)
+        
+        # Check if the user is logged in.
+        rc = self._read_rc()
+        loggedin, user_id = self._is_loggedin(auth_secret, rc)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+        
+        # Get the user_ids of the page in the order of the follow time, plus the next one 
+        # to tell if there is a next page.
+        user_ids = rc.zrange(zset_key_format.format(user_id), offset, offset + page_size)
+        if len(user_ids) > page_size:
+            result[PytwisConst.NEXT_OFFSET] = offset + page_size
+            user_ids = user_ids[:page_size]
+        else:
+            result[PytwisConst.NEXT_OFFSET] = None
+        
+        result[list_name] = self._get_usernames(user_ids, rc)
+        
+        return (True, result)
+    
+    @instrumented
+    def get_followers_page(self, auth_secret, page_size, offset=0):
+        # Pass NEXT_OFFSET as offset to get the next page.
+        return self._get_follow_list_page(auth_secret, self.FOLLOWER_ZSET_KEY_FORMAT, 
+                                          PytwisConst.FOLLOWER_LIST, page_size, offset)
+    
+    @instrumented
+    def get_following_page(self, auth_secret, page_size, offset=0):
+        return self._get_follow_list_page(auth_secret, self.FOLLOWING_ZSET_KEY_FORMAT, 
+                                          PytwisConst.FOLLOWING_LIST, page_size, offset)
+    
+    def _count_follow_list(self, auth_secret, zset_key_format, cnt_name):
         result = {'error': None}
         
+        # Check if the user is logged in.
+        rc = self._read_rc()
+        loggedin, user_id = self._is_loggedin(auth_secret, rc)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+        
+        result[cnt_name] = rc.zcard(zset_key_format.format(user_id))
+        
+        return (True, result)
+    
+    @instrumented
+    def count_followers(self, auth_secret):
+        return self._count_follow_list(auth_secret, self.FOLLOWER_ZSET_KEY_FORMAT, PytwisConst.FOLLOWER_CNT)
+    
+    @instrumented
+    def count_following(self, auth_secret):
+        return self._count_follow_list(auth_secret, self.FOLLOWING_ZSET_KEY_FORMAT, PytwisConst.FOLLOWING_CNT)
+    
+    def _instrumented_iter(self, method_name, iterator):
+        # Count the lazy Redis round trips of a generator returned by a method to the method.
+        if self._metrics is None:
+            return iterator
+        return self._metrics.iterate(method_name, iterator)
+    
+    def _iter_follow_list(self, auth_secret, zset_key_format, list_name, chunk_size, method_name):
+        result = {'error': None}
+        
+        # Check if the user is logged in.
+        rc = self._read_rc()
+        loggedin, user_id = self._is_loggedin(auth_secret, rc)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+        
+        result[list_name] = self._instrumented_iter(
+            method_name, self._iter_usernames(zset_key_format.format(user_id), chunk_size, rc))
+        
+        return (True, result)
+    
+    def _iter_usernames(self, zset_key, chunk_size, rc):
+        # ZSCAN the user_ids about chunk_size at a time and hydrate their usernames. As with 
+        # any SCAN, a user may be yielded twice if the zset is resized during the iteration.
+        cursor = None
+        while cursor != 0:
+            cursor, user_ids_and_scores = rc.zscan(zset_key, cursor or 0, count=chunk_size)
+            if len(user_ids_and_scores) > 0:
+                yield from self._get_usernames([user_id for user_id, _ in user_ids_and_scores], rc)
+    
+    @instrumented
+    def iter_followers(self, auth_secret, chunk_size=100):
+        # Like get_followers, except that result[FOLLOWER_LIST] is a generator.
+        return self._iter_follow_list(auth_secret, self.FOLLOWER_ZSET_KEY_FORMAT, 
+                                      PytwisConst.FOLLOWER_LIST, chunk_size, 'iter_followers')
+    
+    @instrumented
+    def iter_following(self, auth_secret, chunk_size=100):
+        # Like get_following, except that result[FOLLOWING_LIST] is a generator.
+        return self._iter_follow_list(auth_secret, self.FOLLOWING_ZSET_KEY_FORMAT, 
+                                      PytwisConst.FOLLOWING_LIST, chunk_size, 'iter_following')
+    
+    def _get_celebrity_followee_ids(self, user_id, rc=None):
+        # Get the user_ids of the celebrities followed by the user. Only the followings are 
+        # looked up in the celebrity set (SMISMEMBER), which may be much larger.
+        if rc is None:
+            rc = self._rc
+        following_zset_key = self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id)
+        with self._pipeline(rc) as pipe:
+            pipe.zrange(following_zset_key, 0, -1)
+            pipe.exists(self.CELEBRITIES_SET_KEY)
+            following_user_ids, has_celebrities = pipe.execute()
+        if len(following_user_ids) == 0 or not has_celebrities:
+            return []
+        
+        are_celebrities = rc.smismember(self.CELEBRITIES_SET_KEY, following_user_ids)
+        return [following_user_id for following_user_id, is_celebrity in zip(following_user_ids, are_celebrities) 
+                if is_celebrity]
+    
+    @instrumented_phase('tweet_hydration')
+    def _get_tweets(self, post_ids, rc=None):
+        if len(post_ids) == 0:
+            return []
+        
+        tweets = [tweet for tweet in self._read_posts(post_ids, rc) if tweet is not None]
+        self._add_usernames(tweets, rc)
+        
+        return tweets
+    
+    def _add_usernames(self, tweets, rc=None):
+        # Get the user_id-to-username mappings for all the user IDs associated with the tweets.
+        user_id_list = list({ tweet[self.POST_ID_USERID_KEY] for tweet in tweets })
+        username_list = self._get_usernames(user_id_list, rc)
+        
+        user_id_to_username = { user_id: username for user_id, username in zip(user_id_list, username_list) }
+        
+        # Add the username for the user ID of each tweet.
+        for tweet in tweets:
+            tweet[self.USER_ID_PROFILE_USERNAME_KEY] = user_id_to_username[tweet[self.POST_ID_USERID_KEY]]
+    
+    def _read_posts(self, post_ids, rc=None):
+        # Get the tweets with their user IDs and UNIX timestamps, or None for the missing ones.
+        with self._pipeline(rc) as pipe:
+            for post_id in post_ids:
+                self._queue_post_read(pipe, post_id, self._post_storage)
+            tweets = [self._decode_post(raw_post) for raw_post in pipe.execute()]
+        
+        # Look the missing tweets up in the other storages.
+        missing_indexes = [index for index, tweet in enumerate(tweets) if tweet is None]
+        if len(missing_indexes) > 0:
+            missing_post_storages = self._get_missing_post_storages(self._post_storage)
+            with self._pipeline(rc) as pipe:
+                for index in missing_indexes:
+                    for post_storage in missing_post_storages:
+                        self._queue_post_read(pipe, post_ids[index], post_storage)
+                raw_posts = iter(pipe.execute())
+            for index in missing_indexes:
+                for raw_post in [next(raw_posts) for _ in missing_post_storages]:
+                    tweets[index] = tweets[index] or self._decode_post(raw_post)
+        
+        return tweets
+    
+    def _get_timeline_keys(self, auth_secret, rc=None):
+        # Get the user_id (None for the general timeline) and the keys of the lists whose 
+        # post IDs make up the timeline, or None if the user isn't logged in.
         if auth_secret == '':
             # An empty authentication secret implies getting the general timeline.
-            timeline_key = self.GENERAL_TIMELINE_KEY
-        else:
-            # Check if the user is logged in.
-            loggedin, user_id = self._is_loggedin(auth_secret)
-            if not loggedin:
-                result[PytwisConst.ERROR] = 'Not logged in'
-                return (False, result)
-            
-            # Get the user timeline.
-            timeline_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
+            return (None, [self.GENERAL_TIMELINE_KEY])
+        
+        # Check if the user is logged in.
+        loggedin, user_id = self._is_loggedin(auth_secret, rc)
+        if not loggedin:
+            return None
+        
+        # Get the user timeline.
+        timeline_keys = [self.POST_ID_USER_KEY_FORMAT.format(user_id)]
+        
+        # Get the celebrities whose tweets need to be merged into the user timeline.
+        if self._celebrity_follower_threshold is not None:
+            for celebrity_user_id in self._get_celebrity_followee_ids(user_id, rc):
+                timeline_keys.append(self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(celebrity_user_id))
+        
+        return (user_id, timeline_keys)
+    
+    @instrumented_phase('backfill')
+    def _get_backfill_post_id_lists(self, user_id, max_cnt_post_ids, max_id=None, since_id=None, rc=None):
+        # Rebuild the part of the user timeline which has been trimmed by user_timeline_max_post_cnt 
+        # from the tweets authored by the user and the followings. Return a list of post ID 
+        # lists to be merged into the user timeline.
+        if self._user_timeline_max_post_cnt is None:
+            return []
+        
+        post_id_user_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
+        following_zset_key = self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id)
+        with self._pipeline(rc) as pipe:
+            pipe.llen(post_id_user_key)
+            pipe.lindex(post_id_user_key, -1)
+            pipe.exists(self.TRIMMED_USER_KEY_FORMAT.format(user_id))
+            pipe.zrange(following_zset_key, 0, -1)
+            post_id_cnt, oldest_post_id, is_trimmed, following_user_ids = pipe.execute()
+        
+        if not self._is_user_timeline_trimmed(post_id_cnt, is_trimmed):
+            return []
+        
+        # Only the posts older than the user timeline have been trimmed.
+        backfill_max_id = max_id
+        if oldest_post_id is not None and (max_id is None or int(oldest_post_id) - 1 < max_id):
+            backfill_max_id = int(oldest_post_id) - 1
+        
+        return self._run_read_plan(self._plan_backfill_reads(
+            [self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(authored_user_id) 
+             for authored_user_id in [user_id] + following_user_ids], 
+            max_cnt_post_ids, backfill_max_id, since_id), rc)
+    
+    def _run_read_plan(self, plan, rc=None):
+        # Run the batches of read commands yielded by a generator like _plan_backfill_reads.
+        try:
+            commands = next(plan)
+            while True:
+                with self._pipeline(rc, transaction=False) as pipe:
+                    for command_name, *command_args in commands:
+                        getattr(pipe, command_name)(*command_args)
+                    commands = plan.send(pipe.execute())
+        except StopIteration as e:
+            return e.value
+    
+    @instrumented
+    def get_timeline(self, auth_secret, max_cnt_tweets):
+        result = {'error': None}
+        
+        rc = self._read_rc()
+        user_id_and_timeline_keys = self._get_timeline_keys(auth_secret, rc)
+        if user_id_and_timeline_keys is None:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+        user_id, timeline_keys = user_id_and_timeline_keys
         
         result[PytwisConst.TWEETS] = []
         if max_cnt_tweets == 0:
@@ -444,33 +2121,367 @@ class Pytwis:
             last_tweet_index = max_cnt_tweets - 1
             
         # Get the post IDs of the tweets.
-        post_ids = self._rc.lrange(timeline_key, 0, last_tweet_index)
+        with self._pipeline(rc) as pipe:
+            for timeline_key in timeline_keys:
+                pipe.lrange(timeline_key, 0, last_tweet_index)
+            post_id_lists = pipe.execute()
         
-        if len(post_ids) == 0:
-            return (True, result)
+        # Rebuild the trimmed tweets if the user timeline can't provide max_cnt_tweets tweets.
+        if user_id is not None and self._user_timeline_max_post_cnt is not None and \
+           (max_cnt_tweets == -1 or len(post_id_lists[0]) < max_cnt_tweets):
+            post_id_lists += self._get_backfill_post_id_lists(user_id, max_cnt_tweets, rc=rc)
+        
+        post_ids = merge_post_ids(post_id_lists, max_cnt_tweets)
+        
+        result[PytwisConst.TWEETS] = self._get_tweets(post_ids, rc)
         
-        with self._rc.pipeline() as pipe:
-            # Get the tweets with their user IDs and UNIX timestamps.
-            pipe.multi()
+        return (True, result)
+    
+    @instrumented
+    def iter_timeline(self, auth_secret, chunk_size=100):
+        # Like get_timeline(auth_secret, -1), except that result[TWEETS] is a generator which 
+        # reads and hydrates chunk_size tweets at a time, so neither the memory nor the time 
+        # to the first tweet grows with the timeline.
+        result = {'error': None}
+        
+        rc = self._read_rc()
+        user_id_and_timeline_keys = self._get_timeline_keys(auth_secret, rc)
+        if user_id_and_timeline_keys is None:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+        user_id, timeline_keys = user_id_and_timeline_keys
+        
+        post_ids = iter_merged_post_ids([self._iter_post_ids(timeline_key, chunk_size, rc) 
+                                         for timeline_key in timeline_keys])
+        if user_id is not None and self._user_timeline_max_post_cnt is not None:
+            post_ids = self._iter_backfilled_post_ids(user_id, post_ids, chunk_size, rc)
+        
+        result[PytwisConst.TWEETS] = self._instrumented_iter('iter_timeline', 
+                                                             self._iter_tweets(post_ids, chunk_size, rc))
+        
+        return (True, result)
+    
+    def _iter_post_ids(self, timeline_key, chunk_size, rc):
+        # Yield the post IDs of a timeline from its head to its tail, LRANGE by chunk_size. 
+        # A timeline isn't strictly sorted, so it's paged by position rather than by post ID. 
+        # The posts pushed or removed in the meantime shift the rest of the timeline, so each 
+        # window is moved by the change of LLEN since the last one. In case the change wasn't 
+        # ahead of the window, the window also reaches back as far, and the post IDs among 
+        # the last ones read are skipped.
+        post_id_cnt = None
+        next_window_start_index = 0
+        read_post_ids = []
+        while True:
+            last_post_id_cnt, post_id_cnt = post_id_cnt, rc.llen(timeline_key)
+            shift = post_id_cnt - last_post_id_cnt if last_post_id_cnt is not None else 0
+            window_start_index = max(next_window_start_index + shift - min(abs(shift), next_window_start_index), 0)
+            next_window_start_index = max(next_window_start_index + shift, 0) + chunk_size
+            post_ids = rc.lrange(timeline_key, window_start_index, next_window_start_index - 1)
+            
+            recent_post_ids = set(read_post_ids)
             for post_id in post_ids:
-                post_id_key = self.POST_ID_KEY_FORMAT.format(post_id)
-                pipe.hgetall(post_id_key)
-            result[PytwisConst.TWEETS] = pipe.execute()
-        
-            # Get the user_id-to-username mappings for all the user IDs associated with the tweets.
-            user_id_set = { tweet[self.POST_ID_USERID_KEY] for tweet in result[PytwisConst.TWEETS] }
-            user_id_list = []
-            pipe.multi()
-            for user_id in user_id_set:
-                user_id_list.append(user_id)
-                user_id_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
-                pipe.hget(user_id_key, self.USER_ID_PROFILE_USERNAME_KEY)
-            username_list = pipe.execute()
+                if post_id not in recent_post_ids:
+                    yield post_id
+            if len(post_ids) < next_window_start_index - window_start_index:
+                return
+            read_post_ids = (read_post_ids + post_ids)[-(len(post_ids) + chunk_size):]
+    
+    def _iter_backfilled_post_ids(self, user_id, post_ids, chunk_size, rc):
+        # Yield the post IDs of a user timeline and then the ones trimmed by user_timeline_max_post_cnt, 
+        # rebuilt from the tweets authored by the user and the followings as in _get_backfill_post_id_lists.
+        post_id_user_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
+        following_zset_key = self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id)
+        with self._pipeline(rc) as pipe:
+            pipe.llen(post_id_user_key)
+            pipe.lindex(post_id_user_key, -1)
+            pipe.exists(self.TRIMMED_USER_KEY_FORMAT.format(user_id))
+            pipe.zrange(following_zset_key, 0, -1)
+            post_id_cnt, oldest_post_id, is_trimmed, following_user_ids = pipe.execute()
         
-        user_id_to_username = { user_id: username for user_id, username in zip(user_id_list, username_list) }
+        if not self._is_user_timeline_trimmed(post_id_cnt, is_trimmed):
+            yield from post_ids
+            return
         
-        # Add the username for the user ID of each tweet.
-        for tweet in result[PytwisConst.TWEETS]:
-            tweet[self.USER_ID_PROFILE_USERNAME_KEY] = user_id_to_username[tweet[self.POST_ID_USERID_KEY]]
+        # Since a timeline isn't strictly sorted, it may also have some of the older posts, 
+        # which aren't rebuilt again.
+        backfill_max_id = int(oldest_post_id) - 1 if oldest_post_id is not None else float('inf')
+        old_post_ids = set()
+        for post_id in post_ids:
+            if int(post_id) <= backfill_max_id:
+                old_post_ids.add(post_id)
+            yield post_id
+        for post_id in iter_merged_post_ids(
+            [(post_id for post_id in self._iter_post_ids(self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(authored_user_id), 
+                                                         chunk_size, rc) 
+              if int(post_id) <= backfill_max_id) 
+             for authored_user_id in [user_id] + following_user_ids]):
+            if post_id not in old_post_ids:
+                yield post_id
+    
+    def _iter_tweets(self, post_ids, chunk_size, rc):
+        # Hydrate the post IDs chunk_size at a time.
+        while True:
+            chunk_post_ids = list(itertools.islice(post_ids, chunk_size))
+            if len(chunk_post_ids) == 0:
+                return
+            yield from self._get_tweets(chunk_post_ids, rc)
+    
+    @instrumented
+    def read_post_events(self, auth_secret, last_event_id=None, block_ms=None, max_cnt_events=100):
+        # Read the tweets pushed into the user timeline and posted by the celebrity followings 
+        # after last_event_id, or after now if it's None, waiting up to block_ms milliseconds 
+        # (not at all if None) for one. Each event in result[EVENTS] has the hydrated tweet and 
+        # its LAST_EVENT_ID to resume after it, e.g., by a reconnecting Server-Sent Events client. 
+        # result[LAST_EVENT_ID] resumes after all the events read.
+        result = {'error': None}
+        
+        if not self._post_events:
+            result[PytwisConst.ERROR] = 'Post events are disabled'
+            return (False, result)
+        if last_event_id is not None and not STREAM_ENTRY_ID_REGEX.fullmatch(last_event_id):
+            result[PytwisConst.ERROR] = 'Invalid event ID {}'.format(last_event_id)
+            return (False, result)
+        
+        # Check if the user is logged in.
+        loggedin, user_id = self._is_loggedin(auth_secret)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+        
+        post_event_keys = [self.POST_EVENT_USER_KEY_FORMAT.format(user_id)]
+        if self._celebrity_follower_threshold is not None:
+            post_event_keys.extend(self.CELEBRITY_POST_EVENT_KEY_FORMAT.format(celebrity_user_id) 
+                                   for celebrity_user_id in self._get_celebrity_followee_ids(user_id))
+        
+        # All the streams are resumed after the same entry ID. The IDs of the different streams 
+        # are only ordered by their milliseconds, so the entries of the current millisecond are 
+        # left to the next read, after which no stream can add an entry with a smaller ID.
+        while True:
+            seconds, microseconds = self._rc.time()
+            now_ms = seconds * 1000 + microseconds // 1000
+            if last_event_id is None:
+                last_event_id = '{}-{}'.format(now_ms - 1, 2 ** 64 - 1)
+            
+            post_events = []
+            for _, entries in self._rc.xread({post_event_key: last_event_id for post_event_key in post_event_keys}, 
+                                             count=max_cnt_events, block=block_ms) or []:
+                post_events.extend(entries)
+            post_events.sort(key=lambda post_event: parse_stream_entry_id(post_event[0]))
+            past_post_events = [post_event for post_event in post_events 
+                                if parse_stream_entry_id(post_event[0])[0] < now_ms]
+            if len(past_post_events) > 0 or len(post_events) == 0:
+                break
+        
+        # Each stream returns its first max_cnt_events entries, so none of them is skipped 
+        # up to the max_cnt_events-th entry of all the streams.
+        past_post_events = past_post_events[:max_cnt_events]
+        if len(past_post_events) > 0:
+            last_event_id = past_post_events[-1][0]
+        event_ids = [entry_id for entry_id, _ in past_post_events]
+        post_ids = [post_event[self.POST_EVENT_POST_ID_KEY] for _, post_event in past_post_events]
+        
+        tweets = self._read_posts(post_ids) if len(post_ids) > 0 else []
+        self._add_usernames([tweet for tweet in tweets if tweet is not None])
+        result[PytwisConst.EVENTS] = [{PytwisConst.LAST_EVENT_ID: event_id, 
+                                       PytwisConst.POST_ID: post_id, 
+                                       PytwisConst.TWEET: tweet}
+                                      for event_id, post_id, tweet in zip(event_ids, post_ids, tweets) 
+                                      if tweet is not None]
+        result[PytwisConst.LAST_EVENT_ID] = last_event_id
+        
+        return (True, result)
+    
+    @instrumented
+    def search(self, terms, cursor=None, limit=20, mode='and'):
+        # Get the latest limit tweets which have all (mode 'and') or any (mode 'or') of the 
+        # #hashtags and @mentions in terms, a list or a space-separated string, posted before 
+        # cursor, the NEXT_CURSOR of the previous page. NEXT_CURSOR is None on the last page. 
+        # limit ranges from 1 to SEARCH_MAX_LIMIT. Only the sorted sets of the terms are read, so the cost doesn't grow with the posts 
+        # without the terms.
+        result = {'error': None}
+        
+        if isinstance(terms, str):
+            terms = terms.split()
+        terms = sorted({term.lower() for term in terms})
+        if len(terms) == 0 or not all(TERM_REGEX.fullmatch(term) for term in terms):
+            result[PytwisConst.ERROR] = 'Only #hashtags and @mentions can be searched'
+            return (False, result)
+        if mode not in self.SEARCH_MODES:
+            result[PytwisConst.ERROR] = 'Unknown search mode {}'.format(mode)
+            return (False, result)
+        # Both limit and cursor may come from a request as strings.
+        if not str(limit).isdecimal() or not 1 <= int(limit) <= self.SEARCH_MAX_LIMIT:
+            result[PytwisConst.ERROR] = 'The limit should be from 1 to {}'.format(self.SEARCH_MAX_LIMIT)
+            return (False, result)
+        if cursor is not None and not str(cursor).isdecimal():
+            result[PytwisConst.ERROR] = 'Invalid cursor {}'.format(cursor)
+            return (False, result)
+        limit = int(limit)
+        
+        term_zset_keys = [self.TERM_ZSET_KEY_FORMAT.format(term) for term in terms]
+        max_score = '+inf' if cursor is None else '({}'.format(int(cursor))
+        rc = self._read_rc()
+        if len(term_zset_keys) == 1 or mode == self.SEARCH_MODE_OR:
+            # Merge the latest limit + 1 post IDs of each term, one more to tell if there 
+            # is a next page.
+            with self._pipeline(rc, transaction=False) as pipe:
+                for term_zset_key in term_zset_keys:
+                    pipe.zrevrangebyscore(term_zset_key, max_score, '-inf', start=0, num=limit + 1)
+                post_ids = merge_post_ids(pipe.execute(), limit + 1)
+        elif self._cluster:
+            result[PytwisConst.ERROR] = 'Searching for all of multiple terms is not supported in the cluster mode'
+            return (False, result)
+        else:
+            # Intersect the sorted sets of the terms on the primary in a transaction, which 
+            # costs about the size of the smallest sorted set times the number of terms.
+            search_result_key = self.SEARCH_RESULT_KEY_FORMAT.format(' '.join(terms))
+            with self._pipeline() as pipe:
+                pipe.zinterstore(search_result_key, term_zset_keys, aggregate='MAX')
+                pipe.zrevrangebyscore(search_result_key, max_score, '-inf', start=0, num=limit + 1)
+                pipe.delete(search_result_key)
+                _, post_ids, _ = pipe.execute()
+        
+        result[PytwisConst.NEXT_CURSOR] = None
+        if len(post_ids) > limit:
+            post_ids = post_ids[:limit]
+            result[PytwisConst.NEXT_CURSOR] = post_ids[-1]
+        
+        result[PytwisConst.TWEETS] = self._get_tweets(post_ids, rc)
+        
+        return (True, result)
+    
+    @instrumented
+    def get_general_timeline_json(self, max_cnt_tweets):
+        # Get the result of get_timeline('', max_cnt_tweets) serialized as JSON, together with 
+        # an ETag which changes with every new post. The serialized timeline is cached in Redis 
+        # and shared by all the instances until the next post, so a hit is one round trip 
+        # without any hydration.
+        result = {'error': None}
+        
+        if max_cnt_tweets < -1:
+            result[PytwisConst.ERROR] = 'Invalid tweet count {}'.format(max_cnt_tweets)
+            return (False, result)
+        # The general timeline never holds more than GENERAL_TIMELINE_MAX_POST_CNT tweets.
+        if max_cnt_tweets == -1 or max_cnt_tweets > self.GENERAL_TIMELINE_MAX_POST_CNT:
+            max_cnt_tweets = self.GENERAL_TIMELINE_MAX_POST_CNT
+        
+        # Only the whole general timeline is cached and the fewer tweets are sliced from it, 
+        # so the cache holds one timeline however many counts are requested.
+        rc = self._read_rc()
+        with self._pipeline(rc, transaction=False) as pipe:
+            pipe.get(self.GENERAL_TIMELINE_VERSION_KEY)
+            pipe.hget(self.GENERAL_TIMELINE_CACHE_KEY, self.GENERAL_TIMELINE_MAX_POST_CNT)
+            version, cached_timeline = pipe.execute()
+        version = version or '0'
         
-        return (True, result)
\ No newline at end of file
+        cached_version, _, timeline_json = (cached_timeline or '').partition(':')
+        if cached_version != version:
+            # Read the timeline after the version from the same server, so it's never older 
+            # than the version. A cache entry overwritten by an older version is simply rebuilt 
+            # by the next read.
+            post_ids = rc.lrange(self.GENERAL_TIMELINE_KEY, 0, self.GENERAL_TIMELINE_MAX_POST_CNT - 1)
+            timeline_json = json.dumps({'error': None, 
+                                        PytwisConst.TWEETS: self._get_tweets(post_ids, rc)})
+            # Replace the whole hash to also drop the timelines cached per count by the 
+            # earlier versions.
+            with self._pipeline() as pipe:
+                pipe.delete(self.GENERAL_TIMELINE_CACHE_KEY)
+                pipe.hset(self.GENERAL_TIMELINE_CACHE_KEY, self.GENERAL_TIMELINE_MAX_POST_CNT, 
+                          '{}:{}'.format(version, timeline_json))
+                pipe.execute()
+        
+        if max_cnt_tweets < self.GENERAL_TIMELINE_MAX_POST_CNT:
+            timeline = json.loads(timeline_json)
+            timeline[PytwisConst.TWEETS] = timeline[PytwisConst.TWEETS][:max_cnt_tweets]
+            timeline_json = json.dumps(timeline)
+        
+        result[PytwisConst.ETAG] = '{}-{}'.format(version, max_cnt_tweets)
+        result[PytwisConst.TIMELINE_JSON] = timeline_json
+        return (True, result)
+    
+    def _scan_post_ids(self, timeline_key, max_cnt_post_ids, max_id=None, since_id=None, rc=None):
+        # Scan the timeline from the latest tweet in windows of TIMELINE_SCAN_WINDOW post IDs 
+        # and get at most max_cnt_post_ids (all if -1) post IDs which are no larger than 
+        # max_id and larger than since_id, from the latest to the oldest.
+        if rc is None:
+            rc = self._rc
+        post_ids = []
+        scan_end_index = None
+        window_start_index = 0
+        while True:
+            window = rc.lrange(timeline_key, window_start_index, 
+                               window_start_index + self.TIMELINE_SCAN_WINDOW - 1)
+            scan_end_index = self._filter_scan_window(window, window_start_index, post_ids, 
+                                                      scan_end_index, max_id, since_id)
+            window_start_index += self.TIMELINE_SCAN_WINDOW
+            if self._is_scan_done(window, window_start_index, post_ids, scan_end_index, max_cnt_post_ids):
+                break
+        
+        return self._sort_scanned_post_ids(post_ids, max_cnt_post_ids)
+    
+    @instrumented
+    def get_timeline_page(self, auth_secret, page_size, max_id=None, since_id=None):
+        result = {'error': None}
+        
+        if page_size < 1:
+            result[PytwisConst.ERROR] = 'Invalid page size {}'.format(page_size)
+            return (False, result)
+        
+        rc = self._read_rc()
+        user_id_and_timeline_keys = self._get_timeline_keys(auth_secret, rc)
+        if user_id_and_timeline_keys is None:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+        user_id, timeline_keys = user_id_and_timeline_keys
+        
+        # Get the post IDs of the page: the latest page_size tweets which are no later than 
+        # max_id (to page back through the timeline) and later than since_id (to poll for 
+        # new tweets).
+        post_id_lists = [self._scan_post_ids(timeline_key, page_size, max_id, since_id, rc) 
+                         for timeline_key in timeline_keys]
+        
+        # Rebuild the trimmed tweets if the user timeline runs out of tweets before the page is full.
+        if user_id is not None and len(post_id_lists[0]) < page_size:
+            post_id_lists += self._get_backfill_post_id_lists(user_id, page_size, max_id, since_id, rc)
+        
+        post_ids = merge_post_ids(post_id_lists, page_size)
+        
+        result[PytwisConst.TWEETS] = self._get_tweets(post_ids, rc)
+        
+        # Pass NEXT_MAX_ID as max_id to get the next older page, and NEXT_SINCE_ID as since_id 
+        # to get the tweets posted after this page.
+        if len(post_ids) > 0 and len(post_ids) == page_size:
+            result[PytwisConst.NEXT_MAX_ID] = int(post_ids[-1]) - 1
+        else:
+            result[PytwisConst.NEXT_MAX_ID] = None
+        if len(post_ids) > 0:
+            result[PytwisConst.NEXT_SINCE_ID] = int(post_ids[0])
+        else:
+            result[PytwisConst.NEXT_SINCE_ID] = since_id
+        
+        return (True, result)
+
+
+def parse_stream_entry_id(entry_id):
+    # Split the ID of a Redis Stream entry into its milliseconds and sequence number.
+    milliseconds, _, sequence_number = entry_id.partition('-')
+    return (int(milliseconds), int(sequence_number or 0))
+
+def merge_post_ids(post_id_lists, max_cnt_post_ids=-1):
+    # Merge the lists of post IDs, each of which is sorted from the latest to the oldest, 
+    # into one list sorted in the same order without duplicates. Since post IDs are 
+    # allocated by INCR, a larger post ID implies a later tweet.
+    merged_post_ids = iter_merged_post_ids(post_id_lists)
+    if max_cnt_post_ids != -1:
+        merged_post_ids = itertools.islice(merged_post_ids, max_cnt_post_ids)
+    
+    return list(merged_post_ids)
+
+def iter_merged_post_ids(post_id_iters):
+    # Lazy version of merge_post_ids which only reads ahead one post ID of each iterable.
+    last_post_id = None
+    for post_id in heapq.merge(*post_id_iters, key=lambda post_id: -int(post_id)):
+        if post_id == last_post_id:
+            continue
+        yield post_id
+        last_post_id = post_id
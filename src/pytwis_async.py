@@ -0,0 +1,599 @@
+# -*- coding: utf-8 -*-
+#
+# Native asyncio version of Pytwis built on redis.asyncio.
+#
+# AsyncPytwis uses the same key layout (PytwisKeyLayout) as Pytwis, so both can run
+# against the same database. It serves a subset of the methods of Pytwis with the
+# same results: register, change_password, login, logout, post_tweet, follow,
+# unfollow, the follow lists with their pages and counts, get_timeline and
+# get_timeline_page. The batch methods, the iterators, search, read_post_events and
+# get_general_timeline_json, as well as the cluster, replica, metrics and cache
+# options, are only in Pytwis, which serves them over the same data. The tweets
+# posted by AsyncPytwis are indexed for search and, with post_events, published
+# to the post event streams just like the ones posted by Pytwis.
+#
+# The session checks and post_tweet always run as the server-side Lua scripts of
+# PytwisKeyLayout, which keeps every authenticated write to one awaited round trip.
+#
+
+import asyncio
+from collections import Counter
+import secrets
+import time
+
+import redis.asyncio
+from redis.exceptions import (ResponseError, TimeoutError)
+
+from pytwis import PytwisConst, PytwisKeyLayout, PytwisPasswordHasher, extract_terms, merge_post_ids
+
+
+class AsyncPytwis(PytwisKeyLayout):
+
+    def __init__(self, hostname='127.0.0.1', port=6379, db=0, password='',
+                 celebrity_follower_threshold=None, async_fanout=False,
+                 user_timeline_max_post_cnt=None, unix_socket_path=None, max_connections=None,
+                 pool_timeout=20, socket_keepalive=False, health_check_interval=0,
+                 post_storage='hash', follow_backfill_post_cnt=100, password_scrypt_n=None,
+                 password_scrypt_r=8, password_scrypt_p=1, password_hash_workers=None,
+                 post_events=False):
+        # See Pytwis.__init__ for the meaning of the options.
+        self._celebrity_follower_threshold = celebrity_follower_threshold
+        self._async_fanout = async_fanout
+        self._user_timeline_max_post_cnt = user_timeline_max_post_cnt
+        if post_storage not in self.POST_STORAGES:
+            raise ValueError('Unknown post storage {}'.format(post_storage))
+        self._post_storage = post_storage
+        self._follow_backfill_post_cnt = follow_backfill_post_cnt
+        self._post_events = post_events
+        # The hashing is awaited without blocking the event loop unless password_hash_workers is 0.
+        self._password_hasher = PytwisPasswordHasher(password_scrypt_n, password_scrypt_r,
+                                                     password_scrypt_p, password_hash_workers)
+
+        connection_kwargs = {
+            'db': db,
+            'password': password,
+            'decode_responses': True, # Decode the response bytes into strings.
+            'health_check_interval': health_check_interval}
+        if unix_socket_path is not None:
+            connection_kwargs['connection_class'] = redis.asyncio.UnixDomainSocketConnection
+            connection_kwargs['path'] = unix_socket_path
+            self._hostname = unix_socket_path
+        else:
+            connection_kwargs['host'] = hostname
+            connection_kwargs['port'] = port
+            connection_kwargs['socket_connect_timeout'] = self.REDIS_SOCKET_CONNECT_TIMEOUT
+            connection_kwargs['socket_keepalive'] = socket_keepalive
+            self._hostname = hostname
+        
+        # As in Pytwis, a coroutine which needs a connection when all the max_connections 
+        # connections are in use waits up to pool_timeout seconds for one to be released.
+        if max_connections is not None:
+            connection_pool = redis.asyncio.BlockingConnectionPool(max_connections=max_connections,
+                                                                   timeout=pool_timeout,
+                                                                   **connection_kwargs)
+        else:
+            connection_pool = redis.asyncio.ConnectionPool(**connection_kwargs)
+        self._rc = redis.asyncio.StrictRedis(connection_pool=connection_pool)
+
+        self._post_tweet_script = self._rc.register_script(self._render_lua_script(self.POST_TWEET_LUA_SCRIPT))
+        self._is_loggedin_script = self._rc.register_script(self._render_lua_script(self.IS_LOGGEDIN_LUA_SCRIPT))
+        self._rehash_password_script = self._rc.register_script(
+            self._render_lua_script(self.REHASH_PASSWORD_LUA_SCRIPT))
+
+    async def connect(self):
+        # Test the connection by ping.
+        try:
+            if await self._rc.ping() == True:
+                print('Ping {} returned True'.format(self._hostname))
+        except (ResponseError, TimeoutError) as e:
+            raise ValueError(str(e)) from e
+
+        if self._user_timeline_max_post_cnt is not None and await self._rc.exists(self.NEXT_POST_ID_KEY) and \
+           not await self._rc.exists(self.AUTHORED_POSTS_COMPLETE_KEY):
+            raise ValueError(self.AUTHORED_POSTS_INCOMPLETE_ERROR)
+
+    async def close(self):
+        await self._rc.close()
+
+    async def _is_loggedin(self, auth_secret):
+        user_id = await self._is_loggedin_script(keys=[self.AUTHS_HASH_KEY], args=[auth_secret])
+        if user_id is None:
+            return (False, None)
+
+        return (True, user_id)
+
+    async def _get_usernames(self, user_ids):
+        async with self._rc.pipeline() as pipe:
+            for user_id in user_ids:
+                user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
+                pipe.hget(user_id_profile_key, self.USER_ID_PROFILE_USERNAME_KEY)
+            return await pipe.execute()
+
+    async def register(self, username, password):
+        result = {'error': None}
+
+        # Hash the password in a worker process while the username is claimed.
+        password_future = asyncio.wrap_future(self._password_hasher.submit_hash(password))
+
+        # Claim the username by HSETNX, which only succeeds for one of the clients registering
+        # with the same username without making any other registration retry (see Pytwis.register).
+        user_id = await self._rc.incr(self.NEXT_USER_ID_KEY)
+        if not await self._rc.hsetnx(self.USERS_HASH_KEY, username, user_id):
+            result[PytwisConst.ERROR] = 'username {} already exists'.format(username)
+            password_future.cancel()
+            return (False, result)
+
+        # Generate the authentication secret.
+        auth_secret = secrets.token_hex()
+        user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
+        password = await password_future
+
+        async with self._rc.pipeline() as pipe:
+            pipe.hset(self.AUTHS_HASH_KEY, auth_secret, user_id)
+            pipe.hset(user_id_profile_key,
+                      mapping={self.USER_ID_PROFILE_USERNAME_KEY: username,
+                               self.USER_ID_PROFILE_PASSWORD_KEY: password,
+                               self.USER_ID_PROFILE_AUTH_KEY: auth_secret})
+            await pipe.execute()
+
+        result[PytwisConst.USER_NAME] = user_id
+        result[PytwisConst.AUTH] = auth_secret
+
+        return (True, result)
+
+    async def change_password(self, auth_secret, old_password, new_password):
+        result = {'error': None}
+
+        # Check if the user is logged in.
+        loggedin, user_id = await self._is_loggedin(auth_secret)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+
+        # Check if the old password matches.
+        user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
+        stored_password = await self._rc.hget(user_id_profile_key, self.USER_ID_PROFILE_PASSWORD_KEY)
+        if not await asyncio.wrap_future(self._password_hasher.submit_verify(old_password, stored_password)):
+            result[PytwisConst.ERROR] = 'Incorrect old password'
+            return (False, result)
+
+        # Replace the old password by the new one and the old authentication secret by the new one.
+        new_password = await asyncio.wrap_future(self._password_hasher.submit_hash(new_password))
+        new_auth_secret = secrets.token_hex()
+        async with self._rc.pipeline() as pipe:
+            pipe.hset(user_id_profile_key, self.USER_ID_PROFILE_PASSWORD_KEY, new_password)
+            pipe.hset(user_id_profile_key, self.USER_ID_PROFILE_AUTH_KEY, new_auth_secret)
+            pipe.hset(self.AUTHS_HASH_KEY, new_auth_secret, user_id)
+            pipe.hdel(self.AUTHS_HASH_KEY, auth_secret)
+            pipe.publish(self.SESSION_INVALIDATION_CHANNEL, auth_secret)
+            await pipe.execute()
+
+        result[PytwisConst.AUTH] = new_auth_secret
+        return (True, result)
+
+    async def login(self, username, password):
+        result = {'error': None}
+
+        # Get the user-id based on the username.
+        user_id = await self._rc.hget(self.USERS_HASH_KEY, username)
+        if user_id is None:
+            result[PytwisConst.ERROR] = "username {} doesn't exist".format(username)
+            return (False, result)
+
+        # Compare the input password with the stored one. If it matches,
+        # return the authentication secret.
+        user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
+        stored_password, auth_secret = await self._rc.hmget(user_id_profile_key,
+                                                            self.USER_ID_PROFILE_PASSWORD_KEY,
+                                                            self.USER_ID_PROFILE_AUTH_KEY)
+        if await asyncio.wrap_future(self._password_hasher.submit_verify(password, stored_password)):
+            # Rehash the password if it's raw or hashed with the old costs.
+            if self._password_hasher.needs_rehash(stored_password):
+                rehashed_password = await asyncio.wrap_future(self._password_hasher.submit_hash(password))
+                await self._rehash_password_script(keys=[user_id_profile_key],
+                                                   args=[stored_password, rehashed_password])
+
+            result[PytwisConst.USER_NAME] = username
+            result[PytwisConst.AUTH] = auth_secret
+            return (True, result)
+        else:
+            result[PytwisConst.ERROR] = 'Incorrect password'
+            return (False, result)
+
+    async def logout(self, auth_secret):
+        result = {'error': None}
+
+        # Check if the user is logged in.
+        loggedin, user_id = await self._is_loggedin(auth_secret)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+
+        # Replace the old authentication secret by the new one.
+        new_auth_secret = secrets.token_hex()
+        user_id_profile_key = self.USER_ID_PROFILE_KEY_FORMAT.format(user_id)
+        async with self._rc.pipeline() as pipe:
+            pipe.hset(user_id_profile_key, self.USER_ID_PROFILE_AUTH_KEY, new_auth_secret)
+            pipe.hset(self.AUTHS_HASH_KEY, new_auth_secret, user_id)
+            pipe.hdel(self.AUTHS_HASH_KEY, auth_secret)
+            pipe.publish(self.SESSION_INVALIDATION_CHANNEL, auth_secret)
+            await pipe.execute()
+
+        result[PytwisConst.AUTH] = ''
+        result[PytwisConst.USER_NAME] = ''
+        return (True, result)
+
+    async def post_tweet(self, auth_secret, tweet):
+        result = {'error': None}
+
+        threshold = self._celebrity_follower_threshold
+        max_post_cnt = self._user_timeline_max_post_cnt
+        post_id = await self._post_tweet_script(
+            keys=[self.AUTHS_HASH_KEY, self.NEXT_POST_ID_KEY, self.CELEBRITIES_SET_KEY,
+                  self.FANOUT_STREAM_KEY, self.GENERAL_TIMELINE_KEY, self.GENERAL_TIMELINE_VERSION_KEY],
+            args=[auth_secret, tweet, int(time.time()),
+                  -1 if threshold is None else threshold,
+                  1 if self._async_fanout else 0,
+                  -1 if max_post_cnt is None else max_post_cnt,
+                  self._post_storage,
+                  1 if self._post_events else 0] + extract_terms(tweet))
+        if post_id == 0:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+
+        return (True, result)
+
+    async def _get_followee_user_id(self, followee_username):
+        return await self._rc.hget(self.USERS_HASH_KEY, followee_username)
+
+    async def follow(self, auth_secret, followee_username):
+        result = {'error': None}
+
+        # Check if the user is logged in.
+        loggedin, user_id = await self._is_loggedin(auth_secret)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+
+        # Check if the followee exists.
+        followee_user_id = await self._get_followee_user_id(followee_username)
+        if followee_user_id is None:
+            result[PytwisConst.ERROR] = "Followee {} doesn't exist".format(followee_username)
+            return (False, result)
+
+        # Update the two zset 'followers:[followee_username]' and 'following:[username]'.
+        follower_zset_key = self.FOLLOWER_ZSET_KEY_FORMAT.format(followee_user_id)
+        following_zset_key = self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id)
+        unix_time = int(time.time())
+        async with self._rc.pipeline() as pipe:
+            pipe.zadd(follower_zset_key, {user_id: unix_time})
+            pipe.zadd(following_zset_key, {followee_user_id: unix_time})
+            await pipe.execute()
+
+        if followee_user_id != user_id:
+            await self._backfill_home_timeline(user_id, followee_user_id)
+
+        return (True, result)
+
+    async def _backfill_home_timeline(self, user_id, followee_user_id):
+        # See Pytwis._backfill_home_timelines.
+        if self._follow_backfill_post_cnt == 0:
+            return
+
+        post_id_user_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
+        async with self._rc.pipeline() as pipe:
+            pipe.sismember(self.CELEBRITIES_SET_KEY, followee_user_id)
+            pipe.lrange(self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(followee_user_id),
+                        0, self._follow_backfill_post_cnt - 1)
+            pipe.lrange(post_id_user_key, 0, self._get_follow_backfill_merge_window() - 1)
+            is_celebrity, backfill_post_ids, home_post_ids = await pipe.execute()
+
+        if is_celebrity:
+            return
+
+        inserts = self._plan_follow_backfill(home_post_ids, backfill_post_ids)
+        async with self._rc.pipeline(transaction=False) as pipe:
+            for post_id, pivot_post_id in inserts:
+                if pivot_post_id is None:
+                    pipe.rpush(post_id_user_key, post_id)
+                else:
+                    pipe.linsert(post_id_user_key, 'BEFORE', pivot_post_id, post_id)
+            if self._user_timeline_max_post_cnt is not None:
+                pipe.ltrim(post_id_user_key, 0, self._user_timeline_max_post_cnt - 1)
+                if len(home_post_ids) + len(inserts) > self._user_timeline_max_post_cnt:
+                    pipe.set(self.TRIMMED_USER_KEY_FORMAT.format(user_id), 1)
+            await pipe.execute()
+
+    async def _purge_home_timeline(self, user_id, followee_user_id):
+        # See Pytwis._purge_home_timeline.
+        post_id_user_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
+        async with self._rc.pipeline() as pipe:
+            pipe.llen(post_id_user_key)
+            pipe.lrange(post_id_user_key, 0, self.UNFOLLOW_PURGE_WINDOW - 1)
+            post_id_cnt, window_post_ids = await pipe.execute()
+        if len(window_post_ids) == 0:
+            return
+
+        if self._is_user_timeline_trimmed(post_id_cnt, False):
+            await self._rc.set(self.TRIMMED_USER_KEY_FORMAT.format(user_id), 1)
+
+        oldest_post_id = min(int(post_id) for post_id in window_post_ids)
+        window_post_id_cnts = Counter(window_post_ids)
+        authored_post_id_user_key = self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(followee_user_id)
+        chunk_start_index = 0
+        while True:
+            post_ids = await self._rc.lrange(authored_post_id_user_key, chunk_start_index,
+                                             chunk_start_index + self.UNFOLLOW_PURGE_CHUNK_SIZE - 1)
+            purged_post_ids = [post_id for post_id in post_ids if int(post_id) >= oldest_post_id]
+            if any(post_id in window_post_id_cnts for post_id in purged_post_ids):
+                async with self._rc.pipeline(transaction=False) as pipe:
+                    for post_id in purged_post_ids:
+                        if post_id in window_post_id_cnts:
+                            pipe.lrem(post_id_user_key, window_post_id_cnts[post_id], post_id)
+                    await pipe.execute()
+
+            if len(purged_post_ids) < self.UNFOLLOW_PURGE_CHUNK_SIZE:
+                break
+            chunk_start_index += self.UNFOLLOW_PURGE_CHUNK_SIZE
+
+    async def unfollow(self, auth_secret, followee_username):
+        result = {'error': None}
+
+        # Check if the user is logged in.
+        loggedin, user_id = await self._is_loggedin(auth_secret)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+
+        # Check if the followee exists.
+        followee_user_id = await self._get_followee_user_id(followee_username)
+        if followee_user_id is None:
+            result[PytwisConst.ERROR] = "Followee {} doesn't exist".format(followee_username)
+            return (False, result)
+
+        follower_zset_key = self.FOLLOWER_ZSET_KEY_FORMAT.format(followee_user_id)
+        following_zset_key = self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id)
+        async with self._rc.pipeline() as pipe:
+            pipe.zrem(follower_zset_key, user_id)
+            pipe.zrem(following_zset_key, followee_user_id)
+            await pipe.execute()
+
+        # The user timeline always has the posts of the user, even after unfollowing oneself.
+        if followee_user_id != user_id:
+            await self._purge_home_timeline(user_id, followee_user_id)
+
+        return (True, result)
+
+    async def _get_follow_list(self, auth_secret, zset_key_format, list_name):
+        result = {'error': None}
+
+        # Check if the user is logged in.
+        loggedin, user_id = await self._is_loggedin(auth_secret)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+
+        user_ids = await self._rc.zrange(zset_key_format.format(user_id), 0, -1)
+        result[list_name] = await self._get_usernames(user_ids) if len(user_ids) > 0 else []
+
+        return (True, result)
+
+    async def get_followers(self, auth_secret):
+        return await self._get_follow_list(auth_secret, self.FOLLOWER_ZSET_KEY_FORMAT,
+                                           PytwisConst.FOLLOWER_LIST)
+
+    async def get_following(self, auth_secret):
+        return await self._get_follow_list(auth_secret, self.FOLLOWING_ZSET_KEY_FORMAT,
+                                           PytwisConst.FOLLOWING_LIST)
+
+    async def _get_follow_list_page(self, auth_secret, zset_key_format, list_name, page_size, offset):
+        # See Pytwis._get_follow_list_page.
+        result = {'error': None}
+
+        if page_size < 1 or offset < 0:
+            result[PytwisConst.ERROR] = 'Invalid page size {} or offset {}'.format(page_size, offset)
+            return (False, result)
+
+        loggedin, user_id = await self._is_loggedin(auth_secret)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+
+        user_ids = await self._rc.zrange(zset_key_format.format(user_id), offset, offset + page_size)
+        if len(user_ids) > page_size:
+            result[PytwisConst.NEXT_OFFSET] = offset + page_size
+            user_ids = user_ids[:page_size]
+        else:
+            result[PytwisConst.NEXT_OFFSET] = None
+
+        result[list_name] = await self._get_usernames(user_ids)
+
+        return (True, result)
+
+    async def get_followers_page(self, auth_secret, page_size, offset=0):
+        return await self._get_follow_list_page(auth_secret, self.FOLLOWER_ZSET_KEY_FORMAT,
+                                                PytwisConst.FOLLOWER_LIST, page_size, offset)
+
+    async def get_following_page(self, auth_secret, page_size, offset=0):
+        return await self._get_follow_list_page(auth_secret, self.FOLLOWING_ZSET_KEY_FORMAT,
+                                                PytwisConst.FOLLOWING_LIST, page_size, offset)
+
+    async def _count_follow_list(self, auth_secret, zset_key_format, cnt_name):
+        result = {'error': None}
+
+        loggedin, user_id = await self._is_loggedin(auth_secret)
+        if not loggedin:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+
+        result[cnt_name] = await self._rc.zcard(zset_key_format.format(user_id))
+
+        return (True, result)
+
+    async def count_followers(self, auth_secret):
+        return await self._count_follow_list(auth_secret, self.FOLLOWER_ZSET_KEY_FORMAT, PytwisConst.FOLLOWER_CNT)
+
+    async def count_following(self, auth_secret):
+        return await self._count_follow_list(auth_secret, self.FOLLOWING_ZSET_KEY_FORMAT, PytwisConst.FOLLOWING_CNT)
+
+    async def _get_tweets(self, post_ids):
+        if len(post_ids) == 0:
+            return []
+
+        # Get the tweets, looking the missing ones up in the other storages (see Pytwis._read_posts).
+        async with self._rc.pipeline() as pipe:
+            for post_id in post_ids:
+                self._queue_post_read(pipe, post_id, self._post_storage)
+            tweets = [self._decode_post(raw_post) for raw_post in await pipe.execute()]
+
+        missing_indexes = [index for index, tweet in enumerate(tweets) if tweet is None]
+        if len(missing_indexes) > 0:
+            missing_post_storages = self._get_missing_post_storages(self._post_storage)
+            async with self._rc.pipeline() as pipe:
+                for index in missing_indexes:
+                    for post_storage in missing_post_storages:
+                        self._queue_post_read(pipe, post_ids[index], post_storage)
+                raw_posts = iter(await pipe.execute())
+            for index in missing_indexes:
+                for raw_post in [next(raw_posts) for _ in missing_post_storages]:
+                    tweets[index] = tweets[index] or self._decode_post(raw_post)
+        tweets = [tweet for tweet in tweets if tweet is not None]
+
+        # Add the username for the user ID of each tweet.
+        user_id_list = list({ tweet[self.POST_ID_USERID_KEY] for tweet in tweets })
+        user_id_to_username = dict(zip(user_id_list, await self._get_usernames(user_id_list)))
+        for tweet in tweets:
+            tweet[self.USER_ID_PROFILE_USERNAME_KEY] = user_id_to_username[tweet[self.POST_ID_USERID_KEY]]
+
+        return tweets
+
+    async def _get_timeline_keys(self, auth_secret):
+        # See Pytwis._get_timeline_keys.
+        if auth_secret == '':
+            return (None, [self.GENERAL_TIMELINE_KEY])
+
+        loggedin, user_id = await self._is_loggedin(auth_secret)
+        if not loggedin:
+            return None
+
+        timeline_keys = [self.POST_ID_USER_KEY_FORMAT.format(user_id)]
+        if self._celebrity_follower_threshold is not None:
+            async with self._rc.pipeline() as pipe:
+                pipe.zrange(self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id), 0, -1)
+                pipe.exists(self.CELEBRITIES_SET_KEY)
+                following_user_ids, has_celebrities = await pipe.execute()
+            if len(following_user_ids) > 0 and has_celebrities:
+                are_celebrities = await self._rc.smismember(self.CELEBRITIES_SET_KEY, following_user_ids)
+                for following_user_id, is_celebrity in zip(following_user_ids, are_celebrities):
+                    if is_celebrity:
+                        timeline_keys.append(self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(following_user_id))
+
+        return (user_id, timeline_keys)
+
+    async def _scan_post_ids(self, timeline_key, max_cnt_post_ids, max_id=None, since_id=None):
+        # See Pytwis._scan_post_ids.
+        post_ids = []
+        scan_end_index = None
+        window_start_index = 0
+        while True:
+            window = await self._rc.lrange(timeline_key, window_start_index,
+                                           window_start_index + self.TIMELINE_SCAN_WINDOW - 1)
+            scan_end_index = self._filter_scan_window(window, window_start_index, post_ids,
+                                                      scan_end_index, max_id, since_id)
+            window_start_index += self.TIMELINE_SCAN_WINDOW
+            if self._is_scan_done(window, window_start_index, post_ids, scan_end_index, max_cnt_post_ids):
+                break
+
+        return self._sort_scanned_post_ids(post_ids, max_cnt_post_ids)
+
+    async def _get_backfill_post_id_lists(self, user_id, max_cnt_post_ids, max_id=None, since_id=None):
+        # See Pytwis._get_backfill_post_id_lists.
+        if self._user_timeline_max_post_cnt is None:
+            return []
+
+        post_id_user_key = self.POST_ID_USER_KEY_FORMAT.format(user_id)
+        async with self._rc.pipeline() as pipe:
+            pipe.llen(post_id_user_key)
+            pipe.lindex(post_id_user_key, -1)
+            pipe.exists(self.TRIMMED_USER_KEY_FORMAT.format(user_id))
+            pipe.zrange(self.FOLLOWING_ZSET_KEY_FORMAT.format(user_id), 0, -1)
+            post_id_cnt, oldest_post_id, is_trimmed, following_user_ids = await pipe.execute()
+
+        if not self._is_user_timeline_trimmed(post_id_cnt, is_trimmed):
+            return []
+
+        backfill_max_id = max_id
+        if oldest_post_id is not None and (max_id is None or int(oldest_post_id) - 1 < max_id):
+            backfill_max_id = int(oldest_post_id) - 1
+
+        return await self._run_read_plan(self._plan_backfill_reads(
+            [self.AUTHORED_POST_ID_USER_KEY_FORMAT.format(authored_user_id)
+             for authored_user_id in [user_id] + following_user_ids],
+            max_cnt_post_ids, backfill_max_id, since_id))
+
+    async def _run_read_plan(self, plan):
+        # See Pytwis._run_read_plan.
+        try:
+            commands = next(plan)
+            while True:
+                async with self._rc.pipeline(transaction=False) as pipe:
+                    for command_name, *command_args in commands:
+                        getattr(pipe, command_name)(*command_args)
+                    commands = plan.send(await pipe.execute())
+        except StopIteration as e:
+            return e.value
+
+    async def get_timeline(self, auth_secret, max_cnt_tweets):
+        result = {'error': None}
+
+        user_id_and_timeline_keys = await self._get_timeline_keys(auth_secret)
+        if user_id_and_timeline_keys is None:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+        user_id, timeline_keys = user_id_and_timeline_keys
+
+        result[PytwisConst.TWEETS] = []
+        if max_cnt_tweets == 0:
+            return (True, result)
+        last_tweet_index = -1 if max_cnt_tweets == -1 else max_cnt_tweets - 1
+
+        async with self._rc.pipeline() as pipe:
+            for timeline_key in timeline_keys:
+                pipe.lrange(timeline_key, 0, last_tweet_index)
+            post_id_lists = await pipe.execute()
+
+        if user_id is not None and self._user_timeline_max_post_cnt is not None and \
+           (max_cnt_tweets == -1 or len(post_id_lists[0]) < max_cnt_tweets):
+            post_id_lists += await self._get_backfill_post_id_lists(user_id, max_cnt_tweets)
+
+        result[PytwisConst.TWEETS] = await self._get_tweets(merge_post_ids(post_id_lists, max_cnt_tweets))
+
+        return (True, result)
+
+    async def get_timeline_page(self, auth_secret, page_size, max_id=None, since_id=None):
+        result = {'error': None}
+
+        if page_size < 1:
+            result[PytwisConst.ERROR] = 'Invalid page size {}'.format(page_size)
+            return (False, result)
+
+        user_id_and_timeline_keys = await self._get_timeline_keys(auth_secret)
+        if user_id_and_timeline_keys is None:
+            result[PytwisConst.ERROR] = 'Not logged in'
+            return (False, result)
+        user_id, timeline_keys = user_id_and_timeline_keys
+
+        post_id_lists = [await self._scan_post_ids(timeline_key, page_size, max_id, since_id)
+                         for timeline_key in timeline_keys]
+        if user_id is not None and len(post_id_lists[0]) < page_size:
+            post_id_lists += await self._get_backfill_post_id_lists(user_id, page_size, max_id, since_id)
+        post_ids = merge_post_ids(post_id_lists, page_size)
+
+        result[PytwisConst.TWEETS] = await self._get_tweets(post_ids)
+        if len(post_ids) > 0 and len(post_ids) == page_size:
+            result[PytwisConst.NEXT_MAX_ID] = int(post_ids[-1]) - 1
+        else:
+            result[PytwisConst.NEXT_MAX_ID] = None
+        result[PytwisConst.NEXT_SINCE_ID] = int(post_ids[0]) if len(post_ids) > 0 else since_id
+
+        return (True, result)
@@ -0,0 +1,266 @@
+#
+# Asynchronous REST API for pytwis
+#
+# The same resources as pytwis_rest.py, served by Quart on top of AsyncPytwis,
+# so that one process can serve many concurrent clients without blocking a
+# thread per request on Redis.
+#
+# Resource      Action      Operation
+# ===========================================================================
+# users         POST        Create a new user (register)
+#               GET         Get the information of a user (implicit login,
+#                           following and follower)
+#               PUT         Modify a user (change his followers, change his
+#                           password)
+# posts         POST        Post a new tweet
+#               GET         Get timeline (a page of it if page_size is given,
+#                           paged by max_id and since_id)
+#
+#
+# How to run:
+# python3 pytwis_async_rest.py
+# or, with an ASGI server,
+# hypercorn pytwis_async_rest:app
+#
+
+import argparse
+import sys
+import time
+
+from quart import Quart, jsonify, request, abort, make_response
+
+from pytwis import PytwisConst
+from pytwis_async import AsyncPytwis
+from pytwis_clt import add_redis_arguments, redis_connection_kwargs
+
+app = Quart(__name__)
+
+PROJECT_NAME = 'pytwis'
+PYTWIS_API_VERSION = "1.0"
+
+HTTP_INDEX_URL = '/' + PROJECT_NAME + '/api/v' + PYTWIS_API_VERSION + '/'
+
+g_pytwis_args = {}
+g_pytwis = None
+
+@app.before_serving
+async def connect():
+    global g_pytwis
+    g_pytwis = AsyncPytwis(**g_pytwis_args)
+    await g_pytwis.connect()
+
+@app.after_serving
+async def close():
+    await g_pytwis.close()
+
+# Project information
+@app.route(HTTP_INDEX_URL)
+async def index():
+    about = {
+        'projectname': PROJECT_NAME,
+        'apiversion': PYTWIS_API_VERSION,
+        'timestamp': time.time()
+    }
+    return jsonify({'projectinfo': about})
+
+async def authenticate(request_json):
+    # If there is a set of credentials, try login first. Otherwise use the auth information.
+    # Return (auth, error_response).
+    if PytwisConst.USER_NAME in request_json and PytwisConst.PASSWORD in request_json:
+        succeeded, result = await g_pytwis.login(request_json[PytwisConst.USER_NAME],
+                                                 request_json[PytwisConst.PASSWORD])
+        if not succeeded:
+            return '', await make_response(jsonify(process_error(result)), 404)
+        return result[PytwisConst.AUTH], None
+
+    return request_json.get(PytwisConst.AUTH, ''), None
+
+@app.route(HTTP_INDEX_URL+'users', methods=['POST'])
+async def register_user():
+    request_json = await request.get_json()
+    if not request_json or not PytwisConst.USER_NAME in request_json or not PytwisConst.PASSWORD in request_json:
+        abort(400)
+    # Call twis API to register a new user
+    succeeded, result = await g_pytwis.register(request_json[PytwisConst.USER_NAME],
+                                                request_json[PytwisConst.PASSWORD])
+    if succeeded:
+        server_resp = {
+            'userid': result[PytwisConst.USER_NAME],
+            PytwisConst.USER_NAME: request_json[PytwisConst.USER_NAME],
+            PytwisConst.AUTH: result[PytwisConst.AUTH]
+        }
+        return jsonify(server_resp)
+    else:
+        return await make_response(jsonify(process_error(result)), 404)
+
+@app.route(HTTP_INDEX_URL+'users', methods=['GET'])
+async def get_user_info():
+    request_json = await request.get_json()
+    if not request_json:
+        abort(400)
+    auth, error_response = await authenticate(request_json)
+    if error_response is not None:
+        return error_response
+
+    userinfo = {PytwisConst.USER_NAME: request_json.get(PytwisConst.USER_NAME, 'n/a')}
+
+    # Get a page of each list if page_size is given, paged by followers_offset and
+    # followings_offset, or the whole lists otherwise.
+    if PytwisConst.PAGE_SIZE in request_json:
+        page_size = int(request_json[PytwisConst.PAGE_SIZE])
+        succeeded, result = await g_pytwis.get_followers_page(
+            auth, page_size, int(request_json.get(PytwisConst.FOLLOWERS_OFFSET, 0)))
+        if succeeded:
+            userinfo[PytwisConst.NEXT_FOLLOWERS_OFFSET] = result[PytwisConst.NEXT_OFFSET]
+    else:
+        succeeded, result = await g_pytwis.get_followers(auth)
+    if not succeeded:
+        return await make_response(jsonify(process_error(result)), 404)
+    userinfo[PytwisConst.FOLLOWERS] = result[PytwisConst.FOLLOWER_LIST]
+
+    if PytwisConst.PAGE_SIZE in request_json:
+        succeeded, result = await g_pytwis.get_following_page(
+            auth, page_size, int(request_json.get(PytwisConst.FOLLOWINGS_OFFSET, 0)))
+        if succeeded:
+            userinfo[PytwisConst.NEXT_FOLLOWINGS_OFFSET] = result[PytwisConst.NEXT_OFFSET]
+    else:
+        succeeded, result = await g_pytwis.get_following(auth)
+    if not succeeded:
+        return await make_response(jsonify(process_error(result)), 404)
+    userinfo[PytwisConst.FOLLOWINGS] = result[PytwisConst.FOLLOWING_LIST]
+
+    _, result = await g_pytwis.count_followers(auth)
+    userinfo[PytwisConst.FOLLOWER_CNT] = result[PytwisConst.FOLLOWER_CNT]
+    _, result = await g_pytwis.count_following(auth)
+    userinfo[PytwisConst.FOLLOWING_CNT] = result[PytwisConst.FOLLOWING_CNT]
+
+    return jsonify({'userinfo': userinfo})
+
+@app.route(HTTP_INDEX_URL+'users', methods=['PUT'])
+async def update_user():
+    request_json = await request.get_json()
+    if not request_json:
+        abort(400)
+    auth, error_response = await authenticate(request_json)
+    if error_response is not None:
+        return error_response
+
+    succeeded = False
+    result = {'error': "Unknown operation"}
+    if 'added_follower' in request_json:
+        succeeded, result = await g_pytwis.follow(auth, request_json['added_follower'])
+    elif 'removed_follower' in request_json:
+        succeeded, result = await g_pytwis.unfollow(auth, request_json['removed_follower'])
+    elif PytwisConst.NEW_PASSWORD in request_json and PytwisConst.PASSWORD in request_json:
+        succeeded, result = await g_pytwis.change_password(auth, request_json[PytwisConst.PASSWORD],
+                                                           request_json[PytwisConst.NEW_PASSWORD])
+
+    if succeeded:
+        return await make_response(jsonify(result), 200)
+    else:
+        return await make_response(jsonify(process_error(result)), 404)
+
+@app.route(HTTP_INDEX_URL+'posts', methods=['POST'])
+async def add_post():
+    request_json = await request.get_json()
+    if not request_json or not 'tweet_content' in request_json:
+        abort(400)
+    auth, error_response = await authenticate(request_json)
+    if error_response is not None:
+        return error_response
+
+    succeeded, result = await g_pytwis.post_tweet(auth, request_json['tweet_content'])
+    if succeeded:
+        return await make_response(jsonify(result), 200)
+    else:
+        return await make_response(jsonify(process_error(result)), 404)
+
+@app.route(HTTP_INDEX_URL+'posts', methods=['GET'])
+async def get_timeline():
+    request_json = await request.get_json()
+    if request_json is None:
+        abort(400)
+    auth, error_response = await authenticate(request_json)
+    if error_response is not None:
+        return error_response
+
+    if PytwisConst.PAGE_SIZE in request_json:
+        succeeded, result = await g_pytwis.get_timeline_page(auth, get_int_arg(request_json, PytwisConst.PAGE_SIZE),
+                                                             get_int_arg(request_json, PytwisConst.MAX_ID),
+                                                             get_int_arg(request_json, PytwisConst.SINCE_ID))
+    else:
+        succeeded, result = await g_pytwis.get_timeline(auth, int(request_json.get(PytwisConst.MAX_TWEET_CNT,
+                                                                                   g_pytwis.GENERAL_TIMELINE_MAX_POST_CNT)))
+    if succeeded:
+        return await make_response(jsonify(result), 200)
+    else:
+        return await make_response(jsonify(process_error(result)), 404)
+
+def get_int_arg(request_json, name, default=None):
+    # Get an integer argument of the JSON request, or abort with 400 if it isn't one.
+    value = request_json.get(name, default)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        abort(400)
+
+def process_error(server_result):
+    errorinfo = {
+        'server_msg': server_result['error'],
+        'timestamp': time.time()
+    }
+    return errorinfo
+
+def pytwis_async_rest():
+    parser = argparse.ArgumentParser(description= \
+                                         'Connect to the Redis database of a Twitter clone and '
+                                         'then serve its asynchronous REST API.')
+    add_redis_arguments(parser, hostname_option='-d', replication=False)
+    parser.add_argument('-a', '--async-fanout', dest='async_fanout', action='store_true',
+                        help='leave the fanout of new tweets to pytwis_fanout_worker.py instead of '
+                             'doing it in the request.')
+    parser.add_argument('-m', '--user-timeline-max-post-cnt', dest='user_timeline_max_post_cnt',
+                        type=int, default=None,
+                        help='the number of the latest tweets retained in each user timeline. '
+                             'If not specified, the user timelines will not be trimmed.')
+    parser.add_argument('--post-storage', dest='post_storage', default='hash',
+                        choices=['hash', 'packed', 'bucketed'],
+                        help='how to store the new tweets. If not specified, will be defaulted to hash.')
+    parser.add_argument('--password-scrypt-n', dest='password_scrypt_n', type=int, default=None,
+                        help='the scrypt CPU/memory cost (a power of 2, e.g., 16384) of hashing the passwords. '
+                             'If not specified, the passwords will be stored raw.')
+    parser.add_argument('--password-scrypt-r', dest='password_scrypt_r', type=int, default=8,
+                        help='the scrypt block size. If not specified, will be defaulted to 8.')
+    parser.add_argument('--password-scrypt-p', dest='password_scrypt_p', type=int, default=1,
+                        help='the scrypt parallelization. If not specified, will be defaulted to 1.')
+    parser.add_argument('--password-hash-workers', dest='password_hash_workers', type=int, default=None,
+                        help='the number of processes hashing the passwords, or 0 to hash in the request. '
+                             'If not specified, will be defaulted to the number of CPUs.')
+    parser.add_argument('--post-events', dest='post_events', action='store_true',
+                        help='publish the new tweets to the post event streams read by the /events '
+                             'route of pytwis_flask.py.')
+
+    args = parser.parse_args()
+
+    print('The input Redis server hostname is {}.'.format(args.redis_hostname))
+    print('The input Redis server port is {}.'.format(args.redis_port))
+
+    g_pytwis_args.update(redis_connection_kwargs(args, replication=False))
+    g_pytwis_args.update(async_fanout=args.async_fanout,
+                         user_timeline_max_post_cnt=args.user_timeline_max_post_cnt,
+                         post_storage=args.post_storage,
+                         password_scrypt_n=args.password_scrypt_n,
+                         password_scrypt_r=args.password_scrypt_r,
+                         password_scrypt_p=args.password_scrypt_p,
+                         password_hash_workers=args.password_hash_workers,
+                         post_events=args.post_events)
+
+if __name__ == '__main__':
+    pytwis_async_rest()
+    try:
+        app.run()
+    except ValueError as e:
+        print('Failed to connect to the Redis server: {}'.format(str(e)),
+              file=sys.stderr)
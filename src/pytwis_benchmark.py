@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmark for pytwis
+#
+# Generates a synthetic social graph in a Redis database and then drives a mix
+# of Pytwis calls against it from several threads or processes. Each user
+# follows the same number of users, picked with Zipf weights, so the follower
+# counts follow a power law with a few celebrities like a real social graph.
+#
+# The throughput and the p50/p95/p99 latencies of each method are printed as
+# JSON, together with the configuration and the git commit, so that the runs
+# can be compared across commits.
+#
+# How to run:
+#   python3 pytwis_benchmark.py -d 14 --flushdb --users 10000 --workers 8 \
+#       --mix get_timeline=80,login=10,post_tweet=5,follow=5 -o result.json
+#
+# or to benchmark the logins with the passwords hashed by scrypt:
+#   python3 pytwis_benchmark.py -d 14 --flushdb --users 1000 --workers 8 \
+#       --mix login=100 --password-scrypt-n 16384 -o login.json
+#
+# Note that the benchmark database is flushed by --flushdb, so never point it
+# to a database in use.
+#
+
+import argparse
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import math
+import random
+import subprocess
+import sys
+import time
+
+import pytwis
+
+
+BENCHMARK_PASSWORD = 'password'
+
+BENCHMARK_METHODS = ['post_tweet', 'get_timeline', 'follow', 'login']
+
+
+def zipf_cum_weights(cnt, exponent):
+    # The cumulative weights of picking the user of each rank, for random.choices.
+    return list(itertools.accumulate(1.0 / (rank + 1) ** exponent for rank in range(cnt)))
+
+
+def generate_graph(twis, user_cnt, follow_cnt, tweet_cnt, zipf_exponent, seed):
+    # Register user_cnt users, let each of them follow follow_cnt users picked by the Zipf
+    # weights, and post tweet_cnt tweets by the authors picked by the same weights.
+    # Return the usernames and the authentication secrets.
+    rng = random.Random(seed)
+    usernames = ['user{}'.format(index) for index in range(user_cnt)]
+    auth_secrets = [result[pytwis.PytwisConst.AUTH]
+                    for _, result in twis.register_many([(username, BENCHMARK_PASSWORD)
+                                                         for username in usernames])]
+
+    cum_weights = zipf_cum_weights(user_cnt, zipf_exponent)
+    follows = []
+    for index in range(user_cnt):
+        followee_indexes = set(rng.choices(range(user_cnt), cum_weights=cum_weights,
+                                           k=min(follow_cnt, user_cnt - 1)))
+        followee_indexes.discard(index)
+        follows += [(auth_secrets[index], usernames[followee_index])
+                    for followee_index in followee_indexes]
+    twis.follow_many(follows)
+
+    twis.post_tweets([(auth_secrets[author_index], 'tweet {}'.format(tweet_index))
+                      for tweet_index, author_index in enumerate(rng.choices(range(user_cnt),
+                                                                             cum_weights=cum_weights,
+                                                                             k=tweet_cnt))])
+
+    return usernames, auth_secrets
+
+
+def connect(pytwis_kwargs):
+    # Keep the connection messages out of the JSON result printed to stdout.
+    with contextlib.redirect_stdout(sys.stderr):
+        return pytwis.Pytwis(**pytwis_kwargs)
+
+
+def run_worker(worker_args):
+    # Call the methods picked by the mix for duration seconds and return the latencies
+    # (in seconds) and the error count of each method.
+    pytwis_kwargs, usernames, auth_secrets, mix, duration, zipf_exponent, seed = worker_args
+    twis = connect(pytwis_kwargs)
+    rng = random.Random(seed)
+    cum_weights = zipf_cum_weights(len(usernames), zipf_exponent)
+    methods = list(mix.keys())
+    method_weights = list(mix.values())
+
+    latencies = {method: [] for method in methods}
+    error_cnts = {method: 0 for method in methods}
+    end_time = time.perf_counter() + duration
+    while time.perf_counter() < end_time:
+        method = rng.choices(methods, weights=method_weights)[0]
+        index = rng.randrange(len(usernames))
+        if method == 'post_tweet':
+            call = lambda: twis.post_tweet(auth_secrets[index], 'benchmark tweet')
+        elif method == 'get_timeline':
+            call = lambda: twis.get_timeline(auth_secrets[index], pytwis.Pytwis.GENERAL_TIMELINE_MAX_POST_CNT)
+        elif method == 'follow':
+            followee_index = rng.choices(range(len(usernames)), cum_weights=cum_weights)[0]
+            call = lambda: twis.follow(auth_secrets[index], usernames[followee_index])
+        else:
+            call = lambda: twis.login(usernames[index], BENCHMARK_PASSWORD)
+
+        start_time = time.perf_counter()
+        succeeded, _ = call()
+        latencies[method].append(time.perf_counter() - start_time)
+        if not succeeded:
+            error_cnts[method] += 1
+
+    return latencies, error_cnts
+
+
+def percentile(sorted_values, percent):
+    # The nearest-rank percentile of a sorted list.
+    if len(sorted_values) == 0:
+        return None
+    rank = max(1, math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(worker_results, duration):
+    summary = {}
+    for method in BENCHMARK_METHODS:
+        latencies = sorted(itertools.chain.from_iterable(latencies.get(method, [])
+                                                         for latencies, _ in worker_results))
+        if len(latencies) == 0:
+            continue
+        summary[method] = {
+            'count': len(latencies),
+            'errors': sum(error_cnts.get(method, 0) for _, error_cnts in worker_results),
+            'throughput': len(latencies) / duration,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000}
+    return summary
+
+
+def parse_mix(mix):
+    # Parse a mix like 'get_timeline=80,post_tweet=20' into {method: weight}.
+    weights = {}
+    for item in mix.split(','):
+        method, _, weight = item.partition('=')
+        if method not in BENCHMARK_METHODS or not weight.isdigit():
+            raise argparse.ArgumentTypeError('{} is not in the form of method=weight with a method in {}'.format(
+                item, ', '.join(BENCHMARK_METHODS)))
+        weights[method] = int(weight)
+    return weights
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def pytwis_benchmark():
+    parser = argparse.ArgumentParser(description= \
+                                         'Generate a synthetic social graph for a Twitter clone and '
+                                         'measure the throughput and the latencies of its methods.')
+    parser.add_argument('-n', '--hostname', dest='redis_hostname', default='127.0.0.1',
+                        help='the Redis server hostname. If not specified, will be defaulted to 127.0.0.1.')
+    parser.add_argument('-t', '--port', dest='redis_port', type=int, default=6379,
+                        help='the Redis server port. If not specified, will be defaulted to 6379.')
+    parser.add_argument('-d', '--database', dest='redis_database', type=int, default=14,
+                        help='the Redis server database. If not specified, will be defaulted to 14.')
+    parser.add_argument('-p', '--password', dest='redis_password', default='',
+                        help='the Redis server password. If not specified, will be defaulted to an empty string.')
+    parser.add_argument('--flushdb', dest='flushdb', action='store_true',
+                        help='flush the database before generating the graph. Required if the database isn\'t empty.')
+    parser.add_argument('--users', dest='user_cnt', type=int, default=1000,
+                        help='the number of users. If not specified, will be defaulted to 1000.')
+    parser.add_argument('--follows', dest='follow_cnt', type=int, default=50,
+                        help='the number of users followed by each user. If not specified, will be defaulted to 50.')
+    parser.add_argument('--tweets', dest='tweet_cnt', type=int, default=10000,
+                        help='the number of tweets posted before the benchmark. '
+                             'If not specified, will be defaulted to 10000.')
+    parser.add_argument('--zipf-exponent', dest='zipf_exponent', type=float, default=1.0,
+                        help='the exponent of the Zipf weights of picking a user to follow. '
+                             'If not specified, will be defaulted to 1.0.')
+    parser.add_argument('--mix', dest='mix', type=parse_mix,
+                        default='get_timeline=80,login=10,post_tweet=5,follow=5',
+                        help='the relative weights of the benchmarked methods. '
+                             'If not specified, will be defaulted to get_timeline=80,login=10,post_tweet=5,follow=5.')
+    parser.add_argument('--workers', dest='worker_cnt', type=int, default=4,
+                        help='the number of concurrent workers. If not specified, will be defaulted to 4.')
+    parser.add_argument('--processes', dest='processes', action='store_true',
+                        help='run the workers in processes instead of threads.')
+    parser.add_argument('--duration', dest='duration', type=float, default=30,
+                        help='the seconds to run the workers. If not specified, will be defaulted to 30.')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='the random seed. If not specified, will be defaulted to 0.')
+    parser.add_argument('-l', '--lua-scripts', dest='lua_scripts', action='store_true',
+                        help='run the session checks and post_tweet as server-side Lua scripts.')
+    parser.add_argument('--celebrity-follower-threshold', dest='celebrity_follower_threshold',
+                        type=int, default=None,
+                        help='the follower count from which the tweets of a user are merged at read time.')
+    parser.add_argument('-m', '--user-timeline-max-post-cnt', dest='user_timeline_max_post_cnt',
+                        type=int, default=None,
+                        help='the number of the latest tweets retained in each user timeline.')
+    parser.add_argument('-c', '--username-cache-size', dest='username_cache_size', type=int, default=0,
+                        help='the max number of usernames cached in process.')
+    parser.add_argument('--session-cache-size', dest='session_cache_size', type=int, default=0,
+                        help='the max number of authentication secrets cached in process.')
+    parser.add_argument('--password-scrypt-n', dest='password_scrypt_n', type=int, default=None,
+                        help='the scrypt CPU/memory cost (a power of 2, e.g., 16384) of hashing the passwords. '
+                             'If not specified, the passwords will be stored raw.')
+    parser.add_argument('--password-scrypt-r', dest='password_scrypt_r', type=int, default=8,
+                        help='the scrypt block size. If not specified, will be defaulted to 8.')
+    parser.add_argument('--password-scrypt-p', dest='password_scrypt_p', type=int, default=1,
+                        help='the scrypt parallelization. If not specified, will be defaulted to 1.')
+    parser.add_argument('--password-hash-workers', dest='password_hash_workers', type=int, default=None,
+                        help='the number of processes hashing the passwords, or 0 to hash in the worker. '
+                             'If not specified, will be defaulted to the number of CPUs.')
+    parser.add_argument('-o', '--output', dest='output_path', default=None,
+                        help='the file to write the JSON result to. If not specified, will be printed.')
+
+    args = parser.parse_args()
+
+    pytwis_kwargs = {'hostname': args.redis_hostname,
+                     'port': args.redis_port,
+                     'db': args.redis_database,
+                     'password': args.redis_password,
+                     'lua_scripts': args.lua_scripts,
+                     'celebrity_follower_threshold': args.celebrity_follower_threshold,
+                     'user_timeline_max_post_cnt': args.user_timeline_max_post_cnt,
+                     'username_cache_size': args.username_cache_size,
+                     'session_cache_size': args.session_cache_size,
+                     'password_scrypt_n': args.password_scrypt_n,
+                     'password_scrypt_r': args.password_scrypt_r,
+                     'password_scrypt_p': args.password_scrypt_p,
+                     'password_hash_workers': args.password_hash_workers}
+    try:
+        twis = connect(pytwis_kwargs)
+    except ValueError as e:
+        print('Failed to connect to the Redis server: {}'.format(str(e)),
+              file=sys.stderr)
+        return -1
+
+    if args.flushdb:
+        twis._rc.flushdb()
+    elif twis._rc.dbsize() > 0:
+        print('The database {} isn\'t empty. Pass --flushdb to flush it.'.format(args.redis_database),
+              file=sys.stderr)
+        return -1
+
+    start_time = time.perf_counter()
+    usernames, auth_secrets = generate_graph(twis, args.user_cnt, args.follow_cnt, args.tweet_cnt,
+                                             args.zipf_exponent, args.seed)
+    generation_seconds = time.perf_counter() - start_time
+    print('Generated the graph in {:.1f} seconds.'.format(generation_seconds), file=sys.stderr)
+
+    if args.processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.worker_cnt)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.worker_cnt)
+    with executor:
+        worker_results = list(executor.map(run_worker,
+                                           [(pytwis_kwargs, usernames, auth_secrets, args.mix, args.duration,
+                                             args.zipf_exponent, args.seed + worker_index + 1)
+                                            for worker_index in range(args.worker_cnt)]))
+
+    config = {name: value for name, value in vars(args).items()
+              if name not in ('redis_password', 'output_path')}
+    result = {'git_commit': get_git_commit(),
+              'timestamp': time.time(),
+              'config': config,
+              'generation_seconds': generation_seconds,
+              'methods': summarize(worker_results, args.duration)}
+
+    if args.output_path is None:
+        print(json.dumps(result, indent=2))
+    else:
+        with open(args.output_path, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    pytwis_benchmark()
@@ -222,19 +222,102 @@ def pytwis_command_processor(twis, auth_secret, command_with_args):
     else:
         pass
 
+def parse_redis_endpoint(endpoint):
+    hostname, _, port = endpoint.rpartition(':')
+    if hostname == '' or not port.isdigit():
+        raise argparse.ArgumentTypeError('{} is not in the form of hostname:port'.format(endpoint))
+    return (hostname, int(port))
+
+def add_redis_arguments(parser, hostname_option='-n', replication=True):
+    # Add the Redis connection options shared by the command line interface and the REST 
+    # servers, which keep -d for the hostname. The options of the Cluster, the replicas and 
+    # the Sentinels are left out with replication=False, e.g., for AsyncPytwis.
+    parser.add_argument(hostname_option, '--hostname', dest='redis_hostname', default='127.0.0.1',
+                        help='the Redis server hostname. If not specified, will be defaulted to 127.0.0.1.')
+    parser.add_argument('-t', '--port', dest='redis_port', default=6379,
+                        help='the Redis server port. If not specified, will be defaulted to 6379.')
+    parser.add_argument('-p', '--password', dest='redis_password', default='',
+                        help='the Redis server password. If not specified, will be defaulted to an empty string.')
+    parser.add_argument('-s', '--socket', dest='redis_socket', default=None,
+                        help='the Redis server Unix domain socket path, e.g., /tmp/redis.sock. '
+                             'If specified, the hostname and the port will be ignored.')
+    parser.add_argument('--max-connections', dest='redis_max_connections', type=int, default=None,
+                        help='the max number of Redis connections. If specified, a request waits for '
+                             'a free connection instead of opening a new one when all are in use.')
+    parser.add_argument('--pool-timeout', dest='redis_pool_timeout', type=int, default=20,
+                        help='the seconds to wait for a free Redis connection. '
+                             'If not specified, will be defaulted to 20.')
+    parser.add_argument('--keepalive', dest='redis_socket_keepalive', action='store_true',
+                        help='enable TCP keepalive on the Redis connections.')
+    parser.add_argument('--health-check-interval', dest='redis_health_check_interval', type=int, default=0,
+                        help='the seconds after which an idle Redis connection is checked before use. '
+                             'If not specified, will be defaulted to 0 (no health check).')
+    if not replication:
+        return
+    parser.add_argument('--prewarm-connections', dest='redis_prewarm_connections', type=int, default=0,
+                        help='the number of Redis connections opened at startup. '
+                             'If not specified, will be defaulted to 0.')
+    parser.add_argument('--cluster', dest='redis_cluster', action='store_true',
+                        help='connect to a Redis Cluster via the node at the hostname and the port.')
+    parser.add_argument('--replica', dest='redis_replicas', action='append', type=parse_redis_endpoint,
+                        help='a Redis replica as hostname:port which serves the read-only requests. '
+                             'Can be given multiple times.')
+    parser.add_argument('--sentinel', dest='redis_sentinels', action='append', type=parse_redis_endpoint,
+                        help='a Redis Sentinel as hostname:port which discovers the primary and its replicas. '
+                             'Can be given multiple times.')
+    parser.add_argument('--sentinel-service', dest='redis_sentinel_service', default='mymaster',
+                        help='the service name monitored by the Sentinels. '
+                             'If not specified, will be defaulted to mymaster.')
+    parser.add_argument('--replica-selection', dest='redis_replica_selection', default='round_robin',
+                        choices=['round_robin', 'least_latency'],
+                        help='how to pick a replica for a read-only request. '
+                             'If not specified, will be defaulted to round_robin.')
+
+def redis_connection_kwargs(args, replication=True):
+    # The Pytwis keyword arguments of the options added by add_redis_arguments.
+    kwargs = {'hostname': args.redis_hostname,
+              'port': args.redis_port,
+              'password': args.redis_password,
+              'unix_socket_path': args.redis_socket,
+              'max_connections': args.redis_max_connections,
+              'pool_timeout': args.redis_pool_timeout,
+              'socket_keepalive': args.redis_socket_keepalive,
+              'health_check_interval': args.redis_health_check_interval}
+    if replication:
+        kwargs.update(prewarm_connections=args.redis_prewarm_connections,
+                      cluster=args.redis_cluster,
+                      replicas=args.redis_replicas,
+                      sentinels=args.redis_sentinels,
+                      sentinel_service_name=args.redis_sentinel_service,
+                      replica_selection=args.redis_replica_selection)
+    return kwargs
+
 def pytwis_cli_init():
     # TODO: Add epilog for the help information about online commands after connecting to the Twitter clone.
     parser = argparse.ArgumentParser(description= \
                                          'Connect to the Redis database of a Twitter clone and '
                                          'then run commands to access and update the database.')
-    parser.add_argument('-n', '--hostname', dest='redis_hostname', default='127.0.0.1',
-                        help='the Redis server hostname. If not specified, will be defaulted to 127.0.0.1.')
-    parser.add_argument('-t', '--port', dest='redis_port', default=6379,
-                        help='the Redis server port. If not specified, will be defaulted to 6379.')
+    add_redis_arguments(parser)
     parser.add_argument('-d', '--database', dest='redis_database', default=0,
                         help='the Redis server database. If not specified, will be defaulted to 0.')
-    parser.add_argument('-p', '--password', dest='redis_password', default='',
-                        help='the Redis server password. If not specified, will be defaulted to an empty string.')
+    parser.add_argument('--post-storage', dest='post_storage', default='hash',
+                        choices=['hash', 'packed', 'bucketed'],
+                        help='how to store the new tweets. If not specified, will be defaulted to hash.')
+    parser.add_argument('--password-scrypt-n', dest='password_scrypt_n', type=int, default=None,
+                        help='the scrypt CPU/memory cost (a power of 2, e.g., 16384) of hashing the passwords. '
+                             'If not specified, the passwords will be stored raw.')
+    parser.add_argument('--password-scrypt-r', dest='password_scrypt_r', type=int, default=8,
+                        help='the scrypt block size. If not specified, will be defaulted to 8.')
+    parser.add_argument('--password-scrypt-p', dest='password_scrypt_p', type=int, default=1,
+                        help='the scrypt parallelization. If not specified, will be defaulted to 1.')
+    parser.add_argument('--password-hash-workers', dest='password_hash_workers', type=int, default=None,
+                        help='the number of processes hashing the passwords, or 0 to hash in the request. '
+                             'If not specified, will be defaulted to the number of CPUs.')
+    parser.add_argument('--metrics', dest='metrics', action='store_true',
+                        help='record the metrics of the Pytwis methods, e.g., for the /metrics route of pytwis_flask.py.')
+    parser.add_argument('--post-events', dest='post_events', action='store_true',
+                        help='publish the new tweets to the post event streams read by the /events '
+                             'route of pytwis_flask.py.')
 
     args = parser.parse_args()
 
@@ -247,7 +330,15 @@ def pytwis_cli_init():
         print('The input Redis server password is empty.')
 
     try:
-        return pytwis.Pytwis(args.redis_hostname, args.redis_port, args.redis_database, args.redis_password), args
+        return pytwis.Pytwis(db=args.redis_database,
+                             **redis_connection_kwargs(args),
+                             metrics=args.metrics,
+                             post_storage=args.post_storage,
+                             password_scrypt_n=args.password_scrypt_n,
+                             password_scrypt_r=args.password_scrypt_r,
+                             password_scrypt_p=args.password_scrypt_p,
+                             password_hash_workers=args.password_hash_workers,
+                             post_events=args.post_events), args
     except ValueError as e:
         print('Failed to connect to the Redis server: {}'.format(str(e)),
               file=sys.stderr)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Fanout worker for pytwis
+#
+# When a Pytwis instance is created with async_fanout=True, post_tweet only
+# appends a fanout job (post_id, userid) to the Redis Stream Pytwis.FANOUT_STREAM_KEY.
+# This worker consumes the stream as a member of a consumer group and pushes
+# the tweet into the timelines of the author's followers in batched pipelines.
+#
+# Every job is acknowledged only after all the followers are done, so a job
+# of a crashed worker is redelivered (at-least-once). The (score, member) of
+# the last follower of each job is committed in the same MULTI as the batch of
+# pushes (in the same pipeline in the cluster mode), so a redelivered job
+# resumes after the last committed batch instead of pushing the tweet twice,
+# even if some followers have unfollowed the author in the meantime.
+#
+# A worker which loses its Redis connection backs off and retries. The jobs
+# it was processing stay pending and are claimed again after min_idle_ms.
+#
+# How to run:
+# Start as many workers as needed with distinct consumer names, e.g.,
+#   python3 pytwis_fanout_worker.py -c worker1
+#   python3 pytwis_fanout_worker.py -c worker2
+#
+
+import argparse
+import socket
+import sys
+import time
+
+from redis.exceptions import RedisError, ResponseError
+
+import pytwis
+
+
+class PytwisFanoutWorker:
+
+    FANOUT_CONSUMER_GROUP = 'fanout_workers'
+
+    # Hash: fanout job ID -> 'score:member' of the last follower the tweet has been pushed to.
+    FANOUT_PROGRESS_HASH_KEY = 'fanout_progress'
+
+    # After a Redis error, the worker waits RETRY_BACKOFF_MIN_SECONDS, doubled on every
+    # consecutive error up to RETRY_BACKOFF_MAX_SECONDS.
+    RETRY_BACKOFF_MIN_SECONDS = 0.1
+    RETRY_BACKOFF_MAX_SECONDS = 30
+
+    # Jobs delivered more than MAX_DELIVERY_CNT times are moved to this stream.
+    FANOUT_DEAD_LETTER_STREAM_KEY = 'fanout_dead_letter'
+
+    def __init__(self, twis, consumer_name, batch_size=1000, read_cnt=10,
+                 block_ms=5000, min_idle_ms=60000, max_delivery_cnt=5):
+        self._twis = twis
+        self._rc = twis._rc
+        self._consumer_name = consumer_name
+        self._batch_size = batch_size
+        self._read_cnt = read_cnt
+        self._block_ms = block_ms
+        self._min_idle_ms = min_idle_ms
+        self._max_delivery_cnt = max_delivery_cnt
+        self._stopped = False
+
+        self._create_consumer_group()
+
+    def _create_consumer_group(self):
+        try:
+            self._rc.xgroup_create(self._twis.FANOUT_STREAM_KEY, self.FANOUT_CONSUMER_GROUP,
+                                   id='0', mkstream=True)
+        except ResponseError as e:
+            # The consumer group has been created by another worker.
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    def _claim_stale_jobs(self):
+        # Take over the jobs which have been pending too long, e.g., because their worker crashed.
+        stale_job_ids = []
+        for pending_job in self._rc.xpending_range(self._twis.FANOUT_STREAM_KEY, self.FANOUT_CONSUMER_GROUP,
+                                                   '-', '+', self._read_cnt):
+            if pending_job['time_since_delivered'] < self._min_idle_ms:
+                continue
+
+            if pending_job['times_delivered'] > self._max_delivery_cnt:
+                self._dead_letter(pending_job['message_id'])
+            else:
+                stale_job_ids.append(pending_job['message_id'])
+
+        if len(stale_job_ids) == 0:
+            return []
+
+        return self._rc.xclaim(self._twis.FANOUT_STREAM_KEY, self.FANOUT_CONSUMER_GROUP,
+                               self._consumer_name, self._min_idle_ms, stale_job_ids)
+
+    def _read_new_jobs(self):
+        streams = self._rc.xreadgroup(self.FANOUT_CONSUMER_GROUP, self._consumer_name,
+                                      {self._twis.FANOUT_STREAM_KEY: '>'},
+                                      count=self._read_cnt, block=self._block_ms)
+        if not streams:
+            return []
+
+        _, jobs = streams[0]
+        return jobs
+
+    def _dead_letter(self, job_id):
+        jobs = self._rc.xrange(self._twis.FANOUT_STREAM_KEY, job_id, job_id)
+        with self._twis._pipeline() as pipe:
+            for _, job in jobs:
+                pipe.xadd(self.FANOUT_DEAD_LETTER_STREAM_KEY, job)
+            self._finish_job(pipe, job_id)
+            pipe.execute()
+
+        print('Moved fanout job {} to {}'.format(job_id, self.FANOUT_DEAD_LETTER_STREAM_KEY),
+              file=sys.stderr)
+
+    def _finish_job(self, pipe, job_id):
+        pipe.xack(self._twis.FANOUT_STREAM_KEY, self.FANOUT_CONSUMER_GROUP, job_id)
+        pipe.xdel(self._twis.FANOUT_STREAM_KEY, job_id)
+        pipe.hdel(self.FANOUT_PROGRESS_HASH_KEY, job_id)
+
+    def _get_follower_batch(self, follower_zset_key, cursor):
+        # Get the next batch of (follower_user_id, score) after cursor, the (score, member) of the
+        # last follower of the previous batch or None. Unlike a rank, the cursor isn't shifted when
+        # an earlier follower unfollows. The followers with the same score are ordered by member.
+        if cursor is None:
+            return self._rc.zrangebyscore(follower_zset_key, '-inf', '+inf', start=0, num=self._batch_size,
+                                          withscores=True, score_cast_func=str)
+
+        last_score, last_follower_user_id = cursor
+        followers = [(follower_user_id, score)
+                     for follower_user_id, score in self._rc.zrangebyscore(follower_zset_key, last_score, last_score,
+                                                                           withscores=True, score_cast_func=str)
+                     if follower_user_id > last_follower_user_id][:self._batch_size]
+        if len(followers) < self._batch_size:
+            followers += self._rc.zrangebyscore(follower_zset_key, '({}'.format(last_score), '+inf',
+                                                start=0, num=self._batch_size - len(followers),
+                                                withscores=True, score_cast_func=str)
+        return followers
+
+    def process_job(self, job_id, job):
+        post_id = job[self._twis.FANOUT_STREAM_POST_ID_KEY]
+        user_id = job[self._twis.FANOUT_STREAM_USERID_KEY]
+        follower_zset_key = self._twis.FOLLOWER_ZSET_KEY_FORMAT.format(user_id)
+
+        # Resume after the last committed batch if the job is redelivered.
+        progress = self._rc.hget(self.FANOUT_PROGRESS_HASH_KEY, job_id)
+        cursor = tuple(progress.split(':', 1)) if progress is not None else None
+
+        with self._twis._pipeline() as pipe:
+            while True:
+                followers = self._get_follower_batch(follower_zset_key, cursor)
+                follower_user_ids = [follower_user_id for follower_user_id, _ in followers]
+
+                # Skip the followers which have the post already, e.g., backfilled by their follow.
+                self._twis._fanout_post(pipe, post_id, 
+                                        self._twis._get_user_ids_without_post(follower_user_ids, post_id))
+                if len(follower_user_ids) < self._batch_size:
+                    self._finish_job(pipe, job_id)
+                    pipe.execute()
+                    return
+
+                last_follower_user_id, last_score = followers[-1]
+                cursor = (last_score, last_follower_user_id)
+                pipe.hset(self.FANOUT_PROGRESS_HASH_KEY, job_id, '{}:{}'.format(*cursor))
+                pipe.execute()
+
+    def process_once(self):
+        jobs = self._claim_stale_jobs() + self._read_new_jobs()
+        for job_id, job in jobs:
+            try:
+                self.process_job(job_id, job)
+            except ResponseError as e:
+                # Leave the job pending so that it will be retried after min_idle_ms.
+                print('Failed to process fanout job {}: {}'.format(job_id, str(e)), file=sys.stderr)
+
+        return len(jobs)
+
+    def run(self):
+        backoff_seconds = 0
+        while not self._stopped:
+            try:
+                self.process_once()
+                backoff_seconds = 0
+            except RedisError as e:
+                # E.g., the connection is lost. The jobs in progress stay pending.
+                backoff_seconds = min(max(2 * backoff_seconds, self.RETRY_BACKOFF_MIN_SECONDS),
+                                      self.RETRY_BACKOFF_MAX_SECONDS)
+                print('Failed to process the fanout jobs, retrying in {} seconds: {}'.format(
+                    backoff_seconds, str(e)), file=sys.stderr)
+                time.sleep(backoff_seconds)
+
+    def stop(self):
+        self._stopped = True
+
+
+def pytwis_fanout_worker():
+    parser = argparse.ArgumentParser(description= \
+                                         'Consume the fanout jobs of a Twitter clone and push '
+                                         'the tweets into the timelines of the followers.')
+    parser.add_argument('-n', '--hostname', dest='redis_hostname', default='127.0.0.1',
+                        help='the Redis server hostname. If not specified, will be defaulted to 127.0.0.1.')
+    parser.add_argument('-t', '--port', dest='redis_port', default=6379,
+                        help='the Redis server port. If not specified, will be defaulted to 6379.')
+    parser.add_argument('-d', '--database', dest='redis_database', default=0,
+                        help='the Redis server database. If not specified, will be defaulted to 0.')
+    parser.add_argument('-p', '--password', dest='redis_password', default='',
+                        help='the Redis server password. If not specified, will be defaulted to an empty string.')
+    parser.add_argument('-c', '--consumer', dest='consumer_name', default=socket.gethostname(),
+                        help='the unique name of this worker in the consumer group. '
+                             'If not specified, will be defaulted to the host name.')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+                        help='the number of followers updated per pipeline. '
+                             'If not specified, will be defaulted to 1000.')
+    parser.add_argument('-m', '--user-timeline-max-post-cnt', dest='user_timeline_max_post_cnt',
+                        type=int, default=None,
+                        help='the number of the latest tweets retained in each user timeline. '
+                             'If not specified, the user timelines will not be trimmed.')
+    parser.add_argument('--cluster', dest='redis_cluster', action='store_true',
+                        help='connect to a Redis Cluster via the node at the hostname and the port.')
+    parser.add_argument('--post-events', dest='post_events', action='store_true',
+                        help='publish the tweets pushed into the timelines to the post event streams. '
+                             'Needed if the front ends are run with --post-events.')
+
+    args = parser.parse_args()
+
+    try:
+        twis = pytwis.Pytwis(args.redis_hostname, args.redis_port, args.redis_database, args.redis_password,
+                             user_timeline_max_post_cnt=args.user_timeline_max_post_cnt,
+                             cluster=args.redis_cluster,
+                             post_events=args.post_events)
+    except ValueError as e:
+        print('Failed to connect to the Redis server: {}'.format(str(e)),
+              file=sys.stderr)
+        return -1
+
+    worker = PytwisFanoutWorker(twis, args.consumer_name, batch_size=args.batch_size)
+    print('Fanout worker {} is running.'.format(args.consumer_name))
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        print('Fanout worker {} is exiting.'.format(args.consumer_name))
+
+    return 0
+
+
+if __name__ == '__main__':
+    pytwis_fanout_worker()
@@ -1,10 +1,13 @@
 import datetime
-from flask import Flask
+from flask import Flask, Response
+import itertools
 import json
+import logging
 from pytwis_clt import pytwis_cli_init
 from pytwis import Pytwis
 from pytwis import PytwisConst
-from flask import request
+from pytwis import STREAM_ENTRY_ID_REGEX
+from flask import request, abort, make_response
 
 
 ## Todo
@@ -24,15 +27,38 @@ from flask import request
 ## Commands
 # Init
 # http://127.0.0.1:4000/init?server=<ip_address>&port=<port>&password=<password>
+# Add &post_events=1 to publish the new tweets to /events
 # Tweet
 # http://127.0.0.1:4000/pytwis?cmd=register&username=bjlee3&password=test3
 # http://127.0.0.1:4000/pytwis?cmd=login&username=bjlee3&password=test3
 # http://127.0.0.1:4000/pytwis?cmd=followers&auth=<auth_key>
 # http://127.0.0.1:4000/pytwis?cmd=post&tweet=test12345&auth=<auth_key>
 # http://127.0.0.1:4000/pytwis?cmd=timeline&auth=<auth_key>
+# http://127.0.0.1:4000/pytwis?cmd=timeline&auth=<auth_key>&page_size=20&max_id=<next_max_id>
+# http://127.0.0.1:4000/pytwis?cmd=timeline&auth=<auth_key>&page_size=20&since_id=<next_since_id>
+# Metrics (Prometheus text format, if started with --metrics)
+# http://127.0.0.1:4000/metrics
+# New tweets of the user timeline as Server-Sent Events (if started with --post-events),
+# resumed after the Last-Event-ID header of a reconnecting EventSource or the last_event_id parameter
+# http://127.0.0.1:4000/events?auth=<auth_key>
+#
+# Without page_size, the timeline, followers and followings commands stream their
+# lists as newline-delimited JSON, one object per tweet or per {"followers": username}
+# or {"followings": username}, while they are read from Redis if the request has
+# the header "Accept: application/x-ndjson". The responses are logged at the DEBUG
+# level of the pytwis_flask logger.
 
 app = Flask(__name__)
 
+logger = logging.getLogger(__name__)
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# How long an /events request waits for new tweets before sending a keepalive comment,
+# which also detects the disconnected clients. Note that each connected client holds
+# a Redis connection while it waits.
+SSE_BLOCK_MS = 15000
+
 @app.route('/')
 def homepage():
     return "Hello Sammamish Study Group"
@@ -50,7 +76,7 @@ def test_request():
 def pytwis_get_request():
 
     command = request.args[PytwisConst.CMD]
-    print(command)
+    logger.debug(command)
     command_with_args = [request.args[PytwisConst.CMD], request.args]
 
     if(PytwisConst.AUTH in request.args):
@@ -58,17 +84,66 @@ def pytwis_get_request():
     else:
         auth_key = ''
 
+    # Stream the tweets or the follow list, each entry as a line of JSON.
+    if wants_ndjson() and PytwisConst.PAGE_SIZE not in request.args:
+        response = pytwis_stream_request_processor(g_twis, auth_key, command_with_args)
+        if response is not None:
+            return response
+
+    # Serve the general timeline from its cache, or just 304 if the client has it already.
+    if command == PytwisConst.CMD_TIMELINE and auth_key == '' and PytwisConst.PAGE_SIZE not in request.args:
+        try:
+            max_cnt_tweets = int(request.args.get(PytwisConst.MAX_TWEET_CNT, g_twis.GENERAL_TIMELINE_MAX_POST_CNT))
+        except ValueError:
+            abort(400)
+        succeeded, result = g_twis.get_general_timeline_json(max_cnt_tweets)
+        if not succeeded:
+            return make_response(json.dumps(result), 400, {'Content-Type': 'application/json'})
+        response = make_response(result[PytwisConst.TIMELINE_JSON], 200, {'Content-Type': 'application/json'})
+        response.set_etag(result[PytwisConst.ETAG])
+        return response.make_conditional(request)
+
     response = pytwis_get_request_processor(g_twis, auth_key, command_with_args)
 
-    jsonResponse = json.loads(response)
-    print(json.dumps(jsonResponse, sort_keys=True, indent=4))  # Beautified Json for debugging with logs
+    # Beautified Json for debugging with logs, only re-serialized if it's going to be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(json.loads(response), sort_keys=True, indent=4))
 
     return response
 
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def pytwis_stream_request_processor(twis, auth_secret, command_with_args):
+    # Return a streaming response for the commands which return a list, or None for the others.
+    command = command_with_args[0]
+    args = command_with_args[1]
+
+    if command == PytwisConst.CMD_TIMELINE:
+        succeeded, result = twis.iter_timeline(auth_secret)
+        items = result.get(PytwisConst.TWEETS)
+        if succeeded and PytwisConst.MAX_TWEET_CNT in args and int(args[PytwisConst.MAX_TWEET_CNT]) != -1:
+            items = itertools.islice(items, int(args[PytwisConst.MAX_TWEET_CNT]))
+    elif command == PytwisConst.CMD_FOLLOWERS:
+        # Each username is wrapped in an object, like pytwis_rest.py does.
+        succeeded, result = twis.iter_followers(auth_secret)
+        if succeeded:
+            items = ({PytwisConst.CMD_FOLLOWERS: follower} for follower in result[PytwisConst.FOLLOWER_LIST])
+    elif command == PytwisConst.CMD_FOLLOWINGS:
+        succeeded, result = twis.iter_following(auth_secret)
+        if succeeded:
+            items = ({PytwisConst.CMD_FOLLOWINGS: following} for following in result[PytwisConst.FOLLOWING_LIST])
+    else:
+        return None
+
+    if not succeeded:
+        return json.dumps(result)
+    return Response((json.dumps(item) + '\n' for item in items), mimetype=NDJSON_MIMETYPE)
+
 def pytwis_get_request_processor(twis, auth_secret, command_with_args):
     command = command_with_args[0]
     args = command_with_args[1]
-    print("pytwis_get_request_processor")
+    logger.debug("pytwis_get_request_processor")
 
     if command == PytwisConst.CMD_REGISTER:
         succeeded, result = twis.register(args[PytwisConst.USER_NAME], args[PytwisConst.PASSWORD])
@@ -89,7 +164,11 @@ def pytwis_get_request_processor(twis, auth_secret, command_with_args):
     elif command ==PytwisConst.CMD_FOLLOWINGS:
         succeeded, result = twis.get_following(auth_secret)
     elif command == PytwisConst.CMD_TIMELINE:
-        if(PytwisConst.MAX_TWEET_CNT in args):
+        if(PytwisConst.PAGE_SIZE in args):
+            max_id = int(args[PytwisConst.MAX_ID]) if PytwisConst.MAX_ID in args else None
+            since_id = int(args[PytwisConst.SINCE_ID]) if PytwisConst.SINCE_ID in args else None
+            succeeded, result = twis.get_timeline_page(auth_secret, int(args[PytwisConst.PAGE_SIZE]), max_id, since_id)
+        elif(PytwisConst.MAX_TWEET_CNT in args):
             succeeded, result = twis.get_timeline(auth_secret, int(args[PytwisConst.MAX_TWEET_CNT]))
         else:
             succeeded, result = twis.get_timeline(auth_secret, g_twis.GENERAL_TIMELINE_MAX_POST_CNT)
@@ -98,6 +177,41 @@ def pytwis_get_request_processor(twis, auth_secret, command_with_args):
 
     return json.dumps(result)
 
+@app.route('/events', methods=['GET'])
+def events():
+    auth_key = request.args.get(PytwisConst.AUTH, '')
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get(PytwisConst.LAST_EVENT_ID))
+    if last_event_id is not None and not STREAM_ENTRY_ID_REGEX.fullmatch(last_event_id):
+        abort(400)
+
+    # Check the session and replay the missed events before streaming.
+    succeeded, result = g_twis.read_post_events(auth_key, last_event_id)
+    if not succeeded:
+        return make_response(json.dumps(result), 404, {'Content-Type': 'application/json'})
+
+    def stream(result):
+        while True:
+            for event in result[PytwisConst.EVENTS]:
+                yield 'id: {}\ndata: {}\n\n'.format(event[PytwisConst.LAST_EVENT_ID],
+                                                   json.dumps({PytwisConst.POST_ID: event[PytwisConst.POST_ID],
+                                                               PytwisConst.TWEET: event[PytwisConst.TWEET]}))
+            if len(result[PytwisConst.EVENTS]) == 0:
+                yield ': keepalive\n\n'
+
+            succeeded, result = g_twis.read_post_events(auth_key, result[PytwisConst.LAST_EVENT_ID], SSE_BLOCK_MS)
+            if not succeeded:
+                # The user has logged out.
+                return
+
+    return Response(stream(result), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    metrics = g_twis.get_metrics()
+    if metrics is None:
+        abort(404)
+    return make_response(metrics, 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
 g_twis = None
 # g_twis =  Pytwis("hostname", "port", dbNumber, "<password")
 
@@ -112,7 +226,8 @@ def init():
             dbId = request.args['db']
             password = request.args[PytwisConst.PASSWORD]
 
-            g_twis =  Pytwis(server, port, dbId, password)
+            g_twis =  Pytwis(server, port, dbId, password,
+                             post_events=request.args.get('post_events') == '1')
             if twis is None:
                 return "Error"
             else:
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Bulk loader for pytwis
+#
+# Streams JSONL or CSV files of users, follow edges and tweets into the Redis
+# database of a Twitter clone, with the same key layout as Pytwis. The rows
+# are read one window at a time and each window is written in a few pipelined
+# round trips, so the memory use doesn't depend on the size of the files.
+#
+# The input files (a .csv file has a header row with the same field names):
+#   users    {"username": "...", "password": "..."}
+#   follows  {"follower": "<username>", "followee": "<username>"}
+#   posts    {"username": "...", "body": "...", "unix_time": 1500000000}
+#            unix_time is optional. The posts are expected in chronological order.
+#
+# The number of rows loaded from each file is saved in the checkpoint file
+# after every window, so an interrupted load resumes from the last window.
+# Note that the tweets of the window being written when the load was
+# interrupted may be loaded twice. A file is identified by its path, size and
+# modification time, so a different file at the same path is loaded from its
+# first row. The checkpoint of a file or a pass is deleted once it completes,
+# and --restart ignores the checkpoint file altogether.
+#
+# The tweets are only pushed into the general timeline and the timelines of
+# their authors. Pass --rebuild-timelines to rebuild the user timelines of all
+# the users from the follow graph in a final pass.
+#
+# Pass --migrate-posts with a post storage (see Pytwis.POST_STORAGES) to convert
+# all the existing posts into that storage, e.g., before switching the Pytwis
+# instances to post_storage='bucketed'. The posts are readable in any storage
+# during the migration. Rerun it after switching the instances to also convert
+# the posts written in the old storage in the meantime.
+#
+# Pass --build-authored-posts to build the lists of the posts authored by each
+# user from the existing posts, which is needed before user_timeline_max_post_cnt
+# (-m) can be enabled on a database with posts written before those lists were
+# introduced. The posts can be written in the meantime.
+#
+# Pass --index-terms to index the existing posts by their #hashtags and @mentions
+# for Pytwis.search. The new posts are indexed when they are posted.
+#
+# How to run:
+#   python3 pytwis_loader.py -u users.csv -f follows.jsonl -P posts.jsonl --rebuild-timelines
+#   python3 pytwis_loader.py --migrate-posts bucketed
+#   python3 pytwis_loader.py -P posts.jsonl --restart
+#   python3 pytwis_loader.py --build-authored-posts
+#   python3 pytwis_loader.py --index-terms
+#
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import pytwis
+
+
+class PytwisLoader:
+
+    # The key of the checkpoint of the timeline rebuilding pass.
+    REBUILD_TIMELINES_CHECKPOINT_KEY = 'rebuild_timelines'
+
+    # The key format of the checkpoint of the post migration to a post storage.
+    MIGRATE_POSTS_CHECKPOINT_KEY_FORMAT = 'migrate_posts:{}'
+
+    # The key of the checkpoint of the pass building the lists of the authored posts.
+    BUILD_AUTHORED_POSTS_CHECKPOINT_KEY = 'build_authored_posts'
+
+    # The key of the checkpoint of the term indexing pass.
+    INDEX_TERMS_CHECKPOINT_KEY = 'index_terms'
+
+    def __init__(self, twis, window_size=1000, checkpoint_path=None,
+                 timeline_max_post_cnt=pytwis.Pytwis.GENERAL_TIMELINE_MAX_POST_CNT, restart=False):
+        self._twis = twis
+        self._rc = twis._rc
+        self._window_size = window_size
+        self._checkpoint_path = checkpoint_path
+        self._timeline_max_post_cnt = timeline_max_post_cnt
+
+        self._checkpoint = {}
+        if checkpoint_path is not None and os.path.exists(checkpoint_path) and not restart:
+            with open(checkpoint_path) as checkpoint_file:
+                self._checkpoint = json.load(checkpoint_file)
+
+    def _get_file_checkpoint_key(self, path):
+        # Identify the file by its path, size and modification time. The checkpoints of the
+        # previous files at the same path are forgotten.
+        stat = os.stat(path)
+        path_prefix = os.path.abspath(path) + ':'
+        checkpoint_key = '{}{}:{}'.format(path_prefix, stat.st_size, stat.st_mtime_ns)
+        for stale_checkpoint_key in [key for key in self._checkpoint
+                                     if key.startswith(path_prefix) and key != checkpoint_key]:
+            del self._checkpoint[stale_checkpoint_key]
+        return checkpoint_key
+
+    def _save_checkpoint(self, checkpoint_key, loaded_cnt):
+        self._checkpoint[checkpoint_key] = loaded_cnt
+        self._write_checkpoint()
+
+    def _clear_checkpoint(self, checkpoint_key):
+        # Forget the progress of a completed load or pass, and the checkpoint file once it's empty.
+        self._checkpoint.pop(checkpoint_key, None)
+        if len(self._checkpoint) == 0 and self._checkpoint_path is not None and \
+           os.path.exists(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
+            return
+        self._write_checkpoint()
+
+    def _write_checkpoint(self):
+        if self._checkpoint_path is None or len(self._checkpoint) == 0:
+            return
+
+        # Replace the checkpoint file atomically so that a crash never leaves it half written.
+        temp_checkpoint_path = self._checkpoint_path + '.tmp'
+        with open(temp_checkpoint_path, 'w') as checkpoint_file:
+            json.dump(self._checkpoint, checkpoint_file)
+        os.replace(temp_checkpoint_path, self._checkpoint_path)
+
+    def _read_windows(self, path, checkpoint_key):
+        # Yield (rows, loaded_cnt) for the windows of rows after the checkpoint of the file,
+        # where loaded_cnt is the number of rows loaded once the window is written.
+        loaded_cnt = self._checkpoint.get(checkpoint_key, 0)
+        with open(path, newline='') as input_file:
+            if path.endswith('.csv'):
+                rows = csv.DictReader(input_file)
+            else:
+                rows = (json.loads(line) for line in input_file if line.strip() != '')
+
+            window = []
+            for row_index, row in enumerate(rows):
+                if row_index < loaded_cnt:
+                    continue
+                window.append(row)
+                if len(window) == self._window_size:
+                    loaded_cnt += len(window)
+                    yield window, loaded_cnt
+                    window = []
+
+            if len(window) > 0:
+                yield window, loaded_cnt + len(window)
+
+    def _get_user_ids(self, usernames):
+        # Get the username-to-user_id mapping of the usernames in one round trip.
+        usernames = list(set(usernames))
+        with self._twis._pipeline() as pipe:
+            for username in usernames:
+                pipe.hget(self._twis._users_hash_key(username), username)
+            return dict(zip(usernames, pipe.execute()))
+
+    def load_users(self, path):
+        checkpoint_key = self._get_file_checkpoint_key(path)
+        loaded_cnt = self._checkpoint.get(checkpoint_key, 0)
+        failed_cnt = 0
+        for window, loaded_cnt in self._read_windows(path, checkpoint_key):
+            results = self._twis.register_many([(row['username'], row['password']) for row in window])
+            for succeeded, result in results:
+                if not succeeded:
+                    failed_cnt += 1
+                    print('Skipped a user: {}'.format(result[pytwis.PytwisConst.ERROR]), file=sys.stderr)
+            self._save_checkpoint(checkpoint_key, loaded_cnt)
+
+        self._clear_checkpoint(checkpoint_key)
+        return loaded_cnt, failed_cnt
+
+    def load_follows(self, path):
+        checkpoint_key = self._get_file_checkpoint_key(path)
+        loaded_cnt = self._checkpoint.get(checkpoint_key, 0)
+        failed_cnt = 0
+        for window, loaded_cnt in self._read_windows(path, checkpoint_key):
+            user_ids = self._get_user_ids([row['follower'] for row in window] +
+                                          [row['followee'] for row in window])
+
+            unix_time = int(time.time())
+            with self._twis._pipeline() as pipe:
+                for row in window:
+                    follower_user_id = user_ids[row['follower']]
+                    followee_user_id = user_ids[row['followee']]
+                    if follower_user_id is None or followee_user_id is None:
+                        failed_cnt += 1
+                        print('Skipped an unknown user in {} -> {}'.format(row['follower'], row['followee']),
+                              file=sys.stderr)
+                        continue
+
+                    pipe.zadd(self._twis.FOLLOWER_ZSET_KEY_FORMAT.format(followee_user_id),
+                              {follower_user_id: unix_time})
+                    pipe.zadd(self._twis.FOLLOWING_ZSET_KEY_FORMAT.format(follower_user_id),
+                              {followee_user_id: unix_time})
+                pipe.execute()
+            self._save_checkpoint(checkpoint_key, loaded_cnt)
+
+        self._clear_checkpoint(checkpoint_key)
+        return loaded_cnt, failed_cnt
+
+    def load_posts(self, path):
+        checkpoint_key = self._get_file_checkpoint_key(path)
+        loaded_cnt = self._checkpoint.get(checkpoint_key, 0)
+        failed_cnt = 0
+        for window, loaded_cnt in self._read_windows(path, checkpoint_key):
+            user_ids = self._get_user_ids([row['username'] for row in window])
+            rows = [row for row in window if user_ids[row['username']] is not None]
+            failed_cnt += len(window) - len(rows)
+
+            # Allocate the post IDs of the window at once, in the order of the tweets.
+            last_post_id = self._rc.incrby(self._twis.NEXT_POST_ID_KEY, len(rows))
+            post_ids = range(last_post_id - len(rows) + 1, last_post_id + 1)
+
+            with self._twis._pipeline() as pipe:
+                for row, post_id in zip(rows, post_ids):
+                    self._twis._write_post(pipe, user_ids[row['username']], post_id, row['body'],
+                                           int(row.get('unix_time') or time.time()), False, [])
+                pipe.execute()
+            self._save_checkpoint(checkpoint_key, loaded_cnt)
+
+        self._clear_checkpoint(checkpoint_key)
+        return loaded_cnt, failed_cnt
+
+    def rebuild_timelines(self):
+        # Rebuild the user timeline of every user from the latest tweets authored by
+        # the user and the followings, a window of user_ids at a time.
+        last_user_id = int(self._rc.get(self._twis.NEXT_USER_ID_KEY) or 0)
+        first_user_id = self._checkpoint.get(self.REBUILD_TIMELINES_CHECKPOINT_KEY, 0) + 1
+        for window_first_user_id in range(first_user_id, last_user_id + 1, self._window_size):
+            user_ids = range(window_first_user_id,
+                             min(window_first_user_id + self._window_size, last_user_id + 1))
+
+            with self._twis._pipeline() as pipe:
+                for user_id in user_ids:
+                    pipe.zrange(self._twis.FOLLOWING_ZSET_KEY_FORMAT.format(user_id), 0, -1)
+                following_user_id_lists = pipe.execute()
+
+            # Merge the latest tweets authored by each user and the followings, window_size LRANGEs
+            # per pipeline without MULTI, so that neither a pipeline nor the merged lists grow with
+            # the number of the followings.
+            authored_user_ids = [(user_id, authored_user_id)
+                                 for user_id, following_user_ids in zip(user_ids, following_user_id_lists)
+                                 for authored_user_id in [user_id] + following_user_ids]
+            post_id_lists = {user_id: [] for user_id in user_ids}
+            for chunk_start_index in range(0, len(authored_user_ids), self._window_size):
+                chunk = authored_user_ids[chunk_start_index:chunk_start_index + self._window_size]
+                with self._twis._pipeline(transaction=False) as pipe:
+                    for _, authored_user_id in chunk:
+                        pipe.lrange(self._twis.AUTHORED_POST_ID_USER_KEY_FORMAT.format(authored_user_id),
+                                    0, self._timeline_max_post_cnt - 1)
+                    for (user_id, _), post_ids in zip(chunk, pipe.execute()):
+                        post_id_lists[user_id] = pytwis.merge_post_ids([post_id_lists[user_id], post_ids],
+                                                                       self._timeline_max_post_cnt)
+
+            with self._twis._pipeline() as pipe:
+                for user_id in user_ids:
+                    post_ids = post_id_lists[user_id]
+                    post_id_user_key = self._twis.POST_ID_USER_KEY_FORMAT.format(user_id)
+                    pipe.delete(post_id_user_key, self._twis.TRIMMED_USER_KEY_FORMAT.format(user_id))
+                    if len(post_ids) > 0:
+                        pipe.rpush(post_id_user_key, *post_ids)
+                pipe.execute()
+            self._save_checkpoint(self.REBUILD_TIMELINES_CHECKPOINT_KEY, user_ids[-1])
+
+        self._clear_checkpoint(self.REBUILD_TIMELINES_CHECKPOINT_KEY)
+        return last_user_id
+
+    def migrate_posts(self, post_storage):
+        # Move every post into post_storage, a window of post IDs at a time.
+        checkpoint_key = self.MIGRATE_POSTS_CHECKPOINT_KEY_FORMAT.format(post_storage)
+        last_post_id = int(self._rc.get(self._twis.NEXT_POST_ID_KEY) or 0)
+        first_post_id = self._checkpoint.get(checkpoint_key, 0) + 1
+        migrated_cnt = 0
+        for window_first_post_id in range(first_post_id, last_post_id + 1, self._window_size):
+            post_ids = range(window_first_post_id,
+                             min(window_first_post_id + self._window_size, last_post_id + 1))
+            tweets = self._twis._read_posts(post_ids)
+
+            with self._twis._pipeline() as pipe:
+                for post_id, tweet in zip(post_ids, tweets):
+                    if tweet is None:
+                        continue
+                    for other_post_storage in self._twis._get_missing_post_storages(post_storage):
+                        self._twis._queue_post_delete(pipe, post_id, other_post_storage)
+                    self._twis._queue_post_write(pipe, post_id, tweet[self._twis.POST_ID_USERID_KEY],
+                                                 tweet[self._twis.POST_ID_UNIXTIME_KEY],
+                                                 tweet[self._twis.POST_ID_BODY_KEY], post_storage)
+                    migrated_cnt += 1
+                pipe.execute()
+            self._save_checkpoint(checkpoint_key, post_ids[-1])
+
+        self._clear_checkpoint(checkpoint_key)
+        return migrated_cnt
+
+    def build_authored_posts(self):
+        # Append every post to the list of the posts authored by its user, a window of post IDs
+        # at a time from the latest to the oldest. Only the posts older than the oldest post of
+        # each list are appended, so the lists stay sorted, the pass can be rerun and the new
+        # posts pushed to the head of the lists in the meantime are left alone.
+        last_post_id = int(self._rc.get(self._twis.NEXT_POST_ID_KEY) or 0)
+        first_post_id = self._checkpoint.get(self.BUILD_AUTHORED_POSTS_CHECKPOINT_KEY, last_post_id + 1) - 1
+        built_cnt = 0
+        for window_first_post_id in range(first_post_id, 0, -self._window_size):
+            post_ids = range(window_first_post_id, max(window_first_post_id - self._window_size, 0), -1)
+            tweets = self._twis._read_posts(post_ids)
+
+            user_ids = list({tweet[self._twis.POST_ID_USERID_KEY] for tweet in tweets if tweet is not None})
+            with self._twis._pipeline() as pipe:
+                for user_id in user_ids:
+                    pipe.lindex(self._twis.AUTHORED_POST_ID_USER_KEY_FORMAT.format(user_id), -1)
+                oldest_post_ids = dict(zip(user_ids, pipe.execute()))
+
+            with self._twis._pipeline() as pipe:
+                for post_id, tweet in zip(post_ids, tweets):
+                    if tweet is None:
+                        continue
+                    user_id = tweet[self._twis.POST_ID_USERID_KEY]
+                    if oldest_post_ids[user_id] is not None and int(oldest_post_ids[user_id]) <= post_id:
+                        continue
+                    pipe.rpush(self._twis.AUTHORED_POST_ID_USER_KEY_FORMAT.format(user_id), post_id)
+                    oldest_post_ids[user_id] = post_id
+                    built_cnt += 1
+                pipe.execute()
+            self._save_checkpoint(self.BUILD_AUTHORED_POSTS_CHECKPOINT_KEY, post_ids[-1])
+
+        self._rc.set(self._twis.AUTHORED_POSTS_COMPLETE_KEY, 1)
+        self._clear_checkpoint(self.BUILD_AUTHORED_POSTS_CHECKPOINT_KEY)
+        return built_cnt
+
+    def index_terms(self):
+        # Index every post by its #hashtags and @mentions, a window of post IDs at a time.
+        last_post_id = int(self._rc.get(self._twis.NEXT_POST_ID_KEY) or 0)
+        first_post_id = self._checkpoint.get(self.INDEX_TERMS_CHECKPOINT_KEY, 0) + 1
+        indexed_cnt = 0
+        for window_first_post_id in range(first_post_id, last_post_id + 1, self._window_size):
+            post_ids = range(window_first_post_id,
+                             min(window_first_post_id + self._window_size, last_post_id + 1))
+            tweets = self._twis._read_posts(post_ids)
+
+            with self._twis._pipeline() as pipe:
+                for post_id, tweet in zip(post_ids, tweets):
+                    if tweet is None:
+                        continue
+                    self._twis._index_terms(pipe, post_id, tweet[self._twis.POST_ID_BODY_KEY])
+                    indexed_cnt += 1
+                pipe.execute()
+            self._save_checkpoint(self.INDEX_TERMS_CHECKPOINT_KEY, post_ids[-1])
+
+        self._clear_checkpoint(self.INDEX_TERMS_CHECKPOINT_KEY)
+        return indexed_cnt
+
+
+def pytwis_loader():
+    parser = argparse.ArgumentParser(description= \
+                                         'Load the users, the follow graph and the tweets of a Twitter clone '
+                                         'from JSONL or CSV files into its Redis database.')
+    parser.add_argument('-n', '--hostname', dest='redis_hostname', default='127.0.0.1',
+                        help='the Redis server hostname. If not specified, will be defaulted to 127.0.0.1.')
+    parser.add_argument('-t', '--port', dest='redis_port', default=6379,
+                        help='the Redis server port. If not specified, will be defaulted to 6379.')
+    parser.add_argument('-d', '--database', dest='redis_database', default=0,
+                        help='the Redis server database. If not specified, will be defaulted to 0.')
+    parser.add_argument('-p', '--password', dest='redis_password', default='',
+                        help='the Redis server password. If not specified, will be defaulted to an empty string.')
+    parser.add_argument('--cluster', dest='redis_cluster', action='store_true',
+                        help='connect to a Redis Cluster via the node at the hostname and the port.')
+    parser.add_argument('-u', '--users', dest='users_path',
+                        help='the JSONL or CSV file of the users.')
+    parser.add_argument('-f', '--follows', dest='follows_path',
+                        help='the JSONL or CSV file of the follow edges.')
+    parser.add_argument('-P', '--posts', dest='posts_path',
+                        help='the JSONL or CSV file of the tweets.')
+    parser.add_argument('-r', '--rebuild-timelines', dest='rebuild_timelines', action='store_true',
+                        help='rebuild the user timelines from the follow graph after loading the files.')
+    parser.add_argument('-m', '--user-timeline-max-post-cnt', dest='user_timeline_max_post_cnt',
+                        type=int, default=None,
+                        help='the number of the latest tweets retained in each user timeline. '
+                             'If not specified, the rebuilt user timelines will retain the latest {} tweets.'.format(
+                                 pytwis.Pytwis.GENERAL_TIMELINE_MAX_POST_CNT))
+    parser.add_argument('-s', '--post-storage', dest='post_storage', default=pytwis.Pytwis.POST_STORAGE_HASH,
+                        choices=pytwis.Pytwis.POST_STORAGES,
+                        help='the storage of the loaded tweets. If not specified, will be defaulted to hash.')
+    parser.add_argument('--migrate-posts', dest='migrate_posts', default=None,
+                        choices=pytwis.Pytwis.POST_STORAGES,
+                        help='convert all the existing tweets into the given storage.')
+    parser.add_argument('--build-authored-posts', dest='build_authored_posts', action='store_true',
+                        help='build the lists of the tweets authored by each user from all the existing tweets.')
+    parser.add_argument('--index-terms', dest='index_terms', action='store_true',
+                        help='index all the existing tweets by their hashtags and mentions.')
+    parser.add_argument('-w', '--window-size', dest='window_size', type=int, default=1000,
+                        help='the number of rows written per pipeline. '
+                             'If not specified, will be defaulted to 1000.')
+    parser.add_argument('-c', '--checkpoint', dest='checkpoint_path', default='pytwis_loader.checkpoint',
+                        help='the file which records the progress of the load. '
+                             'If not specified, will be defaulted to pytwis_loader.checkpoint.')
+    parser.add_argument('--restart', dest='restart', action='store_true',
+                        help='ignore the checkpoint file and load the files from their first rows.')
+
+    args = parser.parse_args()
+
+    try:
+        twis = pytwis.Pytwis(args.redis_hostname, args.redis_port, args.redis_database, args.redis_password,
+                             user_timeline_max_post_cnt=args.user_timeline_max_post_cnt,
+                             cluster=args.redis_cluster,
+                             post_storage=args.post_storage)
+    except ValueError as e:
+        print('Failed to connect to the Redis server: {}'.format(str(e)),
+              file=sys.stderr)
+        return -1
+
+    loader = PytwisLoader(twis, window_size=args.window_size, checkpoint_path=args.checkpoint_path,
+                          timeline_max_post_cnt=args.user_timeline_max_post_cnt or \
+                                                pytwis.Pytwis.GENERAL_TIMELINE_MAX_POST_CNT,
+                          restart=args.restart)
+    for path, load in [(args.users_path, loader.load_users),
+                       (args.follows_path, loader.load_follows),
+                       (args.posts_path, loader.load_posts)]:
+        if path is not None:
+            loaded_cnt, failed_cnt = load(path)
+            print('Loaded {} rows of {} ({} skipped).'.format(loaded_cnt, path, failed_cnt))
+
+    if args.migrate_posts is not None:
+        migrated_cnt = loader.migrate_posts(args.migrate_posts)
+        print('Migrated {} tweets to the {} storage.'.format(migrated_cnt, args.migrate_posts))
+
+    if args.build_authored_posts:
+        built_cnt = loader.build_authored_posts()
+        print('Added {} tweets to the lists of the authored tweets.'.format(built_cnt))
+
+    if args.index_terms:
+        indexed_cnt = loader.index_terms()
+        print('Indexed {} tweets.'.format(indexed_cnt))
+
+    if args.rebuild_timelines:
+        user_cnt = loader.rebuild_timelines()
+        print('Rebuilt the timelines of {} users.'.format(user_cnt))
+
+    return 0
+
+
+if __name__ == '__main__':
+    pytwis_loader()
@@ -5,16 +5,30 @@
 # ===========================================================================
 # users         POST        Create a new user (register)
 #               GET         Get the information of a user (implicit login, 
-#                           following and follower)
+#                           following and follower, a page of them if 
+#                           page_size is given, paged by followers_offset 
+#                           and followings_offset, and their counts)
 #               PUT         Modify a user (change his followers, change his 
 #                           password)
 # posts         POST        Post a new tweet
-#               GET         Get timeline
+#               GET         Get timeline (a page of it if page_size is given, 
+#                           paged by max_id and since_id)
+# search        GET         Search the tweets with all of the #hashtags and 
+#                           @mentions in terms, or any of them if mode is "or", 
+#                           limit tweets a page, paged by cursor
+#
+# Without page_size, the users and posts GETs stream the lists as newline-delimited 
+# JSON (one follower, following or tweet per line) while they are read from Redis 
+# if the request has the header "Accept: application/x-ndjson".
 #
 #
 # How to run:
 # Borrowing code from pytwis_clt.py, if everything about Redis is by default:
 # python3 pytwis_rest.py
+# To return from adding a post without waiting for the fanout, run it together
+# with one or more fanout workers:
+# python3 pytwis_rest.py -a
+# python3 pytwis_fanout_worker.py -c worker1
 #
 # How to test:
 # Use curl tool. For example, to get information of a user
@@ -27,8 +41,12 @@
 #       -d '{"username":"gavin","password":"gavin", "new_password":"g"}'
 #
 
-from flask import Flask, jsonify, request, abort, make_response
+from flask import Flask, Response, jsonify, request, abort, make_response
+import itertools
+import json
 import pytwis
+from pytwis import PytwisConst
+from pytwis_clt import add_redis_arguments, redis_connection_kwargs
 import time
 import sys
 import argparse
@@ -40,6 +58,8 @@ PYTWIS_API_VERSION = "1.0"
 
 HTTP_INDEX_URL = '/' + PROJECT_NAME + '/api/v' + PYTWIS_API_VERSION + '/'
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
 g_pytwis = 0
 
 # Project information
@@ -94,17 +114,52 @@ def get_user_info():
     else:
         abort(400)
 
-    succeeded, result = g_pytwis.get_followers(auth)
+    # Stream the lists after the user information, each entry as a line of JSON.
+    if wants_ndjson() and PytwisConst.PAGE_SIZE not in request.json:
+        succeeded, followers_result = g_pytwis.iter_followers(auth)
+        if not succeeded:
+            return make_response(jsonify(process_error(followers_result)), 404)
+        _, followings_result = g_pytwis.iter_following(auth)
+        _, result = g_pytwis.count_followers(auth)
+        userinfo[PytwisConst.FOLLOWER_CNT] = result[PytwisConst.FOLLOWER_CNT]
+        _, result = g_pytwis.count_following(auth)
+        userinfo[PytwisConst.FOLLOWING_CNT] = result[PytwisConst.FOLLOWING_CNT]
+        return ndjson_response(itertools.chain(
+            [{'userinfo': userinfo}],
+            ({PytwisConst.CMD_FOLLOWERS: follower} for follower in followers_result[PytwisConst.FOLLOWER_LIST]),
+            ({'followings': following} for following in followings_result[PytwisConst.FOLLOWING_LIST])))
+
+    # Get a page of each list if page_size is given, paged by followers_offset and 
+    # followings_offset, or the whole lists otherwise.
+    if PytwisConst.PAGE_SIZE in request.json:
+        page_size = int(request.json[PytwisConst.PAGE_SIZE])
+        succeeded, result = g_pytwis.get_followers_page(auth, page_size, 
+                                                        int(request.json.get(PytwisConst.FOLLOWERS_OFFSET, 0)))
+        if succeeded:
+            userinfo[PytwisConst.NEXT_FOLLOWERS_OFFSET] = result[PytwisConst.NEXT_OFFSET]
+    else:
+        succeeded, result = g_pytwis.get_followers(auth)
     if succeeded:
         userinfo[PytwisConst.CMD_FOLLOWERS] = result['follower_list']
     else:
         return make_response(jsonify(process_error(result)), 404)
     
-    succeeded, result = g_pytwis.get_following(auth)
+    if PytwisConst.PAGE_SIZE in request.json:
+        succeeded, result = g_pytwis.get_following_page(auth, page_size, 
+                                                        int(request.json.get(PytwisConst.FOLLOWINGS_OFFSET, 0)))
+        if succeeded:
+            userinfo[PytwisConst.NEXT_FOLLOWINGS_OFFSET] = result[PytwisConst.NEXT_OFFSET]
+    else:
+        succeeded, result = g_pytwis.get_following(auth)
     if succeeded:
         userinfo['followings'] = result['following_list']
     else:
         return make_response(jsonify(process_error(result)), 404)
+    
+    _, result = g_pytwis.count_followers(auth)
+    userinfo[PytwisConst.FOLLOWER_CNT] = result[PytwisConst.FOLLOWER_CNT]
+    _, result = g_pytwis.count_following(auth)
+    userinfo[PytwisConst.FOLLOWING_CNT] = result[PytwisConst.FOLLOWING_CNT]
 
     return jsonify({'userinfo': userinfo})
 
@@ -161,7 +216,7 @@ def add_post():
 @app.route(HTTP_INDEX_URL+'posts', methods=['GET'])
 def get_timeline():
     auth=''
-    if not request.json or not 'tweet_content' in request.json:
+    if request.json is None:
         abort(400)
     # If there is a set of credentials, try login first
     elif PytwisConst.USERNAME in request.json and PytwisConst.PASSWORD in request.json:
@@ -173,12 +228,80 @@ def get_timeline():
     elif PytwisConst.AUTH in request.json:
         auth = request.json[PytwisConst.AUTH]
 
-    succeeded, result = g_pytwis.get_timeline(auth)
+    # Stream the tweets, each as a line of JSON.
+    if wants_ndjson() and PytwisConst.PAGE_SIZE not in request.json:
+        succeeded, result = g_pytwis.iter_timeline(auth)
+        if not succeeded:
+            return make_response(jsonify(process_error(result)), 404)
+        tweets = result[PytwisConst.TWEETS]
+        max_tweet_cnt = int(request.json.get(PytwisConst.MAX_TWEET_CNT, -1))
+        if max_tweet_cnt != -1:
+            tweets = itertools.islice(tweets, max_tweet_cnt)
+        return ndjson_response(tweets)
+
+    # Serve the general timeline from its cache, or just 304 if the client has it already.
+    if auth == '' and PytwisConst.PAGE_SIZE not in request.json:
+        succeeded, result = g_pytwis.get_general_timeline_json(get_int_arg(PytwisConst.MAX_TWEET_CNT, 
+                                                                           g_pytwis.GENERAL_TIMELINE_MAX_POST_CNT))
+        if not succeeded:
+            return make_response(jsonify(process_error(result)), 400)
+        response = make_response(result[PytwisConst.TIMELINE_JSON], 200, {'Content-Type': 'application/json'})
+        response.set_etag(result[PytwisConst.ETAG])
+        return response.make_conditional(request)
+
+    # If there is a page size, get one page of the timeline after since_id and/or 
+    # before max_id. The result includes the cursors of the adjacent pages.
+    if PytwisConst.PAGE_SIZE in request.json:
+        succeeded, result = g_pytwis.get_timeline_page(auth, get_int_arg(PytwisConst.PAGE_SIZE),
+                                                       get_int_arg(PytwisConst.MAX_ID),
+                                                       get_int_arg(PytwisConst.SINCE_ID))
+    else:
+        succeeded, result = g_pytwis.get_timeline(auth, int(request.json.get(PytwisConst.MAX_TWEET_CNT, 
+                                                                             g_pytwis.GENERAL_TIMELINE_MAX_POST_CNT)))
+    if succeeded:
+        return make_response(jsonify(result), 200)
+    else:
+        return make_response(jsonify(process_error(result)), 404)
+
+@app.route(HTTP_INDEX_URL+'search', methods=['GET'])
+def search():
+    if not request.json or PytwisConst.TERMS not in request.json:
+        abort(400)
+    
+    succeeded, result = g_pytwis.search(request.json[PytwisConst.TERMS],
+                                        request.json.get(PytwisConst.CURSOR),
+                                        request.json.get(PytwisConst.LIMIT, 20),
+                                        request.json.get(PytwisConst.MODE, g_pytwis.SEARCH_MODE_AND))
     if succeeded:
         return make_response(jsonify(result), 200)
     else:
         return make_response(jsonify(process_error(result)), 404)
 
+# Prometheus metrics, if the server is run with --metrics
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    metrics = g_pytwis.get_metrics()
+    if metrics is None:
+        abort(404)
+    return make_response(metrics, 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def ndjson_response(items):
+    # Serialize the items one by one as they are read, instead of the whole list at once.
+    return Response((json.dumps(item) + '\n' for item in items), mimetype=NDJSON_MIMETYPE)
+
+def get_int_arg(name, default=None):
+    # Get an integer argument of the JSON request, or abort with 400 if it isn't one.
+    value = request.json.get(name, default)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        abort(400)
+
 def process_error(server_result):
     errorinfo = {
         'server_msg': server_result['error'],
@@ -190,12 +313,40 @@ def pytwis_rest():
     parser = argparse.ArgumentParser(description= \
                                          'Connect to the Redis database of a Twitter clone and '
                                          'then run commands to access and update the database.')
-    parser.add_argument('-d', '--hostname', dest='redis_hostname', default='127.0.0.1',
-                        help='the Redis server hostname. If not specified, will be defaulted to 127.0.0.1.')
-    parser.add_argument('-t', '--port', dest='redis_port', default=6379,
-                        help='the Redis server port. If not specified, will be defaulted to 6379.')
-    parser.add_argument('-p', '--password', dest='redis_password', default='',
-                        help='the Redis server password. If not specified, will be defaulted to an empty string.')
+    add_redis_arguments(parser, hostname_option='-d')
+    parser.add_argument('-a', '--async-fanout', dest='async_fanout', action='store_true',
+                        help='leave the fanout of new tweets to pytwis_fanout_worker.py instead of '
+                             'doing it in the request.')
+    parser.add_argument('-m', '--user-timeline-max-post-cnt', dest='user_timeline_max_post_cnt',
+                        type=int, default=None,
+                        help='the number of the latest tweets retained in each user timeline. '
+                             'If not specified, the user timelines will not be trimmed.')
+    parser.add_argument('-c', '--username-cache-size', dest='username_cache_size', type=int, default=0,
+                        help='the max number of usernames cached in process. '
+                             'If not specified, the usernames will not be cached.')
+    parser.add_argument('--session-cache-size', dest='session_cache_size', type=int, default=0,
+                        help='the max number of authentication secrets cached in process for a few seconds. '
+                             'If not specified, the authentication secrets will not be cached.')
+    parser.add_argument('-l', '--lua-scripts', dest='lua_scripts', action='store_true',
+                        help='run the session checks and post_tweet as server-side Lua scripts.')
+    parser.add_argument('--post-storage', dest='post_storage', default='hash',
+                        choices=['hash', 'packed', 'bucketed'],
+                        help='how to store the new tweets. If not specified, will be defaulted to hash.')
+    parser.add_argument('--password-scrypt-n', dest='password_scrypt_n', type=int, default=None,
+                        help='the scrypt CPU/memory cost (a power of 2, e.g., 16384) of hashing the passwords. '
+                             'If not specified, the passwords will be stored raw.')
+    parser.add_argument('--password-scrypt-r', dest='password_scrypt_r', type=int, default=8,
+                        help='the scrypt block size. If not specified, will be defaulted to 8.')
+    parser.add_argument('--password-scrypt-p', dest='password_scrypt_p', type=int, default=1,
+                        help='the scrypt parallelization. If not specified, will be defaulted to 1.')
+    parser.add_argument('--password-hash-workers', dest='password_hash_workers', type=int, default=None,
+                        help='the number of processes hashing the passwords, or 0 to hash in the request. '
+                             'If not specified, will be defaulted to the number of CPUs.')
+    parser.add_argument('--metrics', dest='metrics', action='store_true',
+                        help='record the metrics of the Pytwis methods and serve them at /metrics.')
+    parser.add_argument('--post-events', dest='post_events', action='store_true',
+                        help='publish the new tweets to the post event streams read by the /events '
+                             'route of pytwis_flask.py.')
 
     args = parser.parse_args()
 
@@ -208,7 +359,19 @@ def pytwis_rest():
 
     try:
         global g_pytwis
-        g_pytwis = pytwis.Pytwis(args.redis_hostname, args.redis_port, args.redis_password)
+        g_pytwis = pytwis.Pytwis(async_fanout=args.async_fanout,
+                                 user_timeline_max_post_cnt=args.user_timeline_max_post_cnt,
+                                 username_cache_size=args.username_cache_size,
+                                 session_cache_size=args.session_cache_size,
+                                 lua_scripts=args.lua_scripts,
+                                 metrics=args.metrics,
+                                 post_storage=args.post_storage,
+                                 password_scrypt_n=args.password_scrypt_n,
+                                 password_scrypt_r=args.password_scrypt_r,
+                                 password_scrypt_p=args.password_scrypt_p,
+                                 password_hash_workers=args.password_hash_workers,
+                                 post_events=args.post_events,
+                                 **redis_connection_kwargs(args))
     except ValueError as e:
         print('Failed to connect to the Redis server: {}'.format(str(e)),
               file=sys.stderr)
@@ -64,9 +64,1074 @@ class PytwisRegisterTests(PytwisTests):
         
         self.assertTrue(succeeded1 != succeeded2, 'One register should succeed and the other register should fail')
         
+    def registerManyUsersAtSameTime(self):
+        '''Register the same usernames in many threads at the same time.'''
+        usernames = ['test3_username{}'.format(index) for index in range(50)]
+        thread_cnt = 8
+        twis = Pytwis(db=TEST_DATABASE_ID, metrics=True)
+        
+        from multiprocessing.pool import ThreadPool
+        with ThreadPool(processes=thread_cnt) as pool:
+            results = pool.map(lambda username: twis.register(username, 'password'), 
+                               usernames * thread_cnt)
+        
+        user_ids = [result['username'] for succeeded, result in results if succeeded]
+        self.assertEqual(len(user_ids), len(usernames), 'Exactly one register of each username should succeed')
+        self.assertEqual(len(set(user_ids)), len(usernames), 'Every registered user should get its own user-id')
+        self.assertIn('pytwis_aborts_total{{method="register"}} {}'.format(len(usernames) * (thread_cnt - 1)),
+                      twis.get_metrics(), 'Every failed register should be counted as an abort')
+        
     def test_register(self):
         self.registerNewAndExistingUsers()
         self.registerSameUserAtSameTime()
+        self.registerManyUsersAtSameTime()
+
+class PytwisHybridFanoutTests(PytwisTests):
+    '''Test for the hybrid push/pull fanout of ``Pytwis.post_tweet()``.'''
+    
+    def setUp(self):
+        super().setUp()
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, celebrity_follower_threshold=2)
+        
+    def test_celebrity_tweets_merged_at_read_time(self):
+        _, celebrity = self._pytwis.register('celebrity', 'password')
+        follower_auths = []
+        for index in range(2):
+            _, result = self._pytwis.register('follower{}'.format(index), 'password')
+            self._pytwis.follow(result['auth'], 'celebrity')
+            follower_auths.append(result['auth'])
+        
+        succeeded, _ = self._pytwis.post_tweet(celebrity['auth'], 'hello followers')
+        self.assertTrue(succeeded, 'Failed to post a tweet')
+        
+        # The tweet isn't pushed into the followers' timelines...
+        follower_user_id = self._pytwis._rc.hget(Pytwis.USERS_HASH_KEY, 'follower0')
+        self.assertEqual(self._pytwis._rc.llen(Pytwis.POST_ID_USER_KEY_FORMAT.format(follower_user_id)), 0,
+                         'The tweet of a celebrity should not be write fanned out')
+        
+        # ...but merged into them at read time.
+        for follower_auth in follower_auths:
+            succeeded, result = self._pytwis.get_timeline(follower_auth, -1)
+            self.assertTrue(succeeded, 'Failed to get the user timeline')
+            self.assertEqual([tweet['body'] for tweet in result['tweets']], ['hello followers'],
+                             'The tweet of a celebrity should be merged into the user timeline')
+
+class PytwisAsyncFanoutTests(PytwisTests):
+    '''Test for the asynchronous fanout of ``Pytwis.post_tweet()``.'''
+    
+    def setUp(self):
+        super().setUp()
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, async_fanout=True)
+        
+    def test_fanout_worker(self):
+        from pytwis_fanout_worker import PytwisFanoutWorker
+        
+        _, author = self._pytwis.register('author', 'password')
+        _, follower = self._pytwis.register('follower', 'password')
+        self._pytwis.follow(follower['auth'], 'author')
+        self._pytwis.post_tweet(author['auth'], 'hello follower')
+        
+        _, result = self._pytwis.get_timeline(follower['auth'], -1)
+        self.assertEqual(len(result['tweets']), 0, 'The tweet should wait for a fanout worker')
+        
+        worker = PytwisFanoutWorker(self._pytwis, 'test_worker', block_ms=100)
+        self.assertEqual(worker.process_once(), 1, 'The worker should process one fanout job')
+        
+        _, result = self._pytwis.get_timeline(follower['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['hello follower'],
+                         'The worker should push the tweet into the follower timeline')
+        self.assertEqual(self._pytwis._rc.xlen(Pytwis.FANOUT_STREAM_KEY), 0,
+                         'The finished fanout job should be removed from the stream')
+    
+    def test_follow_during_pending_fanout(self):
+        from pytwis_fanout_worker import PytwisFanoutWorker
+        
+        _, author = self._pytwis.register('author', 'password')
+        _, follower = self._pytwis.register('follower', 'password')
+        self._pytwis.post_tweet(author['auth'], 'pending tweet')
+        
+        # The follow backfills the tweet while its fanout job is still queued.
+        self._pytwis.follow(follower['auth'], 'author')
+        self._pytwis.post_tweet(follower['auth'], 'own tweet')
+        _, result = self._pytwis.get_timeline(follower['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['own tweet', 'pending tweet'],
+                         'The follow should backfill the pending tweet')
+        
+        worker = PytwisFanoutWorker(self._pytwis, 'test_worker', block_ms=100)
+        self.assertEqual(worker.process_once(), 2, 'The worker should process both fanout jobs')
+        _, result = self._pytwis.get_timeline(follower['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['own tweet', 'pending tweet'],
+                         'The worker should not push the backfilled tweet again')
+    
+    def test_fanout_worker_resumes_after_unfollow(self):
+        from pytwis_fanout_worker import PytwisFanoutWorker
+        
+        _, author = self._pytwis.register('author', 'password')
+        auths = {}
+        for index in range(4):
+            _, follower = self._pytwis.register('follower{}'.format(index), 'password')
+            self._pytwis.follow(follower['auth'], 'author')
+            auths[self._pytwis._rc.hget(Pytwis.USERS_HASH_KEY, 'follower{}'.format(index))] = follower['auth']
+        self._pytwis.post_tweet(author['auth'], 'hello followers')
+        
+        # Pretend that the first batch, the first follower, was done before it unfollowed the author.
+        worker = PytwisFanoutWorker(self._pytwis, 'test_worker', batch_size=1, block_ms=100)
+        author_user_id = self._pytwis._rc.hget(Pytwis.USERS_HASH_KEY, 'author')
+        [(first_user_id, first_score)] = self._pytwis._rc.zrange(Pytwis.FOLLOWER_ZSET_KEY_FORMAT.format(author_user_id), 
+                                                                 0, 0, withscores=True, score_cast_func=str)
+        [(job_id, _)] = self._pytwis._rc.xrange(Pytwis.FANOUT_STREAM_KEY)
+        self._pytwis._rc.hset(worker.FANOUT_PROGRESS_HASH_KEY, job_id, '{}:{}'.format(first_score, first_user_id))
+        self._pytwis.unfollow(auths.pop(first_user_id), 'author')
+        
+        worker.process_once()
+        for auth in auths.values():
+            _, result = self._pytwis.get_timeline(auth, -1)
+            self.assertEqual([tweet['body'] for tweet in result['tweets']], ['hello followers'],
+                             'No follower after the unfollowed one should be skipped')
+
+class PytwisLuaScriptTests(PytwisTests):
+    '''Test for the server-side Lua script of ``Pytwis.post_tweet()``.'''
+    
+    def setUp(self):
+        super().setUp()
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, lua_scripts=True)
+        
+    def test_post_tweet(self):
+        _, author = self._pytwis.register('author', 'password')
+        _, follower = self._pytwis.register('follower', 'password')
+        self._pytwis.follow(follower['auth'], 'author')
+        
+        succeeded, result = self._pytwis.post_tweet('invalid_auth', 'hello')
+        self.assertFalse(succeeded, 'Posting a tweet should require logging in')
+        self.assertEqual(result['error'], 'Not logged in', 'Incorrect error message')
+        
+        succeeded, _ = self._pytwis.post_tweet(author['auth'], 'hello')
+        self.assertTrue(succeeded, 'Failed to post a tweet')
+        for auth_secret in ['', author['auth'], follower['auth']]:
+            _, result = self._pytwis.get_timeline(auth_secret, -1)
+            self.assertEqual([tweet['body'] for tweet in result['tweets']], ['hello'],
+                             'The tweet should be pushed into all the timelines')
+
+class PytwisTimelinePageTests(PytwisTests):
+    '''Test for the ``Pytwis.get_timeline_page()`` function.'''
+    
+    def test_pages(self):
+        _, author = self._pytwis.register('author', 'password')
+        for index in range(5):
+            self._pytwis.post_tweet(author['auth'], 'tweet{}'.format(index))
+        
+        # Page back through the timeline.
+        succeeded, result = self._pytwis.get_timeline_page(author['auth'], 2)
+        self.assertTrue(succeeded, 'Failed to get the first page')
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet4', 'tweet3'])
+        newest_id = result['next_since_id']
+        
+        _, result = self._pytwis.get_timeline_page(author['auth'], 2, max_id=result['next_max_id'])
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet2', 'tweet1'])
+        
+        _, result = self._pytwis.get_timeline_page(author['auth'], 2, max_id=result['next_max_id'])
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet0'])
+        self.assertIsNone(result['next_max_id'], 'The last page should have no next page')
+        
+        # Poll for the new tweets.
+        _, result = self._pytwis.get_timeline_page(author['auth'], 2, since_id=newest_id)
+        self.assertEqual(len(result['tweets']), 0, 'There should be no new tweet')
+        
+        self._pytwis.post_tweet(author['auth'], 'tweet5')
+        _, result = self._pytwis.get_timeline_page(author['auth'], 2, since_id=newest_id)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet5'])
+        
+        for page_size in [0, -1, -2]:
+            succeeded, _ = self._pytwis.get_timeline_page(author['auth'], page_size)
+            self.assertFalse(succeeded, 'Got a page of {} tweets'.format(page_size))
+    
+    def test_poll_out_of_order_timeline(self):
+        _, author = self._pytwis.register('author', 'password')
+        for index in range(3):
+            self._pytwis.post_tweet(author['auth'], 'tweet{}'.format(index))
+        
+        # Reorder the user timeline as if the post 2 had been pushed after the post 1.
+        author_user_id = self._pytwis._rc.hget(Pytwis.USERS_HASH_KEY, 'author')
+        post_id_user_key = Pytwis.POST_ID_USER_KEY_FORMAT.format(author_user_id)
+        post_ids = self._pytwis._rc.lrange(post_id_user_key, 0, -1)
+        self._pytwis._rc.delete(post_id_user_key)
+        self._pytwis._rc.rpush(post_id_user_key, post_ids[0], post_ids[2], post_ids[1])
+        
+        _, result = self._pytwis.get_timeline_page(author['auth'], 10, since_id=int(post_ids[2]))
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet2', 'tweet1'],
+                         'A new tweet behind an older one should not be skipped')
+
+class PytwisBoundedTimelineTests(PytwisTests):
+    '''Test for the user timelines bounded by ``user_timeline_max_post_cnt``.'''
+    
+    def setUp(self):
+        super().setUp()
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, user_timeline_max_post_cnt=2)
+        
+    def test_backfill_trimmed_tweets(self):
+        _, author = self._pytwis.register('author', 'password')
+        _, follower = self._pytwis.register('follower', 'password')
+        self._pytwis.follow(follower['auth'], 'author')
+        for index in range(4):
+            self._pytwis.post_tweet(author['auth'], 'tweet{}'.format(index))
+        
+        follower_user_id = self._pytwis._rc.hget(Pytwis.USERS_HASH_KEY, 'follower')
+        self.assertEqual(self._pytwis._rc.llen(Pytwis.POST_ID_USER_KEY_FORMAT.format(follower_user_id)), 2,
+                         'The user timeline should be trimmed')
+        
+        _, result = self._pytwis.get_timeline(follower['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], 
+                         ['tweet3', 'tweet2', 'tweet1', 'tweet0'],
+                         'The trimmed tweets should be rebuilt')
+        
+        _, result = self._pytwis.get_timeline_page(follower['auth'], 3)
+        _, result = self._pytwis.get_timeline_page(follower['auth'], 3, max_id=result['next_max_id'])
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet0'],
+                         'Paging past the trimmed user timeline should rebuild the tweets')
+    
+    def test_backfill_after_unfollow(self):
+        # Probe the lists of the authored posts instead of reading them at once.
+        self._pytwis.TIMELINE_SCAN_WINDOW = 2
+        _, follower = self._pytwis.register('follower', 'password')
+        for author in ['author1', 'author2']:
+            _, result = self._pytwis.register(author, 'password')
+            self._pytwis.follow(follower['auth'], author)
+            for index in range(5):
+                self._pytwis.post_tweet(result['auth'], '{}_{}'.format(author, index))
+        
+        # The user timeline is no longer full once the tweets of author2 are purged from it.
+        self._pytwis.unfollow(follower['auth'], 'author2')
+        _, result = self._pytwis.get_timeline(follower['auth'], 3)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], 
+                         ['author1_4', 'author1_3', 'author1_2'],
+                         'The trimmed tweets should be rebuilt after the unfollow')
+        _, result = self._pytwis.get_timeline_page(follower['auth'], 5)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], 
+                         ['author1_{}'.format(index) for index in range(4, -1, -1)],
+                         'Paging past the purged user timeline should rebuild the tweets')
+
+class PytwisUsernameCacheTests(PytwisTests):
+    '''Test for the username cache used to hydrate timelines and follower lists.'''
+    
+    def setUp(self):
+        super().setUp()
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, username_cache_size=10)
+        
+    def test_username_cache(self):
+        _, author = self._pytwis.register('author', 'password')
+        self._pytwis.post_tweet(author['auth'], 'hello')
+        
+        for _ in range(2):
+            _, result = self._pytwis.get_timeline('', -1)
+            self.assertEqual(result['tweets'][0]['username'], 'author', 'Incorrect username')
+        
+        self.assertEqual(self._pytwis.get_username_cache_stats(), {'hits': 1, 'misses': 1, 'size': 1},
+                         'The second timeline should get the username from the cache')
+
+class PytwisSessionCacheTests(PytwisTests):
+    '''Test for the session cache used by the session checks.'''
+    
+    def setUp(self):
+        super().setUp()
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, lua_scripts=True, session_cache_size=10)
+        
+    def test_logout_invalidates_session(self):
+        _, result = self._pytwis.register('user', 'password')
+        auth_secret = result['auth']
+        
+        for _ in range(2):
+            succeeded, _ = self._pytwis.get_followers(auth_secret)
+            self.assertTrue(succeeded, 'The user should be logged in')
+        self.assertEqual(self._pytwis.get_session_cache_stats()['hits'], 1,
+                         'The second session check should hit the session cache')
+        
+        self._pytwis.logout(auth_secret)
+        succeeded, result = self._pytwis.get_followers(auth_secret)
+        self.assertFalse(succeeded, 'The revoked authentication secret should be rejected')
+        self.assertEqual(result['error'], 'Not logged in', 'Incorrect error message')
+
+class PytwisConnectionPoolTests(PytwisTests):
+    '''Test for the Redis connection options shared by the front ends.'''
+
+    def test_unix_socket_blocking_pool(self):
+        import argparse
+        from unittest import mock
+        import redis
+        from pytwis_clt import add_redis_arguments, redis_connection_kwargs
+
+        parser = argparse.ArgumentParser()
+        add_redis_arguments(parser)
+        args = parser.parse_args(['-s', '/tmp/pytwis_test.sock', '--max-connections', '4',
+                                  '--pool-timeout', '5', '--health-check-interval', '30'])
+        # The test Redis server may not listen on the socket, so only the pool is checked.
+        with mock.patch.object(redis.StrictRedis, 'ping', return_value=True):
+            twis = Pytwis(db=TEST_DATABASE_ID, **redis_connection_kwargs(args))
+
+        connection_pool = twis._rc.connection_pool
+        self.assertIsInstance(connection_pool, redis.BlockingConnectionPool,
+                              'max_connections should make the pool block')
+        self.assertEqual(connection_pool.max_connections, 4)
+        self.assertEqual(connection_pool.timeout, 5)
+        self.assertIs(connection_pool.connection_class, redis.UnixDomainSocketConnection)
+        self.assertEqual(connection_pool.connection_kwargs['path'], '/tmp/pytwis_test.sock')
+        self.assertEqual(connection_pool.connection_kwargs['db'], TEST_DATABASE_ID)
+        self.assertEqual(connection_pool.connection_kwargs['health_check_interval'], 30)
+        self.assertNotIn('host', connection_pool.connection_kwargs)
+
+    def test_tcp_blocking_pool(self):
+        import redis
+
+        twis = Pytwis(db=TEST_DATABASE_ID, max_connections=2, pool_timeout=1,
+                      socket_keepalive=True, prewarm_connections=2)
+        connection_pool = twis._rc.connection_pool
+        self.assertIsInstance(connection_pool, redis.BlockingConnectionPool)
+        self.assertEqual(connection_pool.connection_kwargs['host'], '127.0.0.1')
+        self.assertTrue(connection_pool.connection_kwargs['socket_keepalive'])
+        _, result = twis.register('user', 'password')
+        self.assertTrue(twis.get_timeline(result['auth'], -1)[0],
+                        'Failed to get the timeline via the blocking pool')
+
+class PytwisClusterKeyLayoutTests(unittest.TestCase):
+    '''Test for the key layout of the cluster mode, which needs no Redis server.'''
+
+    # The per-user keys read and written together, e.g., by post_tweet, follow and unfollow.
+    USER_KEY_FORMAT_NAMES = ['USER_ID_PROFILE_KEY_FORMAT', 'FOLLOWER_ZSET_KEY_FORMAT',
+                             'FOLLOWING_ZSET_KEY_FORMAT', 'POST_ID_USER_KEY_FORMAT',
+                             'AUTHORED_POST_ID_USER_KEY_FORMAT', 'TRIMMED_USER_KEY_FORMAT']
+
+    @staticmethod
+    def hash_tag(key):
+        # The part of a key hashed into its slot, as in the Redis Cluster specification.
+        start = key.find('{')
+        end = key.find('}', start + 1)
+        if start == -1 or end == -1 or end == start + 1:
+            return key
+        return key[start + 1:end]
+
+    def test_user_keys_share_hash_tag(self):
+        from pytwis import PytwisKeyLayout
+
+        # Apply the cluster key formats as Pytwis.__init__ does.
+        layout = PytwisKeyLayout()
+        for key_format_name, key_format in PytwisKeyLayout.CLUSTER_KEY_FORMATS.items():
+            setattr(layout, key_format_name, key_format)
+
+        for user_id in ['1', '42', '1000000']:
+            user_keys = [getattr(layout, key_format_name).format(user_id)
+                         for key_format_name in self.USER_KEY_FORMAT_NAMES]
+            self.assertEqual({self.hash_tag(user_key) for user_key in user_keys}, {user_id},
+                             'The keys {} should share the hash tag {{{}}}'.format(user_keys, user_id))
+
+        self.assertCountEqual(PytwisKeyLayout.CLUSTER_KEY_FORMATS, self.USER_KEY_FORMAT_NAMES,
+                              'Every per-user key should have a cluster key format')
+        self.assertNotEqual(self.hash_tag(PytwisKeyLayout.USERS_HASH_SHARD_KEY_FORMAT.format(1)),
+                            self.hash_tag(PytwisKeyLayout.USERS_HASH_SHARD_KEY_FORMAT.format(2)),
+                            'The shards of the users hash should be spread over the slots')
+
+class PytwisReplicaTests(PytwisTests):
+    '''Test for routing the read-only methods to the replicas.'''
+
+    def setUp(self):
+        super().setUp()
+        # Use the primary itself as the replicas since the test has a single Redis server.
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, replicas=[('127.0.0.1', 6379)] * 2)
+
+    def test_read_only_methods(self):
+        self._pytwis.register('user', 'password')
+        succeeded, result = self._pytwis.login('user', 'password')
+        self.assertTrue(succeeded, 'Failed to log in on a replica')
+        auth_secret = result['auth']
+
+        self._pytwis.post_tweet(auth_secret, 'tweet')
+        for _ in range(2):
+            succeeded, result = self._pytwis.get_timeline(auth_secret, -1)
+            self.assertTrue(succeeded, 'Failed to get the timeline from a replica')
+            self.assertEqual(len(result['tweets']), 1, 'Incorrect number of tweets')
+
+    def test_least_latency(self):
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, replicas=[('127.0.0.1', 6379)],
+                              replica_selection='least_latency')
+        _, result = self._pytwis.register('user', 'password')
+        succeeded, result = self._pytwis.get_following(result['auth'])
+        self.assertTrue(succeeded, 'Failed to get the following list from a replica')
+        self.assertEqual(result['following_list'], [], 'Incorrect following list')
+
+class PytwisBatchTests(PytwisTests):
+    '''Test for the batch methods.'''
+
+    def test_register_many(self):
+        results = self._pytwis.register_many([('user1', 'password'), ('user2', 'password'),
+                                              ('user1', 'password')])
+        self.assertEqual([succeeded for succeeded, _ in results], [True, True, False],
+                         'Only the duplicate username should fail')
+        self.assertEqual(results[2][1]['error'], 'username user1 already exists', 'Incorrect error message')
+
+        succeeded, _ = self._pytwis.login('user2', 'password')
+        self.assertTrue(succeeded, 'Failed to log into a user registered in a batch')
+
+    def test_follow_many_and_post_tweets(self):
+        (_, result1), (_, result2) = self._pytwis.register_many([('user1', 'password'),
+                                                                 ('user2', 'password')])
+        results = self._pytwis.follow_many([(result2['auth'], 'user1'), (result2['auth'], 'user3')])
+        self.assertEqual([succeeded for succeeded, _ in results], [True, False],
+                         'Only following the nonexistent user should fail')
+
+        results = self._pytwis.post_tweets([(result1['auth'], 'tweet1'), ('', 'tweet2'),
+                                            (result1['auth'], 'tweet3')])
+        self.assertEqual([succeeded for succeeded, _ in results], [True, False, True],
+                         'Only the tweet without login should fail')
+        self.assertEqual(results[1][1]['error'], 'Not logged in', 'Incorrect error message')
+
+        _, result = self._pytwis.get_timeline(result2['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet3', 'tweet1'],
+                         'The tweets should be pushed into the timeline of the follower')
+
+class PytwisLoaderTests(PytwisTests):
+    '''Test for the bulk loader.'''
+
+    def test_load_and_rebuild_timelines(self):
+        import os
+        import tempfile
+        from pytwis_loader import PytwisLoader
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = {}
+            for name, content in [('users.csv', 'username,password\nuser1,password\nuser2,password\n'),
+                                  ('follows.jsonl', '{"follower": "user2", "followee": "user1"}\n'),
+                                  ('posts.jsonl', '{"username": "user1", "body": "tweet1"}\n'
+                                                  '{"username": "user2", "body": "tweet2"}\n')]:
+                paths[name] = os.path.join(temp_dir, name)
+                with open(paths[name], 'w') as input_file:
+                    input_file.write(content)
+
+            checkpoint_path = os.path.join(temp_dir, 'checkpoint')
+            loader = PytwisLoader(self._pytwis, window_size=1, checkpoint_path=checkpoint_path)
+            self.assertEqual(loader.load_users(paths['users.csv']), (2, 0), 'Failed to load the users')
+            self.assertEqual(loader.load_follows(paths['follows.jsonl']), (1, 0), 'Failed to load the follows')
+            self.assertEqual(loader.load_posts(paths['posts.jsonl']), (2, 0), 'Failed to load the tweets')
+            loader.rebuild_timelines()
+            self.assertFalse(os.path.exists(checkpoint_path), 'The checkpoint should be deleted once the load completes')
+
+            # An interrupted load resumes from the checkpoint of the file, unless it's restarted.
+            more_posts_path = os.path.join(temp_dir, 'more_posts.jsonl')
+            with open(more_posts_path, 'w') as input_file:
+                input_file.write('{"username": "user1", "body": "tweet3"}\n{"username": "user1", "body": "tweet4"}\n')
+            loader._save_checkpoint(loader._get_file_checkpoint_key(more_posts_path), 1)
+            self.assertEqual(PytwisLoader(self._pytwis, checkpoint_path=checkpoint_path, restart=True)._checkpoint, {},
+                             'A restarted load should ignore the checkpoint')
+            loader = PytwisLoader(self._pytwis, checkpoint_path=checkpoint_path)
+            self.assertEqual(loader.load_posts(more_posts_path), (2, 0), 'Failed to resume loading the tweets')
+            _, result = self._pytwis.get_timeline('', -1)
+            self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet4', 'tweet2', 'tweet1'],
+                             'Only the tweets after the checkpoint should be loaded')
+
+            # A different file at the same path isn't resumed from the checkpoint of the previous one.
+            loader._save_checkpoint(loader._get_file_checkpoint_key(more_posts_path), 2)
+            with open(more_posts_path, 'w') as input_file:
+                input_file.write('{"username": "user1", "body": "tweet5"}\n')
+            self.assertEqual(loader.load_posts(more_posts_path), (1, 0), 'The new file should be loaded')
+
+        _, result = self._pytwis.login('user2', 'password')
+        _, result = self._pytwis.get_timeline(result['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet2', 'tweet1'],
+                         'The rebuilt timeline should include the tweets of the followings')
+
+    def test_build_authored_posts(self):
+        from pytwis_loader import PytwisLoader
+
+        _, result = self._pytwis.register('user', 'password')
+        for index in range(3):
+            self._pytwis.post_tweet(result['auth'], 'tweet{}'.format(index))
+
+        # Drop the list of the authored posts as if the posts had been written before it was introduced.
+        user_id = self._pytwis._rc.hget(Pytwis.USERS_HASH_KEY, 'user')
+        authored_post_id_user_key = Pytwis.AUTHORED_POST_ID_USER_KEY_FORMAT.format(user_id)
+        authored_post_ids = self._pytwis._rc.lrange(authored_post_id_user_key, 0, -1)
+        self._pytwis._rc.ltrim(authored_post_id_user_key, 0, 0)
+        self._pytwis._rc.delete(Pytwis.AUTHORED_POSTS_COMPLETE_KEY)
+        with self.assertRaises(ValueError, msg='The user timelines should not be trimmed without the lists'):
+            Pytwis(db=TEST_DATABASE_ID, user_timeline_max_post_cnt=2)
+
+        PytwisLoader(self._pytwis, window_size=2).build_authored_posts()
+        self.assertEqual(self._pytwis._rc.lrange(authored_post_id_user_key, 0, -1), authored_post_ids,
+                         'The list of the authored posts should be rebuilt')
+        Pytwis(db=TEST_DATABASE_ID, user_timeline_max_post_cnt=2)
+
+class PytwisBenchmarkTests(PytwisTests):
+    '''Test for the benchmark on a tiny graph.'''
+
+    def test_generate_graph(self):
+        from pytwis_benchmark import generate_graph
+
+        usernames, auth_secrets = generate_graph(self._pytwis, 4, 2, 6, 1.0, 0)
+        self.assertEqual(usernames, ['user0', 'user1', 'user2', 'user3'])
+        self.assertEqual(len(auth_secrets), 4, 'Every user should be registered')
+        for auth_secret in auth_secrets:
+            _, result = self._pytwis.get_following(auth_secret)
+            self.assertLessEqual(len(result['following_list']), 2, 'Too many followings')
+        _, result = self._pytwis.get_timeline('', -1)
+        self.assertEqual(len(result['tweets']), 6, 'Every tweet should be posted')
+
+    def test_run_worker_and_summarize(self):
+        from pytwis_benchmark import BENCHMARK_METHODS, generate_graph, percentile, run_worker, summarize
+
+        self.assertEqual(percentile([], 50), None)
+        self.assertEqual(percentile([5], 99), 5)
+        self.assertEqual([percentile(list(range(1, 101)), percent) for percent in [50, 95, 99, 100]],
+                         [50, 95, 99, 100], 'Incorrect nearest-rank percentiles')
+
+        usernames, auth_secrets = generate_graph(self._pytwis, 3, 1, 3, 1.0, 0)
+        mix = {method: 1 for method in BENCHMARK_METHODS}
+        worker_result = run_worker(({'db': TEST_DATABASE_ID}, usernames, auth_secrets, mix, 0.05, 1.0, 1))
+        summary = summarize([worker_result], 0.05)
+        self.assertGreaterEqual(sum(method_summary['count'] for method_summary in summary.values()), 1,
+                                'The worker should call at least one method')
+        for method_summary in summary.values():
+            self.assertLessEqual(method_summary['p50_ms'], method_summary['p95_ms'])
+            self.assertLessEqual(method_summary['p95_ms'], method_summary['p99_ms'])
+
+        summary = summarize([({'login': [0.003, 0.001]}, {'login': 1}),
+                             ({'login': [0.002]}, {})], 1.5)
+        self.assertEqual(summary, {'login': {'count': 3, 'errors': 1, 'throughput': 2.0,
+                                             'p50_ms': 2.0, 'p95_ms': 3.0, 'p99_ms': 3.0}},
+                         'Incorrect summary of the worker results')
+
+class PytwisMetricsTests(PytwisTests):
+    '''Test for the metrics of the Pytwis methods.'''
+
+    def test_metrics(self):
+        self.assertIsNone(self._pytwis.get_metrics(), 'The metrics should be disabled by default')
+
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, metrics=True)
+        _, result = self._pytwis.register('user', 'password')
+        self._pytwis.login('user', 'wrong_password')
+        self._pytwis.get_timeline(result['auth'], -1)
+
+        metrics = self._pytwis.get_metrics()
+        self.assertIn('pytwis_calls_total{method="login"} 1', metrics, 'The login should be counted')
+        self.assertIn('pytwis_errors_total{method="login"} 1', metrics, 'The failed login should be counted')
+        self.assertIn('pytwis_call_duration_seconds_count{method="get_timeline"} 1', metrics,
+                      'The latency of get_timeline should be recorded')
+        self.assertIn('pytwis_phase_duration_seconds_count{phase="auth"} 1', metrics,
+                      'The session check of get_timeline should be recorded')
+        self.assertIn('pytwis_redis_round_trips_total{method="get_timeline"}', metrics,
+                      'The Redis round trips of get_timeline should be counted')
+
+    def test_iter_metrics(self):
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, metrics=True)
+        _, result = self._pytwis.register('user', 'password')
+        self._pytwis.post_tweet(result['auth'], 'hello')
+        _, result = self._pytwis.iter_timeline(result['auth'])
+
+        def round_trip_cnts():
+            return {line.split()[0]: line.split()[1] for line in self._pytwis.get_metrics().splitlines()
+                    if line.startswith('pytwis_redis_round_trips_total{')}
+
+        round_trip_cnts_before = round_trip_cnts()
+        self.assertEqual(len(list(result['tweets'])), 1)
+        round_trip_cnts_after = round_trip_cnts()
+        self.assertNotEqual(round_trip_cnts_after.get('pytwis_redis_round_trips_total{method="iter_timeline"}'),
+                            round_trip_cnts_before.get('pytwis_redis_round_trips_total{method="iter_timeline"}'),
+                            'The Redis round trips of the timeline generator should be counted to iter_timeline')
+        self.assertEqual(round_trip_cnts_after.get('pytwis_redis_round_trips_total{method="other"}'),
+                         round_trip_cnts_before.get('pytwis_redis_round_trips_total{method="other"}'),
+                         'No Redis round trip of the timeline generator should be left unattributed')
+
+class PytwisPostStorageTests(PytwisTests):
+    '''Test for the compact post storages.'''
+
+    def test_post_storages(self):
+        for post_storage, lua_scripts in [('packed', False), ('bucketed', False), ('bucketed', True)]:
+            self._pytwis._rc.flushdb()
+            self._pytwis = Pytwis(db=TEST_DATABASE_ID, post_storage=post_storage, lua_scripts=lua_scripts)
+            _, result = self._pytwis.register('user', 'password')
+            self._pytwis.post_tweet(result['auth'], 'hello: world')
+
+            _, result = self._pytwis.get_timeline('', -1)
+            self.assertEqual([(tweet['body'], tweet['username']) for tweet in result['tweets']],
+                             [('hello: world', 'user')],
+                             'Failed to read a tweet from the {} storage'.format(post_storage))
+
+    def test_migrate_posts(self):
+        from pytwis_loader import PytwisLoader
+
+        _, result = self._pytwis.register('user', 'password')
+        self._pytwis.post_tweet(result['auth'], 'tweet1')
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, post_storage='bucketed')
+        self._pytwis.post_tweet(result['auth'], 'tweet2')
+
+        # The tweets in both the storages are readable before the migration...
+        _, result = self._pytwis.get_timeline('', -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet2', 'tweet1'])
+
+        # ...and after it.
+        self.assertEqual(PytwisLoader(self._pytwis).migrate_posts('bucketed'), 2,
+                         'Both the tweets should be migrated')
+        self.assertEqual(self._pytwis._rc.exists(Pytwis.POST_ID_KEY_FORMAT.format(1)), 0,
+                         'The migrated tweet should be removed from the old storage')
+        _, result = self._pytwis.get_timeline('', -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['tweet2', 'tweet1'])
+
+class PytwisFollowBackfillTests(PytwisTests):
+    '''Test for merging and removing the posts of a followee on follow and unfollow.'''
+
+    def setUp(self):
+        super().setUp()
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, follow_backfill_post_cnt=2)
+
+    def test_follow_and_unfollow(self):
+        _, followee = self._pytwis.register('followee', 'password')
+        _, user = self._pytwis.register('user', 'password')
+        for index in range(3):
+            self._pytwis.post_tweet(followee['auth'], 'followee{}'.format(index))
+            self._pytwis.post_tweet(user['auth'], 'user{}'.format(index))
+
+        self._pytwis.follow(user['auth'], 'followee')
+        _, result = self._pytwis.get_timeline(user['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']],
+                         ['user2', 'followee2', 'user1', 'followee1', 'user0'],
+                         'The latest tweets of the followee should be merged in order')
+
+        self._pytwis.unfollow(user['auth'], 'followee')
+        _, result = self._pytwis.get_timeline(user['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['user2', 'user1', 'user0'],
+                         'The tweets of the unfollowed user should be removed')
+
+    def test_unfollow_purge_window(self):
+        _, followee = self._pytwis.register('followee', 'password')
+        _, user = self._pytwis.register('user', 'password')
+        for index in range(3):
+            self._pytwis.post_tweet(followee['auth'], 'followee{}'.format(index))
+            self._pytwis.post_tweet(user['auth'], 'user{}'.format(index))
+
+        self._pytwis.follow(user['auth'], 'followee')
+        self._pytwis.UNFOLLOW_PURGE_WINDOW = 3
+        self._pytwis.unfollow(user['auth'], 'followee')
+        _, result = self._pytwis.get_timeline(user['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['user2', 'user1', 'followee1', 'user0'],
+                         'Only the tweets of the unfollowed user in the purge window should be removed')
+
+    def test_follow_and_unfollow_oneself(self):
+        _, user = self._pytwis.register('user', 'password')
+        for index in range(3):
+            self._pytwis.post_tweet(user['auth'], 'user{}'.format(index))
+
+        self._pytwis.follow(user['auth'], 'user')
+        self._pytwis.unfollow(user['auth'], 'user')
+        _, result = self._pytwis.get_timeline(user['auth'], -1)
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['user2', 'user1', 'user0'],
+                         'Unfollowing oneself should not remove the own tweets')
+
+class PytwisFollowListPageTests(PytwisTests):
+    '''Test for getting the follower list page by page and counting the followers.'''
+
+    def test_get_followers_page(self):
+        _, followee = self._pytwis.register('followee', 'password')
+        for index in range(3):
+            _, follower = self._pytwis.register('follower{}'.format(index), 'password')
+            self._pytwis.follow(follower['auth'], 'followee')
+
+        succeeded, result = self._pytwis.get_followers_page(followee['auth'], 2)
+        self.assertTrue(succeeded, 'Failed to get the first follower page')
+        self.assertEqual(len(result['follower_list']), 2, 'The first page should be full')
+        self.assertEqual(result['next_offset'], 2, 'The next page should start after the first page')
+
+        _, last_page = self._pytwis.get_followers_page(followee['auth'], 2, result['next_offset'])
+        self.assertEqual(len(last_page['follower_list']), 1, 'The last page should hold the rest')
+        self.assertIsNone(last_page['next_offset'], 'There should be no page after the last page')
+        self.assertEqual(set(result['follower_list'] + last_page['follower_list']),
+                         {'follower0', 'follower1', 'follower2'},
+                         'The pages should hold all the followers')
+
+        _, result = self._pytwis.count_followers(followee['auth'])
+        self.assertEqual(result['follower_cnt'], 3, 'Wrong follower count')
+        _, result = self._pytwis.count_following(followee['auth'])
+        self.assertEqual(result['following_cnt'], 0, 'Wrong following count')
+
+    def test_get_invalid_follow_list_pages(self):
+        _, followee = self._pytwis.register('followee', 'password')
+        _, follower = self._pytwis.register('follower', 'password')
+        self._pytwis.follow(follower['auth'], 'followee')
+
+        for page_size, offset in [(0, 0), (-1, 0), (1, -1)]:
+            succeeded, _ = self._pytwis.get_followers_page(followee['auth'], page_size, offset)
+            self.assertFalse(succeeded, 'Got a follower page of size {} at offset {}'.format(page_size, offset))
+            succeeded, _ = self._pytwis.get_following_page(follower['auth'], page_size, offset)
+            self.assertFalse(succeeded, 'Got a following page of size {} at offset {}'.format(page_size, offset))
+
+class PytwisPasswordHashTests(PytwisTests):
+    '''Test for hashing the passwords by scrypt and rehashing them on login.'''
+
+    def setUp(self):
+        super().setUp()
+        # A low cost to keep the test fast.
+        self._pytwis = Pytwis(db=TEST_DATABASE_ID, password_scrypt_n=2 ** 4, password_hash_workers=1)
+
+    def _get_stored_password(self, username):
+        user_id = self._pytwis._rc.hget(self._pytwis.USERS_HASH_KEY, username)
+        return self._pytwis._rc.hget(self._pytwis.USER_ID_PROFILE_KEY_FORMAT.format(user_id),
+                                     self._pytwis.USER_ID_PROFILE_PASSWORD_KEY)
+
+    def test_register_and_login(self):
+        succeeded, result = self._pytwis.register('user', 'password')
+        self.assertTrue(succeeded, 'Failed to register a user')
+        self.assertTrue(self._get_stored_password('user').startswith('scrypt$16$'),
+                        'The password should be stored hashed')
+
+        succeeded, _ = self._pytwis.login('user', 'password')
+        self.assertTrue(succeeded, 'Failed to log in with the right password')
+        succeeded, _ = self._pytwis.login('user', 'wrong password')
+        self.assertFalse(succeeded, 'Logged in with a wrong password')
+
+        succeeded, _ = self._pytwis.change_password(result['auth'], 'password', 'new password')
+        self.assertTrue(succeeded, 'Failed to change the password')
+        succeeded, _ = self._pytwis.login('user', 'new password')
+        self.assertTrue(succeeded, 'Failed to log in with the new password')
+
+    def test_rehash_on_login(self):
+        raw_pytwis = Pytwis(db=TEST_DATABASE_ID)
+        raw_pytwis.register('user', 'password')
+        self.assertEqual(self._get_stored_password('user'), 'password', 'The password should be stored raw')
+
+        succeeded, _ = self._pytwis.login('user', 'password')
+        self.assertTrue(succeeded, 'Failed to log in with the raw password')
+        self.assertTrue(self._get_stored_password('user').startswith('scrypt$16$'),
+                        'The raw password should be rehashed')
+
+        costlier_pytwis = Pytwis(db=TEST_DATABASE_ID, password_scrypt_n=2 ** 5, password_hash_workers=0)
+        succeeded, _ = costlier_pytwis.login('user', 'password')
+        self.assertTrue(succeeded, 'Failed to log in with the old costs')
+        self.assertTrue(self._get_stored_password('user').startswith('scrypt$32$'),
+                        'The password should be rehashed with the new costs')
+
+        succeeded, _ = raw_pytwis.login('user', 'password')
+        self.assertTrue(succeeded, 'Failed to log in without the password hashing enabled')
+
+class PytwisGeneralTimelineCacheTests(PytwisTests):
+    '''Test for the general timeline cached as JSON until the next post.'''
+
+    def test_get_general_timeline_json(self):
+        import json
+        _, author = self._pytwis.register('author', 'password')
+        self._pytwis.post_tweet(author['auth'], 'first')
+
+        succeeded, first_result = self._pytwis.get_general_timeline_json(10)
+        self.assertTrue(succeeded, 'Failed to get the general timeline')
+        _, timeline = self._pytwis.get_timeline('', 10)
+        self.assertEqual(json.loads(first_result['timeline_json']), timeline,
+                         'The cached timeline should be the same as the general timeline')
+        _, result = self._pytwis.get_general_timeline_json(10)
+        self.assertEqual(result['etag'], first_result['etag'], 'The ETag should not change without a post')
+
+        lua_pytwis = Pytwis(db=TEST_DATABASE_ID, lua_scripts=True)
+        lua_pytwis.post_tweet(author['auth'], 'second')
+        _, result = self._pytwis.get_general_timeline_json(10)
+        self.assertNotEqual(result['etag'], first_result['etag'], 'A new post should change the ETag')
+        self.assertEqual([tweet['body'] for tweet in json.loads(result['timeline_json'])['tweets']],
+                         ['second', 'first'], 'The cached timeline should include the new post')
+
+    def test_general_timeline_cache_size(self):
+        import json
+        _, author = self._pytwis.register('author', 'password')
+        for index in range(3):
+            self._pytwis.post_tweet(author['auth'], 'tweet{}'.format(index))
+
+        for max_cnt_tweets in range(-1, 20):
+            succeeded, result = self._pytwis.get_general_timeline_json(max_cnt_tweets)
+            self.assertTrue(succeeded, 'Failed to get the general timeline')
+            self.assertEqual(len(json.loads(result['timeline_json'])['tweets']),
+                             3 if max_cnt_tweets == -1 else min(max_cnt_tweets, 3))
+        self.assertEqual(self._pytwis._rc.hlen(Pytwis.GENERAL_TIMELINE_CACHE_KEY), 1,
+                         'Only the whole general timeline should be cached')
+
+        succeeded, _ = self._pytwis.get_general_timeline_json(-2)
+        self.assertFalse(succeeded, 'Got the general timeline with a negative tweet count')
+
+class PytwisIteratorTests(PytwisTests):
+    '''Test for iterating over the timelines and the follow lists chunk by chunk.'''
+
+    def test_iter_timeline(self):
+        _, followee = self._pytwis.register('followee', 'password')
+        _, user = self._pytwis.register('user', 'password')
+        self._pytwis.follow(user['auth'], 'followee')
+        for index in range(5):
+            self._pytwis.post_tweet(followee['auth'], 'followee{}'.format(index))
+            self._pytwis.post_tweet(user['auth'], 'user{}'.format(index))
+
+        for twis in [self._pytwis, Pytwis(db=TEST_DATABASE_ID, user_timeline_max_post_cnt=3)]:
+            _, timeline = twis.get_timeline(user['auth'], -1)
+            succeeded, result = twis.iter_timeline(user['auth'], chunk_size=2)
+            self.assertTrue(succeeded, 'Failed to iterate over the user timeline')
+            self.assertEqual(list(result['tweets']), timeline['tweets'],
+                             'The iterated timeline should be the same as the whole timeline')
+
+        succeeded, _ = self._pytwis.iter_timeline('invalid auth')
+        self.assertFalse(succeeded, 'Iterated over a timeline without logging in')
+
+    def test_iter_out_of_order_timeline(self):
+        _, author = self._pytwis.register('author', 'password')
+        for index in range(3):
+            self._pytwis.post_tweet(author['auth'], 'tweet{}'.format(index))
+
+        # Reorder the user timeline as if the post 2 had been pushed after the post 1.
+        author_user_id = self._pytwis._rc.hget(Pytwis.USERS_HASH_KEY, 'author')
+        post_id_user_key = Pytwis.POST_ID_USER_KEY_FORMAT.format(author_user_id)
+        post_ids = self._pytwis._rc.lrange(post_id_user_key, 0, -1)
+        self._pytwis._rc.delete(post_id_user_key)
+        self._pytwis._rc.rpush(post_id_user_key, post_ids[0], post_ids[2], post_ids[1])
+
+        _, timeline = self._pytwis.get_timeline(author['auth'], -1)
+        _, result = self._pytwis.iter_timeline(author['auth'], chunk_size=1)
+        self.assertEqual(list(result['tweets']), timeline['tweets'],
+                         'A new tweet behind an older one should not be skipped')
+
+        # Push a new tweet in the middle of the iteration.
+        _, result = self._pytwis.iter_timeline(author['auth'], chunk_size=1)
+        tweets = [next(result['tweets'])]
+        self._pytwis.post_tweet(author['auth'], 'tweet3')
+        tweets.extend(result['tweets'])
+        self.assertEqual([tweet['body'] for tweet in tweets], ['tweet2', 'tweet0', 'tweet1'],
+                         'A new tweet should neither shift nor duplicate the rest of the timeline')
+
+    def test_iter_followers(self):
+        _, followee = self._pytwis.register('followee', 'password')
+        for index in range(5):
+            _, follower = self._pytwis.register('follower{}'.format(index), 'password')
+            self._pytwis.follow(follower['auth'], 'followee')
+
+        succeeded, result = self._pytwis.iter_followers(followee['auth'], chunk_size=2)
+        self.assertTrue(succeeded, 'Failed to iterate over the followers')
+        self.assertEqual(sorted(result['follower_list']), ['follower{}'.format(index) for index in range(5)],
+                         'The iterated followers should be all the followers')
+        _, result = self._pytwis.iter_following(followee['auth'])
+        self.assertEqual(list(result['following_list']), [], 'The followee should follow no one')
+
+class PytwisNdjsonTests(PytwisTests):
+    '''Test for the newline-delimited JSON responses of pytwis_rest.py and pytwis_flask.py.'''
+
+    NDJSON_HEADERS = {'Accept': 'application/x-ndjson'}
+
+    def setUp(self):
+        super().setUp()
+        _, self._followee = self._pytwis.register('followee', 'password')
+        _, self._user = self._pytwis.register('user', 'password')
+        _, follower = self._pytwis.register('follower', 'password')
+        self._pytwis.follow(self._user['auth'], 'followee')
+        self._pytwis.follow(follower['auth'], 'user')
+        for index in range(3):
+            self._pytwis.post_tweet(self._followee['auth'], 'followee{}'.format(index))
+            self._pytwis.post_tweet(self._user['auth'], 'user{}'.format(index))
+
+    def parse_ndjson(self, response):
+        import json
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson', 'Wrong Content-Type of a streamed response')
+        body = response.get_data(as_text=True)
+        self.assertTrue(body.endswith('\n'), 'Every line should end with a newline')
+        items = [json.loads(line) for line in body.split('\n')[:-1]]
+        for item in items:
+            self.assertIsInstance(item, dict, 'Every line should be a JSON object')
+        return items
+
+    def test_rest_ndjson(self):
+        import pytwis_rest
+
+        g_pytwis = pytwis_rest.g_pytwis
+        pytwis_rest.g_pytwis = self._pytwis
+        self.addCleanup(setattr, pytwis_rest, 'g_pytwis', g_pytwis)
+        client = pytwis_rest.app.test_client()
+
+        posts_url = pytwis_rest.HTTP_INDEX_URL + 'posts'
+        response = client.get(posts_url, json={'auth': self._user['auth']})
+        self.assertEqual(response.mimetype, 'application/json')
+        tweets = response.get_json()['tweets']
+        self.assertEqual(len(tweets), 6)
+        self.assertEqual(self.parse_ndjson(client.get(posts_url, json={'auth': self._user['auth']},
+                                                      headers=self.NDJSON_HEADERS)),
+                         tweets, 'The streamed timeline should be the same as the whole timeline')
+        self.assertEqual(self.parse_ndjson(client.get(posts_url, json={'auth': self._user['auth'], 'max_tweet_cnt': 2},
+                                                      headers=self.NDJSON_HEADERS)),
+                         tweets[:2], 'The streamed timeline should stop after max_tweet_cnt tweets')
+
+        users_url = pytwis_rest.HTTP_INDEX_URL + 'users'
+        userinfo = client.get(users_url, json={'auth': self._user['auth']}).get_json()['userinfo']
+        items = self.parse_ndjson(client.get(users_url, json={'auth': self._user['auth']},
+                                             headers=self.NDJSON_HEADERS))
+        self.assertEqual(items[0], {'userinfo': {name: value for name, value in userinfo.items()
+                                                 if name not in ['followers', 'followings']}},
+                         'The first line should be the user information without the lists')
+        self.assertEqual([item['followers'] for item in items if 'followers' in item], userinfo['followers'])
+        self.assertEqual([item['followings'] for item in items if 'followings' in item], userinfo['followings'])
+        self.assertEqual(len(items), 3, 'Every follower and following should be a line')
+
+    def test_flask_ndjson(self):
+        import json
+        import pytwis_flask
+
+        g_twis = pytwis_flask.g_twis
+        pytwis_flask.g_twis = self._pytwis
+        self.addCleanup(setattr, pytwis_flask, 'g_twis', g_twis)
+        client = pytwis_flask.app.test_client()
+
+        for command, list_name, item_name in [('timeline', 'tweets', None),
+                                              ('followers', 'follower_list', 'followers'),
+                                              ('followings', 'following_list', 'followings')]:
+            query_string = {'cmd': command, 'auth': self._user['auth']}
+            response = client.get('/pytwis', query_string=query_string)
+            whole_list = json.loads(response.get_data(as_text=True))[list_name]
+            self.assertGreater(len(whole_list), 0)
+            items = self.parse_ndjson(client.get('/pytwis', query_string=query_string, headers=self.NDJSON_HEADERS))
+            if item_name is not None:
+                items = [item[item_name] for item in items]
+            self.assertEqual(items, whole_list, 'The streamed {} should be the same as the whole list'.format(command))
+
+        query_string = {'cmd': 'timeline', 'auth': self._user['auth'], 'max_tweet_cnt': 2}
+        items = self.parse_ndjson(client.get('/pytwis', query_string=query_string, headers=self.NDJSON_HEADERS))
+        self.assertEqual(len(items), 2, 'The streamed timeline should stop after max_tweet_cnt tweets')
+
+class PytwisPostEventTests(PytwisTests):
+    '''Test for reading the new tweets of the followings from the post event streams.'''
+
+    def test_read_post_events(self):
+        _, author = self._pytwis.register('author', 'password')
+        _, follower = self._pytwis.register('follower', 'password')
+        _, stranger = self._pytwis.register('stranger', 'password')
+        self._pytwis.follow(follower['auth'], 'author')
+
+        succeeded, _ = self._pytwis.read_post_events(follower['auth'])
+        self.assertFalse(succeeded, 'Read the post events without post_events')
+
+        events_pytwis = Pytwis(db=TEST_DATABASE_ID, celebrity_follower_threshold=2, post_events=True)
+        _, follower_events = events_pytwis.read_post_events(follower['auth'])
+        _, stranger_events = events_pytwis.read_post_events(stranger['auth'])
+        self.assertEqual(follower_events['events'], [], 'There should be no event before the first post')
+
+        for twis in [events_pytwis, Pytwis(db=TEST_DATABASE_ID, lua_scripts=True, post_events=True),
+                     Pytwis(db=TEST_DATABASE_ID, celebrity_follower_threshold=1, post_events=True)]:
+            twis.post_tweet(author['auth'], 'hello')
+            succeeded, follower_events = events_pytwis.read_post_events(follower['auth'],
+                                                                        follower_events['last_event_id'])
+            self.assertTrue(succeeded, 'Failed to read the post events')
+            self.assertEqual([event['tweet']['body'] for event in follower_events['events']], ['hello'],
+                             'The follower should get the new tweet')
+            _, stranger_events = events_pytwis.read_post_events(stranger['auth'],
+                                                                stranger_events['last_event_id'])
+            self.assertEqual(stranger_events['events'], [], 'A non-follower should not get the new tweet')
+        self.assertEqual(self._pytwis._rc.exists(Pytwis.POST_EVENT_USER_KEY_FORMAT.format(
+            self._pytwis._rc.hget(Pytwis.USERS_HASH_KEY, 'stranger'))), 0,
+            'The tweets should only be published to the streams of their recipients')
+
+        succeeded, _ = events_pytwis.read_post_events(follower['auth'], 'abc')
+        self.assertFalse(succeeded, 'Read the post events after an invalid event ID')
+
+        self._pytwis.post_tweet(author['auth'], 'unpublished')
+        Pytwis(db=TEST_DATABASE_ID, lua_scripts=True).post_tweet(author['auth'], 'unpublished')
+        _, result = events_pytwis.read_post_events(follower['auth'], follower_events['events'][0]['last_event_id'])
+        self.assertEqual(result['events'], [], 'A tweet posted without post_events should not be published')
+
+class PytwisSearchTests(PytwisTests):
+    '''Test for searching the tweets by their hashtags and mentions.'''
+
+    def setUp(self):
+        super().setUp()
+        _, self._author = self._pytwis.register('author', 'password')
+        self._pytwis.post_tweet(self._author['auth'], '#Redis is fast @bob')
+        Pytwis(db=TEST_DATABASE_ID, lua_scripts=True).post_tweet(self._author['auth'], '#redis and #python')
+        self._pytwis.post_tweet(self._author['auth'], 'only #python, mail me at bob@example.com')
+
+    def _search_bodies(self, *args, **kwargs):
+        succeeded, result = self._pytwis.search(*args, **kwargs)
+        self.assertTrue(succeeded, 'Failed to search')
+        return [tweet['body'] for tweet in result['tweets']]
+
+    def test_search_terms(self):
+        self.assertEqual(self._search_bodies('#REDIS'), ['#redis and #python', '#Redis is fast @bob'],
+                         'The search should return the tweets with the hashtag, the latest first')
+        self.assertEqual(self._search_bodies('@bob'), ['#Redis is fast @bob'],
+                         'The search should not match an email address')
+        self.assertEqual(self._search_bodies('#redis #python'), ['#redis and #python'],
+                         'The search should return the tweets with all the terms')
+        self.assertEqual(self._search_bodies(['#python', '@bob'], mode='or'),
+                         ['only #python, mail me at bob@example.com', '#redis and #python', '#Redis is fast @bob'],
+                         'The search should return the tweets with any of the terms')
+        self.assertEqual(self._search_bodies('#missing #redis'), [], 'No tweet has all the terms')
+
+        succeeded, _ = self._pytwis.search('redis')
+        self.assertFalse(succeeded, 'Searched for a term which is not a hashtag or a mention')
+
+    def test_search_pages(self):
+        for mode in ['and', 'or']:
+            bodies = []
+            cursor = None
+            while True:
+                _, result = self._pytwis.search('#redis #python', cursor, limit=1, mode=mode)
+                bodies.extend(tweet['body'] for tweet in result['tweets'])
+                cursor = result['next_cursor']
+                if cursor is None:
+                    break
+            self.assertEqual(bodies, self._search_bodies('#redis #python', mode=mode, limit=10),
+                             'The pages should add up to the whole search result')
+
+    def test_search_invalid_pages(self):
+        for limit in [0, -1, Pytwis.SEARCH_MAX_LIMIT + 1, 'ten']:
+            succeeded, result = self._pytwis.search('#redis', limit=limit)
+            self.assertFalse(succeeded, 'Searched with the invalid limit {}'.format(limit))
+            self.assertIn('limit', result['error'])
+        for cursor in ['abc', '-1', '1.5']:
+            succeeded, _ = self._pytwis.search('#redis', cursor)
+            self.assertFalse(succeeded, 'Searched with the invalid cursor {}'.format(cursor))
+        self.assertEqual(self._search_bodies('#redis', '3', limit='1'), ['#redis and #python'],
+                         'The limit and the cursor of a request should be accepted as strings')
+
+class AsyncPytwisTests(PytwisTests):
+    '''Test for ``AsyncPytwis`` against the same database as ``Pytwis``.'''
+    
+    def test_shared_database(self):
+        import asyncio
+        from pytwis_async import AsyncPytwis
+        
+        async def post_and_get_timeline():
+            async_pytwis = AsyncPytwis(db=TEST_DATABASE_ID)
+            await async_pytwis.connect()
+            
+            succeeded, author = await async_pytwis.register('author', 'password')
+            self.assertTrue(succeeded, 'Failed to register a user')
+            succeeded, _ = await async_pytwis.post_tweet(author['auth'], 'hello')
+            self.assertTrue(succeeded, 'Failed to post a tweet')
+            
+            _, result = await async_pytwis.get_timeline('', -1)
+            await async_pytwis.close()
+            return result
+        
+        result = asyncio.run(post_and_get_timeline())
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['hello'])
+        
+        # The tweet posted by AsyncPytwis should be visible to Pytwis.
+        _, result = self._pytwis.get_timeline('', -1)
+        self.assertEqual([(tweet['username'], tweet['body']) for tweet in result['tweets']], [('author', 'hello')])
+    
+    def test_async_post_indexes(self):
+        import asyncio
+        from pytwis_async import AsyncPytwis
+        
+        events_pytwis = Pytwis(db=TEST_DATABASE_ID, post_events=True)
+        _, author = self._pytwis.register('author', 'password')
+        _, events = events_pytwis.read_post_events(author['auth'])
+        
+        async def post_tweet():
+            async_pytwis = AsyncPytwis(db=TEST_DATABASE_ID, post_events=True)
+            await async_pytwis.connect()
+            await async_pytwis.post_tweet(author['auth'], 'hello #async')
+            await async_pytwis.close()
+        
+        asyncio.run(post_tweet())
+        
+        # The tweet posted by AsyncPytwis should be searchable and published by Pytwis.
+        _, result = self._pytwis.search('#async')
+        self.assertEqual([tweet['body'] for tweet in result['tweets']], ['hello #async'])
+        _, events = events_pytwis.read_post_events(author['auth'], events['last_event_id'])
+        self.assertEqual([event['tweet']['body'] for event in events['events']], ['hello #async'])
         
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file